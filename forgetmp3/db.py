@@ -160,10 +160,10 @@ def _build_tables():
     commit()
     
 def commit():
-    db.connection.commit()
+    db.commit()
     
 def rollback():        
-    db.connection.rollback()
+    db.rollback()
 
 def _prepare():
     _generate()        
@@ -105,13 +105,15 @@ def scan_dir(path=None, full_update=False):
                 id3_info = id3v2(filepath)
                 db.execute("DELETE FROM id3 WHERE song_id=$song_id",
                            {'song_id': song.song_id})
+                id3s = []
                 for field,value in id3_info.items():
                     id3 = db.Id3()
                     id3.set_song(song)
                     id3.field = field
                     # FIXME: Support multi-values better than this
                     id3.value = "\n".join(value)
-                    id3.save()
+                    id3s.append(id3)
+                db.Id3.save_many(id3s)
                 song.scanned = datetime.datetime.now()
                 song.save()
 
@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# *-* encoding: utf8
+#
+# Copyright (c) 2005-2006 Stian Soiland
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307  USA
+#
+# Author: Stian Soiland <stian@soiland.no>
+# URL: http://soiland.no/i/src/forgetsql2/
+# License: LGPL
+#
+"""Benchmarks for forgetSQL2.
+
+The benchmarks run against a temporary sqlite database.
+
+Run all benchmarks:
+    ./benchforgetsql2.py
+
+Run only some benchmarks:
+    ./benchforgetsql2.py roundtrips
+
+The hot path benchmarks (generate, get, where, save, children) run
+against the database both on disk and copied into memory, unless
+--storage is given. Each is timed repeat times, reporting the best
+run. Save the results as JSON for comparing runs:
+    ./benchforgetsql2.py --storage memory --json results.json get where
+"""
+
+import sys
+import os
+import tempfile
+import time
+import platform
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from pysqlite2 import dbapi2 as sqlite
+except ImportError:
+    import sqlite3 as sqlite
+
+import forgetsql2
+
+# Reported by report(), see main()
+results = []
+# Where report() prints results
+output = sys.stdout
+
+def report(benchmark, metric, value, unit, **parameters):
+    """Print a result and add it to results"""
+    params = " ".join(["%s=%s" % item for item in sorted(parameters.items())])
+    if isinstance(value, float):
+        shown = "%.3f" % value
+    else:
+        shown = str(value)
+    print >>output, "%s %s %s: %s %s" % (benchmark, params, metric, 
+                                         shown, unit)
+    result = dict(benchmark=benchmark, metric=metric, value=value, 
+                  unit=unit)
+    result.update(parameters)
+    results.append(result)
+
+def best(function, repeat):
+    """Seconds used by the fastest of repeat calls to function()"""
+    times = []
+    for n in range(repeat):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+class CountingModule(object):
+    """Wrap a DB API module, counting statements sent to the database.
+
+    The number of statements executed through connections made by
+    connect() is available in the attribute statements.
+    """
+    def __init__(self, module):
+        self._module = module
+        self.__name__ = module.__name__
+        self.statements = 0
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def connect(self, *args, **kwargs):
+        connection = self._module.connect(*args, **kwargs)
+        return _CountingConnection(self, connection)
+
+class _CountingConnection(object):
+    def __init__(self, counter, connection):
+        self._counter = counter
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self, *args):
+        return _CountingCursor(self._counter, self._connection.cursor(*args))
+
+class _CountingCursor(object):
+    def __init__(self, counter, cursor):
+        self._counter = counter
+        self._cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, *args):
+        self._counter.statements += 1
+        return self._cursor.execute(*args)
+
+    def executemany(self, *args):
+        self._counter.statements += 1
+        return self._cursor.executemany(*args)
+
+class SharedModule(object):
+    """Wrap a DB API module, connecting to the same connection always.
+
+    Used for in-memory sqlite databases, as each connection to
+    :memory: would otherwise be a new, empty database. Statements are
+    not counted, so that memory and disk are timed alike.
+    """
+    def __init__(self, module, connection):
+        self._module = module
+        self.__name__ = module.__name__
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+    def connect(self, *args, **kwargs):
+        return self._connection
+
+def make_database(filename, boxes=100, things=100000):
+    """Create the benchmark tables box and thing in sqlite database.
+
+    Each thing belongs to a box through the foreign key thing.box_id.
+    """
+    connection = sqlite.connect(filename)
+    c = connection.cursor()
+    c.execute("""CREATE TABLE box (
+                   box_id INTEGER PRIMARY KEY,
+                   name VARCHAR(40)
+                 )""")
+    c.execute("""CREATE TABLE thing (
+                   thing_id INTEGER PRIMARY KEY,
+                   box_id INTEGER,
+                   name VARCHAR(40),
+                   value INTEGER
+                 )""")
+    c.executemany("INSERT INTO box VALUES (?, ?)",
+                  [(n, "box %s" % n) for n in xrange(1, boxes+1)])
+    c.executemany("INSERT INTO thing VALUES (?, ?, ?, ?)",
+                  [(n, n % boxes + 1, "thing %s" % n, n)
+                   for n in xrange(1, things+1)])
+    connection.commit()
+    connection.close()
+
+def bench_roundtrips(filename, gets=2000):
+    """Statements sent to the database per Table.get() by primary key.
+
+    Compares checking the connection before every cursor, as
+    validate_after=-1 will do, with the default of only checking
+    connections that have been idle.
+    """
+    things = sqlite.connect(filename).execute(
+                "SELECT count(*) FROM thing").fetchone()[0]
+    for validate_after in (-1, forgetsql2.DBConnect.validate_after):
+        module = CountingModule(sqlite)
+        db = forgetsql2.generate(module, {"database": filename})
+        db.db.validate_after = validate_after
+        module.statements = 0
+        start = time.time()
+        for n in xrange(gets):
+            db.Thing.get(thing_id=n % things + 1)
+        used = time.time() - start
+        report("roundtrips", "statements", float(module.statements) / gets,
+               "per get", validate_after=validate_after)
+        report("roundtrips", "speed", gets / used, "gets/s", 
+               validate_after=validate_after)
+        db.db.close()
+
+def max_rss():
+    """Peak resident memory of this process in kilobytes"""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on OS X
+        rss /= 1024
+    return rss
+
+def bench_stream(filename, rows=200000):
+    """Peak memory growth while iterating a big table.
+
+    Streaming is measured first, as the peak memory of the process
+    never decreases, then iterating without streaming, where the
+    database module may read the whole result. Keeping all instances in
+    a list is measured last for comparison.
+    """
+    connection = sqlite.connect(filename)
+    connection.execute("CREATE TABLE big AS SELECT * FROM thing")
+    things = connection.execute("SELECT count(*) FROM thing").fetchone()[0]
+    for n in range(rows // things - 1):
+        connection.execute("INSERT INTO big(box_id, name, value) "
+                           "SELECT box_id, name, value FROM thing")
+    connection.commit()
+    rows = connection.execute("SELECT count(*) FROM big").fetchone()[0]
+    connection.close()
+    db = forgetsql2.generate(sqlite, {"database": filename})
+    start = max_rss()
+    count = 0
+    for big in db.Big.where(stream=True):
+        count += 1
+    report("stream", "memory", max_rss() - start, "kB", rows=count,
+           stream=True)
+    start = max_rss()
+    count = 0
+    for big in db.Big:
+        count += 1
+    report("stream", "memory", max_rss() - start, "kB", rows=count,
+           stream=False)
+    start = max_rss()
+    bigs = list(db.Big)
+    report("stream", "memory", max_rss() - start, "kB", rows=len(bigs),
+           stream=False, kept=True)
+    del bigs
+    db.db.close()
+
+def instance_size(instance):
+    """Bytes used by instance, its __dict__ and _primary_values"""
+    size = sys.getsizeof(instance) + sys.getsizeof(instance._primary_values)
+    if hasattr(instance, "__dict__"):
+        size += sys.getsizeof(instance.__dict__)
+    return size
+
+def bench_rows(filename):
+    """Memory per row and load speed of Table instances.
+
+    Compares classes without __slots__, loaded from a dictionary per
+    row as before, with the __slots__ classes loaded straight from the
+    row tuples. The field values themselves are shared and not counted.
+    """
+    for slots in (False, True):
+        db = forgetsql2.generate(sqlite, {"database": filename}, slots=slots)
+        Thing = db.Thing
+        start = time.time()
+        if slots:
+            things = list(Thing.where())
+        else:
+            things = [Thing(_db_row=row) 
+                      for row in db.query("SELECT * FROM thing")]
+        used = time.time() - start
+        size = sum([instance_size(thing) for thing in things])
+        report("rows", "size", float(size) / len(things), "bytes per row",
+               slots=slots)
+        report("rows", "speed", len(things) / used, "rows/s", slots=slots)
+        del things
+        db.db.close()
+
+def bench_startup(filename, tables=300):
+    """Time and statements used by generate() with many tables.
+
+    Compares investigating the schema without cache, with an empty
+    cache file (which is then written) and with a valid cache.
+    """
+    filename = tempfile.mktemp()
+    cache = tempfile.mktemp()
+    connection = sqlite.connect(filename)
+    connection.execute("CREATE TABLE table0 (table0_id INTEGER PRIMARY KEY)")
+    for n in range(1, tables):
+        # Each table has a foreign key to the previous
+        connection.execute("""CREATE TABLE table%s (
+                                table%s_id INTEGER PRIMARY KEY,
+                                name VARCHAR(40),
+                                table%s_id INTEGER
+                              )""" % (n, n, n-1))
+    connection.commit()
+    connection.close()
+    try:
+        for (name, cache_file) in (("none", None), ("cold", cache), 
+                                   ("warm", cache)):
+            module = CountingModule(sqlite)
+            start = time.time()
+            db = forgetsql2.generate(module, {"database": filename}, 
+                                     cache=cache_file)
+            used = time.time() - start
+            report("startup", "time", used, "s", tables=tables, cache=name)
+            report("startup", "statements", module.statements, "statements",
+                   tables=tables, cache=name)
+            db.db.close()
+    finally:
+        os.unlink(filename)
+        os.unlink(cache)
+
+def bench_concurrency(filename, queries=40):
+    """Queries per second when run by the executor of DBConnect.
+
+    Each query joins thing and box, which keeps sqlite busy for a while
+    without holding the Python interpreter lock.
+    """
+    sql = """SELECT count(*) FROM thing, box 
+             WHERE thing.value % 50 = box.box_id % 50 
+               AND thing.thing_id <= 10000"""
+    for workers in (0, 1, 2, 4):
+        db = forgetsql2.generate(sqlite, {"database": filename})
+        db.db.workers = workers
+        start = time.time()
+        if workers:
+            futures = [db.db.submit(db.query_one, sql) 
+                       for n in range(queries)]
+            for future in futures:
+                future.result()
+        else:
+            for n in range(queries):
+                db.query_one(sql)
+        used = time.time() - start
+        report("concurrency", "speed", queries / used, "queries/s", 
+               workers=workers)
+        db.db.close()
+
+def copy_to_memory(filename):
+    """Copy the tables of database filename to a connection to a new
+    in-memory database"""
+    connection = sqlite.connect(":memory:")
+    connection.execute("ATTACH DATABASE ? AS disk", (filename,))
+    tables = connection.execute("""SELECT name, sql FROM disk.sqlite_master 
+                                   WHERE type='table'""").fetchall()
+    for (name, sql) in tables:
+        connection.execute(sql)
+        connection.execute("INSERT INTO %s SELECT * FROM disk.%s" % (
+                           name, name))
+    connection.commit()
+    connection.execute("DETACH DATABASE disk")
+    return connection
+
+def open_database(filename, storage, connection=None):
+    """Run generate() for the benchmark database.
+
+    With storage "memory", the database is used through connection,
+    by default a new copy_to_memory().
+    """
+    if storage == "disk":
+        return forgetsql2.generate(sqlite, {"database": filename})
+    if connection is None:
+        connection = copy_to_memory(filename)
+    return forgetsql2.generate(SharedModule(sqlite, connection),
+                               {"database": ":memory:"})
+
+def bench_generate(filename, storage, repeat):
+    """Time used by generate(), not counting copy_to_memory()"""
+    times = []
+    for n in range(repeat):
+        connection = None
+        if storage == "memory":
+            connection = copy_to_memory(filename)
+        start = time.time()
+        db = open_database(filename, storage, connection)
+        times.append(time.time() - start)
+        db.db.close()
+    report("generate", "time", min(times), "s", storage=storage)
+
+def bench_get(filename, storage, repeat, gets=5000):
+    """Table.get() by primary key, each a query and _load()"""
+    db = open_database(filename, storage)
+    things = db.Thing.select().count()
+    def get():
+        for n in xrange(gets):
+            db.Thing.get(thing_id=n % things + 1)
+    report("get", "speed", gets / best(get, repeat), "gets/s", 
+           storage=storage)
+    db.db.close()
+
+def bench_where(filename, storage, repeat):
+    """Iterating over all instances of where()"""
+    db = open_database(filename, storage)
+    counted = []
+    def where():
+        count = 0
+        for thing in db.Thing.where():
+            count += 1
+        counted.append(count)
+    used = best(where, repeat)
+    report("where", "speed", counted[0] / used, "rows/s", 
+           rows=counted[0], storage=storage)
+    db.db.close()
+
+def bench_save(filename, storage, repeat, saves=2000):
+    """save() of new instances (INSERT) and changed ones (UPDATE).
+
+    The changes are rolled back after each run, so that all runs do
+    the same work.
+    """
+    db = open_database(filename, storage)
+    for reload in (True, False):
+        def insert():
+            for n in xrange(saves):
+                thing = db.Thing()
+                thing.box_id = n % 100 + 1
+                thing.name = "new %s" % n
+                thing.value = n
+                thing.save(reload=reload)
+            db.db.rollback()
+        report("save", "insert", saves / best(insert, repeat), "saves/s",
+               reload=reload, storage=storage)
+        things = list(db.Thing.select().limit(saves))
+        def update():
+            for thing in things:
+                thing.value += 1
+                thing.save(reload=reload)
+            db.db.rollback()
+        report("save", "update", saves / best(update, repeat), "saves/s",
+               reload=reload, storage=storage)
+    db.db.close()
+
+def bench_children(filename, storage, repeat):
+    """Following get_things() from every box, with and without
+    prefetching the children"""
+    db = open_database(filename, storage)
+    boxes = list(db.Box)
+    counted = []
+    def children():
+        count = 0
+        for box in boxes:
+            for thing in box.get_things():
+                count += 1
+        counted.append(count)
+    def prefetched():
+        db.Box.prefetch(boxes, "things")
+        children()
+    for (prefetch, function) in ((False, children), (True, prefetched)):
+        used = best(function, repeat)
+        report("children", "speed", counted[-1] / used, "rows/s", 
+               boxes=len(boxes), prefetch=prefetch, storage=storage)
+    db.db.close()
+
+benchmarks = [
+    ("roundtrips", bench_roundtrips),
+    ("stream", bench_stream),
+    ("rows", bench_rows),
+    ("startup", bench_startup),
+    ("concurrency", bench_concurrency),
+]
+
+# Run against each storage, see open_database()
+hot_paths = [
+    ("generate", bench_generate),
+    ("get", bench_get),
+    ("where", bench_where),
+    ("save", bench_save),
+    ("children", bench_children),
+]
+
+def environment(options):
+    """Describe the benchmark run for the JSON results"""
+    return dict(time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                python=sys.version.split()[0],
+                platform=platform.platform(),
+                sqlite=sqlite.sqlite_version,
+                module=sqlite.__name__,
+                repeat=options.repeat)
+
+def main():
+    parser = OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("--storage", choices=("disk", "memory", "both"),
+                      default="both", 
+                      help="database for the hot paths: disk, memory "
+                           "or both (default)")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="runs of each hot path, the best is reported")
+    parser.add_option("--json", metavar="FILE",
+                      help="write the results as JSON to FILE, or - for "
+                           "standard output")
+    global output
+    (options, names) = parser.parse_args()
+    if options.json == "-":
+        # Keep standard output for the JSON
+        output = sys.stderr
+    names = names or [name for (name, bench) in benchmarks + hot_paths]
+    storages = ["disk", "memory"]
+    if options.storage != "both":
+        storages = [options.storage]
+    filename = tempfile.mktemp()
+    try:
+        make_database(filename)
+        for name, bench in benchmarks:
+            if name in names:
+                bench(filename)
+        for name, bench in hot_paths:
+            if name in names:
+                for storage in storages:
+                    bench(filename, storage, options.repeat)
+    finally:
+        os.unlink(filename)
+    if options.json:
+        document = dict(environment=environment(options), results=results)
+        if options.json == "-":
+            json.dump(document, sys.stdout, indent=2)
+            print
+        else:
+            file = open(options.json, "w")
+            try:
+                json.dump(document, file, indent=2)
+            finally:
+                file.close()
+
+if __name__ == "__main__":
+    main()
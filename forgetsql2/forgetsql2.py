@@ -66,15 +66,124 @@ import logging
 from sets import Set
 from itertools import izip, count
 import re 
+import time
+import random
+import tempfile
+import Queue
 try:
     import threading
 except ImportError:
-    threading = None    
+    import dummy_threading as threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle    
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
 
 from doc_exception import DocstringException, ProgrammingError
 
-# Valid column names for WHERE sentences
-_col_pat = re.compile(r"\$([a-zA-Z][a-zA-Z0-9_-]*)")
+# $name parameters in SQL, see compile_sql()
+_param_pat = re.compile(r"\$([a-zA-Z_][a-zA-Z0-9_]*)")
+# Dollar quote tags in PostgreSQL, $$ or $tag$
+_dollar_pat = re.compile(r"\$([a-zA-Z_][a-zA-Z0-9_]*)?\$")
+
+# Placeholder for parameter number n (from 1) named name
+_placeholders = {
+    "qmark": lambda name, n: "?",
+    "format": lambda name, n: "%s",
+    "numeric": lambda name, n: ":%d" % n,
+    "named": lambda name, n: ":" + name,
+    "pyformat": lambda name, n: "%%(%s)s" % name,
+}
+
+def compile_sql(sql, paramstyle, dialect=None):
+    """Compile $name parameters in sql to a DB API paramstyle.
+
+    Return (sql, names, positional). names lists the parameter names
+    in the order they are given to the database module. If positional
+    is True, the parameters must be given as a sequence in that order,
+    otherwise as a dictionary.
+
+    $ within quoted strings, quoted identifiers and comments is not a
+    parameter. With dialect "mysql", backslash escapes in strings
+    are respected, and with "postgresql", $tag$ dollar quoted strings
+    are skipped. For the paramstyles format and pyformat, % is escaped
+    as %% when there are parameters, as the database module will then
+    format the statement.
+    """
+    try:
+        placeholder = _placeholders[paramstyle]
+    except KeyError:
+        raise UnsupportedDBError, "paramstyle=%s" % paramstyle
+    parts = []
+    names = []
+    unique = []
+    start = 0
+    i = 0
+    end = len(sql)
+    while i < end:
+        c = sql[i]
+        if c in "'\"`":
+            i += 1
+            while i < end:
+                if sql[i] == "\\" and dialect == "mysql":
+                    i += 2
+                elif sql[i] == c:
+                    i += 1
+                    if i == end or sql[i] != c:
+                        # Not a doubled '' quote
+                        break
+                    i += 1
+                else:
+                    i += 1
+        elif c == "-" and sql.startswith("--", i):
+            i = sql.find("\n", i)
+            if i < 0:
+                i = end
+        elif c == "/" and sql.startswith("/*", i):
+            i = sql.find("*/", i+2)
+            if i < 0:
+                i = end
+            else:
+                i += 2
+        elif c == "$":
+            match = dialect == "postgresql" and _dollar_pat.match(sql, i)
+            if match:
+                i = sql.find(match.group(), match.end())
+                if i < 0:
+                    i = end
+                else:
+                    i += len(match.group())
+                continue
+            match = _param_pat.match(sql, i)
+            if not match:
+                i += 1
+                continue
+            name = match.group(1)
+            if name not in unique:
+                unique.append(name)
+            if paramstyle in ("qmark", "format"):
+                names.append(name)
+            parts.append(sql[start:i])
+            parts.append(placeholder(name, unique.index(name)+1))
+            i = start = match.end()
+        else:
+            i += 1
+    parts.append(sql[start:])
+    positional = paramstyle in ("qmark", "format", "numeric")
+    if not positional or paramstyle == "numeric":
+        names = unique
+    if names and paramstyle in ("format", "pyformat"):
+        # Every other part is a placeholder
+        for n in range(0, len(parts), 2):
+            parts[n] = parts[n].replace("%", "%%")
+    return "".join(parts), tuple(names), positional
+
+# Field names that can be used in __slots__
+_identifier = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_]*$")
 
 def _sql_bool(value):
     """Convert SQL bool value to Python True/False"""
@@ -101,15 +210,1012 @@ class PrimaryKeyError(error, ProgrammingError):
 class UnsupportedDBError(error, ProgrammingError):    
     """Unsupported db module"""
 
+class FutureTimeoutError(error):
+    """Timed out waiting for the result of a Future"""
+
+class PoolTimeoutError(error):
+    """Timed out waiting for a free database connection"""
+
+class _PoolEntry(object):
+    """A connection managed by ConnectionPool"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = time.time()
+        self.last_used = self.created
+        # The thread that made the connection
+        self.owner = threading.currentThread()
+        # The thread currently holding the connection, if any
+        self.thread = None
+        # Seconds spent in acquire() for the current checkout
+        self.wait = 0.0
+        # For DBConnect: True if checked out by a statement rather than
+        # by checkout() or connect(), and the number of unfinished
+        # streaming queries. See DBConnect._release_auto().
+        self.auto = False
+        self.streams = 0
+
+class ConnectionPool(object):
+    """Bounded pool of database connections.
+
+    Connections are made by calling the function connect given to the
+    constructor. acquire() checks out a connection for the current
+    thread, and release() hands it back to the pool for reuse.
+
+    Parameters:
+        min_size
+            number of connections kept open even when idle
+        max_size
+            maximum number of open connections, or None for no limit
+        timeout
+            seconds acquire() waits for a free connection before raising
+            PoolTimeoutError, or None to wait forever
+        max_idle
+            seconds an idle connection is kept before being closed, or
+            None to keep it forever
+        max_lifetime
+            seconds a connection is used before being closed and
+            replaced, or None to use it forever
+        thread_bound
+            if True, a connection is only handed out to the thread that
+            made it (as required by pysqlite)
+
+    Connections held by threads that die without calling release()
+    are closed by the next acquire().
+    """
+    def __init__(self, connect, min_size=0, max_size=None, timeout=None,
+                 max_idle=None, max_lifetime=None, thread_bound=False):
+        if max_size is not None and max_size < max(min_size, 1):
+            raise ProgrammingError, "max_size=%s" % max_size
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.thread_bound = thread_bound
+        self._lock = threading.Condition()
+        # Most recently released connections last
+        self._idle = []
+        self._in_use = []
+        # Connections currently being made outside the lock
+        self._connecting = 0
+        # Statistics, see statistics()
+        self.created = 0
+        self.closed = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def _size(self):
+        return len(self._idle) + len(self._in_use) + self._connecting
+
+    def _close(self, entry):
+        """Close connection of entry. Must hold the lock."""
+        self.closed += 1
+        try:
+            entry.connection.close()
+        except Exception:
+            # Already closed, or owned by another thread. In the
+            # last case it will be closed when garbage collected.
+            pass
+
+    def _expired(self, entry, now):
+        return (self.max_lifetime is not None and 
+                now - entry.created > self.max_lifetime)
+
+    def _reap(self, now):
+        """Close expired and too long idle connections. Must hold the
+        lock."""
+        for entry in self._idle[:]:
+            if self._expired(entry, now):
+                self._idle.remove(entry)
+                self._close(entry)
+            elif (self.max_idle is not None and 
+                  now - entry.last_used > self.max_idle and
+                  self._size() > self.min_size):
+                self._idle.remove(entry)
+                self._close(entry)
+
+    def _find_idle(self, thread):
+        """Remove and return usable idle entry, or None. Must hold the
+        lock."""
+        for entry in self._idle[::-1]:
+            if self.thread_bound and entry.owner is not thread:
+                continue
+            self._idle.remove(entry)
+            return entry
+        return None
+
+    def _reclaim_dead(self):
+        """Close connections held by dead threads, and in thread_bound
+        mode idle connections owned by dead threads. Must hold the
+        lock."""
+        for entry in self._in_use[:]:
+            if not entry.thread.isAlive():
+                logging.warning("Reclaiming connection from dead thread %s",
+                                entry.thread.getName())
+                self._in_use.remove(entry)
+                self._close(entry)
+        if self.thread_bound:
+            for entry in self._idle[:]:
+                if not entry.owner.isAlive():
+                    self._idle.remove(entry)
+                    self._close(entry)
+
+    def _reclaim(self):
+        """Make room in a full pool. Must hold the lock.
+
+        In thread_bound mode, idle connections owned by other threads
+        are closed. Return True if room was made.
+        """
+        if self._idle:
+            # Only happens in thread_bound mode, as _find_idle() would
+            # otherwise have found it. Close the least recently used.
+            self._close(self._idle.pop(0))
+            return True
+        return False
+
+    def _checkout(self, entry, thread, start, waited):
+        """Register entry as used by thread. Must hold the lock."""
+        entry.thread = thread
+        entry.wait = time.time() - start
+        entry.auto = False
+        entry.streams = 0
+        self._in_use.append(entry)
+        self.checkouts += 1
+        if waited:
+            wait = time.time() - start
+            self.waits += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def acquire(self):
+        """Check out a connection for the current thread.
+
+        Return a pool entry, whose connection attribute is the
+        connection. The entry must be given back by calling release().
+        """
+        thread = threading.currentThread()
+        start = time.time()
+        waited = False
+        self._lock.acquire()
+        try:
+            while True:
+                self._reclaim_dead()
+                self._reap(time.time())
+                entry = self._find_idle(thread)
+                if entry is not None:
+                    self._checkout(entry, thread, start, waited)
+                    return entry
+                if self.max_size is None or self._size() < self.max_size:
+                    # Make a new connection, but not while holding the
+                    # lock
+                    self._connecting += 1
+                    break
+                if self._reclaim():
+                    continue
+                if self.timeout is None:
+                    self._lock.wait()
+                else:
+                    remaining = start + self.timeout - time.time()
+                    if remaining <= 0:
+                        raise PoolTimeoutError, \
+                            "%s connections in use" % len(self._in_use)
+                    self._lock.wait(remaining)
+                waited = True
+        finally:
+            self._lock.release()
+
+        try:
+            entry = _PoolEntry(self._connect())
+        except:
+            self._lock.acquire()
+            try:
+                self._connecting -= 1
+                self._lock.notify()
+            finally:
+                self._lock.release()
+            raise
+        self._lock.acquire()
+        try:
+            self._connecting -= 1
+            self.created += 1
+            self._checkout(entry, thread, start, waited)
+        finally:
+            self._lock.release()
+        return entry
+
+    def release(self, entry, discard=False):
+        """Give back entry as returned from acquire().
+
+        If discard is True, the connection is closed instead of reused,
+        for instance because it is broken.
+        """
+        self._lock.acquire()
+        try:
+            self._in_use.remove(entry)
+            entry.thread = None
+            now = time.time()
+            if discard or self._expired(entry, now):
+                self._close(entry)
+            else:
+                entry.last_used = now
+                self._idle.append(entry)
+            self._lock.notify()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close all idle connections"""
+        self._lock.acquire()
+        try:
+            while self._idle:
+                self._close(self._idle.pop())
+        finally:
+            self._lock.release()
+
+    def statistics(self):
+        """Return dictionary of pool statistics.
+
+        Keys:
+            size        open connections
+            idle        connections not checked out
+            in_use      connections checked out
+            created     connections made since start
+            closed      connections closed since start
+            checkouts   number of acquire() calls
+            waits       number of acquire() calls that had to wait
+            wait_time   total seconds waited in acquire()
+            max_wait    longest wait in acquire()
+        """
+        self._lock.acquire()
+        try:
+            self._reclaim_dead()
+            return dict(size=self._size(), idle=len(self._idle),
+                        in_use=len(self._in_use), created=self.created,
+                        closed=self.closed, checkouts=self.checkouts,
+                        waits=self.waits, wait_time=self.wait_time,
+                        max_wait=self.max_wait)
+        finally:
+            self._lock.release()
+
+class _Checkout(object):
+    """Connection checked out by DBConnect.checkout()"""
+    def __init__(self, db):
+        self._db = db
+        entry = db._get_entry()
+        self._acquired = entry is None
+        # Checked out by a statement, to be given back as before
+        self._auto = entry is not None and entry.auto
+        self.connection = db._hold().connection
+
+    def close(self):
+        """Release the connection, unless the thread held it already"""
+        if self._acquired:
+            self._acquired = False
+            self._db.release()
+        elif self._auto:
+            self._auto = False
+            entry = self._db._get_entry()
+            if entry is not None:
+                entry.auto = True
+                self._db._release_auto()
+
+    def __enter__(self):
+        return self.connection
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+class _StreamRows(object):
+    """Rows of a query by DBConnect._stream_rows().
+
+    The connection is given back when all rows are read, or when the
+    iterator is closed or garbage collected before that, for instance
+    when a loop over it raises an exception.
+    """
+    def __init__(self, db, rows, entry, replica):
+        self._db = db
+        self._rows = iter(rows)
+        self._entry = entry
+        self._replica = replica
+        self._thread = threading.currentThread()
+        entry.streams += 1
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._entry is None:
+            raise StopIteration
+        try:
+            return self._rows.next()
+        except StopIteration:
+            self.close()
+            raise
+
+    def close(self):
+        """Stop iterating, giving back the connection if possible"""
+        entry = self._entry
+        if entry is None:
+            return
+        self._entry = None
+        self._rows = None
+        if entry.thread is not self._thread or not entry.streams:
+            # Released meanwhile
+            return
+        entry.streams -= 1
+        if threading.currentThread() is self._thread:
+            self._db._release_auto(self._replica)
+
+    def __del__(self):
+        self.close()
+
+class Transaction(object):
+    """Transaction started by DBConnect.transaction().
+
+    Finish the transaction by calling commit() or rollback(), or use
+    it as a context manager. The first transaction of a thread is a
+    database transaction, nested transactions are savepoints within
+    it.
+
+    Attributes:
+        connection      the connection of the transaction
+        savepoint       name of savepoint, or None if outermost
+        commit_every    see DBConnect.transaction()
+        commits         number of commits done by commit_every
+    """
+    def __init__(self, db, commit_every=None):
+        self._db = db
+        self.commit_every = commit_every
+        self.commits = 0
+        # Statements not committed by commit_every yet
+        self._pending = 0
+        # Old isolation_level of sqlite connection, see _begin()
+        self._isolation_level = None
+        self._manual = False
+        self._done = False
+        self.connection = db._hold(auto=True).connection
+        self.savepoint = None
+        stack = db._transactions()
+        if stack:
+            self.savepoint = "forgetsql_%s" % len(stack)
+            self._sql("SAVEPOINT " + self.savepoint)
+        else:
+            self._begin()
+        stack.append(self)
+        if commit_every:
+            db._batching += 1
+
+    def _sql(self, sql):
+        # Not by DBConnect.cursor(), which could reconnect
+        self.connection.cursor().execute(sql)
+
+    def _begin(self):
+        if self._db.type == "sqlite":
+            # pysqlite commits before statements like SAVEPOINT,
+            # unless we do the transaction handling ourself
+            self._isolation_level = self.connection.isolation_level
+            if self._isolation_level is not None:
+                self.connection.isolation_level = None
+            self._manual = True
+            self._sql("BEGIN")
+
+    def _end(self, commit):
+        if self._manual:
+            self._sql(commit and "COMMIT" or "ROLLBACK")
+        elif commit:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+        self._db._settled(commit)
+
+    def _batch(self, depth):
+        """Count a statement, committing if commit_every is reached"""
+        self._pending += 1
+        if self._pending < self.commit_every or depth > 1:
+            return
+        self._end(True)
+        if self._manual:
+            self._sql("BEGIN")
+        self._pending = 0
+        self.commits += 1
+
+    def _finish(self, commit):
+        if self._done:
+            raise ProgrammingError, "Transaction already finished"
+        stack = self._db._transactions()
+        if not stack or stack[-1] is not self:
+            raise ProgrammingError, "Not the innermost transaction"
+        try:
+            if not self.savepoint:
+                self._end(commit)
+            elif commit:
+                self._sql("RELEASE SAVEPOINT " + self.savepoint)
+            else:
+                self._sql("ROLLBACK TO SAVEPOINT " + self.savepoint)
+                self._sql("RELEASE SAVEPOINT " + self.savepoint)
+        finally:
+            self._close()
+            stack.pop()
+        if not stack:
+            self._db._release_auto()
+
+    def _close(self):
+        """Mark as finished, restoring the connection"""
+        self._done = True
+        if self.commit_every:
+            self._db._batching -= 1
+        if self._isolation_level is not None:
+            self.connection.isolation_level = self._isolation_level
+
+    def commit(self):
+        """Commit the transaction, or release the savepoint"""
+        self._finish(True)
+
+    def rollback(self):
+        """Roll back the transaction, or to the savepoint"""
+        self._finish(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+class IdentityMap(object):
+    """Cache of Table instances by primary key.
+
+    Keys are (table class, primary key values) as returned by
+    Table._identity(). When more than size instances are cached, the
+    least recently used are evicted. The map can be shared by threads.
+
+    The attributes hits and misses count the outcome of get().
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        # key -> [last used, instance]
+        self._instances = {}
+        self._clock = 0
+        self._lock = threading.Lock()
+        # Last DBConnect.forget_identities() seen by a per thread map
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._instances)
+
+    def get(self, key):
+        """Get cached instance, or None"""
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._instances[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._clock += 1
+            entry[0] = self._clock
+            return entry[1]
+        finally:
+            self._lock.release()
+
+    def add(self, key, instance):
+        """Cache instance as key"""
+        self._lock.acquire()
+        try:
+            self._clock += 1
+            self._instances[key] = [self._clock, instance]
+            if len(self._instances) > self.size:
+                self._evict()
+        finally:
+            self._lock.release()
+
+    def _evict(self):
+        """Evict least recently used instances. Must hold the lock.
+
+        To avoid sorting on every add(), a tenth of the instances are
+        evicted at a time.
+        """
+        keep = self.size - self.size // 10
+        entries = [(used, key) for (key, (used, instance)) 
+                   in self._instances.items()]
+        entries.sort()
+        for (used, key) in entries[:len(entries)-keep]:
+            self._instances.pop(key, None)
+
+    def discard(self, key):
+        """Remove key from cache if present"""
+        self._lock.acquire()
+        try:
+            self._instances.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self, table=None):
+        """Remove all instances, or only those of the table class"""
+        self._lock.acquire()
+        try:
+            if table is None:
+                self._instances.clear()
+                return
+            for key in self._instances.keys():
+                if key[0] is table:
+                    self._instances.pop(key, None)
+        finally:
+            self._lock.release()
+
+class ResultCache(object):
+    """Cache of query results that expire.
+
+    When more than size results are cached, the least recently used are
+    evicted. The methods get(), set() and delete() are the same as for a
+    memcached client, so that such a client can be used instead to share
+    cached results between processes, see DBConnect.use_result_cache().
+
+    The attributes hits and misses count the outcome of get().
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        # key -> [last used, expires, value]
+        self._entries = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get cached value, or None if missing or expired"""
+        try:
+            entry = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        if entry[1] and entry[1] < time.time():
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._clock += 1
+        entry[0] = self._clock
+        return entry[2]
+
+    def set(self, key, value, ttl=0):
+        """Cache value as key for ttl seconds, or forever if 0"""
+        expires = 0
+        if ttl:
+            expires = time.time() + ttl
+        self._clock += 1
+        self._entries[key] = [self._clock, expires, value]
+        if len(self._entries) > self.size:
+            self._evict()
+
+    def delete(self, key):
+        """Remove key from cache if present"""
+        self._entries.pop(key, None)
+
+    def _evict(self):
+        """Evict least recently used results, a tenth at a time"""
+        keep = self.size - self.size // 10
+        entries = [(used, key) for (key, (used, expires, value)) 
+                   in self._entries.items()]
+        entries.sort()
+        for (used, key) in entries[:len(entries)-keep]:
+            self._entries.pop(key, None)
+
+class Future(object):
+    """Result of a function submitted to an Executor.
+
+    Use result() to wait for the return value of the function, or
+    add_done_callback() to be called when it is done.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        """Check if the function has finished"""
+        return self._done
+
+    def _wait(self, timeout):
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise FutureTimeoutError, "Waited %s s" % timeout
+        finally:
+            self._condition.release()
+
+    def result(self, timeout=None):
+        """Wait for and return the return value of the function.
+
+        If the function raised an exception, it is raised here. If
+        timeout seconds pass first, FutureTimeoutError is raised.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for and return the exception raised by the function, or
+        None."""
+        self._wait(timeout)
+        return self._exc_info and self._exc_info[1]
+
+    def add_done_callback(self, function):
+        """Call function with this future when done.
+
+        The function is called by the worker thread, or right away if
+        already done.
+        """
+        self._condition.acquire()
+        try:
+            if not self._done:
+                self._callbacks.append(function)
+                return
+        finally:
+            self._condition.release()
+        function(self)
+
+    def _set(self, result, exc_info=None):
+        self._condition.acquire()
+        try:
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._condition.notifyAll()
+            callbacks = self._callbacks
+            self._callbacks = []
+        finally:
+            self._condition.release()
+        for function in callbacks:
+            try:
+                function(self)
+            except Exception:
+                logging.exception("Callback %r failed", function)
+
+class Executor(object):
+    """Run functions on a bounded number of worker threads.
+
+    Each function is run as one transaction: it is committed when
+    the function returns, and rolled back if it raises an exception.
+    The worker gives its connection back to the pool after each
+    function, see DBConnect.release().
+
+    The worker threads are started by the first submit().
+    """
+    def __init__(self, db, workers):
+        self.db = db
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def submit(self, function, *args, **kwargs):
+        """Run function(*args, **kwargs) by a worker. Return a Future.
+        """
+        self._lock.acquire()
+        try:
+            if self._shutdown:
+                raise ProgrammingError, "Executor is shut down"
+            future = Future()
+            self._queue.put((future, function, args, kwargs))
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work,
+                    name="forgetsql-worker-%s" % len(self._threads))
+                thread.setDaemon(True)
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            self._lock.release()
+        return future
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            (future, function, args, kwargs) = task
+            try:
+                try:
+                    result = function(*args, **kwargs)
+                    connection = self.db.connection
+                    if connection is not None:
+                        connection.commit()
+                        self.db._settled(True)
+                except:
+                    future._set(None, sys.exc_info())
+                else:
+                    future._set(result)
+            finally:
+                self.db.release()
+
+    def shutdown(self, wait=True):
+        """Stop the workers after the submitted functions are done.
+
+        If wait is True, wait for the workers to finish.
+        """
+        self._lock.acquire()
+        try:
+            self._shutdown = True
+            for thread in self._threads:
+                self._queue.put(None)
+        finally:
+            self._lock.release()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+# Literals and parameters, replaced by ? in fingerprints
+_fingerprint_pats = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"%\(\w+\)s|%s|\$\w+"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(?...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+def fingerprint(sql):
+    """Normalize SQL statement for grouping similar statements.
+
+    Literals and parameters are replaced by ?, lists of them by (?...),
+    and whitespace is collapsed::
+
+        >>> fingerprint("SELECT * FROM postal WHERE postal_no IN (?, ?)")
+        'SELECT * FROM postal WHERE postal_no IN (?...)'
+    """
+    for (pattern, replacement) in _fingerprint_pats:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+class StatementEvent(object):
+    """A statement executed by Database, as given to listeners.
+
+    Attributes:
+        method          "execute" or "executemany"
+        sql             the SQL as sent to the database module
+        parameters      the parameters
+        seconds         seconds used by execute()
+        wait            seconds waited for a connection from the pool 
+        rows            rows fetched, or rows affected by a statement
+                        without a result, None until fetched
+        fetch_seconds   seconds used by fetching rows 
+        thread          the thread executing the statement
+    """
+    def __init__(self, method, sql, parameters):
+        self.method = method
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.wait = 0.0
+        self.rows = None
+        self.fetch_seconds = 0.0
+        self.thread = threading.currentThread()
+
+    def _get_fingerprint(self):
+        return _cached_fingerprint(self.sql)
+    fingerprint = property(_get_fingerprint, doc=
+        """The SQL normalized by fingerprint()""")
+
+_fingerprints = {}
+
+def _cached_fingerprint(sql):
+    try:
+        return _fingerprints[sql]
+    except KeyError:
+        if len(_fingerprints) >= 1024:
+            _fingerprints.clear()
+        result = _fingerprints[sql] = fingerprint(sql)
+        return result
+
+class Listener(object):
+    """Base class for listeners given to DBConnect.add_listener().
+
+    The methods are called by the thread running the statement, and
+    do nothing by default.
+    """
+    def executed(self, event):
+        """Called with a StatementEvent after a statement is executed"""
+
+    def fetched(self, event):
+        """Called when all rows of a query have been fetched. Not called
+        if the rows are not all iterated over."""
+
+    def released(self):
+        """Called when the current thread releases its connection, see
+        DBConnect.release(), or gives back a connection checked out by
+        a statement, see DBConnect.checkout()."""
+
+    def settled(self, commit):
+        """Called when the current thread commits, if commit is True,
+        or rolls back."""
+
+def _percentile(sorted_values, fraction):
+    index = int(round(fraction * (len(sorted_values)-1)))
+    return sorted_values[index]
+
+class Statistics(Listener):
+    """Aggregate statement timings by fingerprint.
+
+    The last samples timings of each fingerprint are kept for
+    calculating percentiles. See report().
+    """
+    def __init__(self, samples=1000):
+        self.samples = samples
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        """Forget all statistics"""
+        # fingerprint -> [count, seconds, rows, wait, [timings]]
+        self._statements = {}
+
+    def executed(self, event):
+        self._lock.acquire()
+        try:
+            stats = self._statements.get(event.fingerprint)
+            if stats is None:
+                stats = self._statements[event.fingerprint] = [0, 0.0, 0,
+                                                               0.0, []]
+            stats[0] += 1
+            stats[1] += event.seconds
+            stats[3] += event.wait
+            if event.rows is not None and event.rows > 0:
+                stats[2] += event.rows
+            timings = stats[4]
+            if len(timings) < self.samples:
+                timings.append(event.seconds)
+            else:
+                timings[stats[0] % self.samples] = event.seconds
+        finally:
+            self._lock.release()
+
+    def fetched(self, event):
+        self._lock.acquire()
+        try:
+            stats = self._statements.get(event.fingerprint)
+            if stats is not None:
+                stats[1] += event.fetch_seconds
+                stats[2] += event.rows
+        finally:
+            self._lock.release()
+
+    def report(self):
+        """Return list of dictionaries, the most time consuming
+        fingerprint first. 
+
+        Keys:
+            fingerprint     the normalized SQL, see fingerprint()
+            count           times executed
+            seconds         total seconds executing and fetching
+            rows            rows fetched or affected
+            wait            total seconds waiting for connections
+            p50, p99        median and 99th percentile of execute()
+                            seconds
+        """
+        self._lock.acquire()
+        try:
+            report = []
+            for (sql, (count, seconds, rows, wait, timings)) in \
+                    self._statements.items():
+                timings = timings[:]
+                timings.sort()
+                report.append(dict(fingerprint=sql, count=count,
+                                   seconds=seconds, rows=rows, wait=wait,
+                                   p50=_percentile(timings, 0.5),
+                                   p99=_percentile(timings, 0.99)))
+        finally:
+            self._lock.release()
+        report.sort(lambda a, b: cmp(b["seconds"], a["seconds"]))
+        return report
+
+class SlowQueryLog(Listener):
+    """Log a warning for statements slower than threshold seconds"""
+    def __init__(self, threshold=1.0, logger=logging):
+        self.threshold = threshold
+        self.logger = logger
+
+    def executed(self, event):
+        if event.seconds >= self.threshold:
+            self.logger.warning("Slow query (%.3f s): %s %r", 
+                                event.seconds, event.sql, event.parameters)
+
+class NPlusOneDetector(Listener):
+    """Warn when a statement is repeated in one request.
+
+    A request lasts until the thread commits, rolls back or releases
+    its connection, see DBConnect.release(). Without DBConnect.checkout()
+    or connect(), the connection is given back after each query, so
+    hold one for the request to count its statements. A warning is
+    logged the first time a fingerprint has been executed threshold
+    times in a request, which usually means that a loop loads related
+    rows one by one, where Table.prefetch() could be used.
+
+    At most size fingerprints are counted per thread. When there are
+    more, the counts start over.
+    """
+    def __init__(self, threshold=10, logger=logging, size=1000):
+        self.threshold = threshold
+        self.logger = logger
+        self.size = size
+        self._name = "forgetsql_nplusone_%s" % id(self)
+
+    def executed(self, event):
+        thread = threading.currentThread()
+        counts = getattr(thread, self._name, None)
+        if counts is None:
+            counts = {}
+            setattr(thread, self._name, counts)
+        elif len(counts) >= self.size and event.fingerprint not in counts:
+            counts.clear()
+        count = counts.get(event.fingerprint, 0) + 1
+        counts[event.fingerprint] = count
+        if count == self.threshold:
+            self.logger.warning("Statement executed %s times in one "
+                                "request: %s", count, event.fingerprint)
+
+    def released(self):
+        setattr(threading.currentThread(), self._name, None)
+
+    def settled(self, commit):
+        setattr(threading.currentThread(), self._name, None)
+
 class DBConnect(object):
     """Database connection.
 
     In addition to connecting to the database and providing cursors, this
     class will guess information such as the database type (mysql,
     postgresql, sqlite) and parameter style.
-    """
 
-    def __init__(self, module, connect_info):
+    Connections are kept in a ConnectionPool, available as the pool
+    attribute. When a thread needs the database, a connection is checked
+    out from the pool. It is given back when a query has been read, and
+    after writing when the thread commits or rolls back, so that a
+    transaction stays on one connection. Use checkout() or connect() to
+    hold a connection until release(), for instance for a web request.
+
+    Queries can be spread over read replicas, see add_replica().
+    """
+    # Maximum number of cached ad-hoc translations, see translate()
+    translation_cache_size = 512
+    # Seconds a connection can be unused before cursor() checks it
+    validate_after = 30.0
+    # Rows fetched per round-trip by streaming cursors
+    arraysize = 500
+    # For naming streaming cursors, see _stream_cursor()
+    _cursor_count = 0
+    # Workers of executor() if the pool has no max_size
+    workers = 4
+    # Number of open transactions with commit_every
+    _batching = 0
+    # How reads pick a replica, "round-robin" or "least-loaded"
+    routing = "round-robin"
+    # Seconds reads stay on the primary after a commit by the thread
+    sticky = 5.0
+    # For round-robin routing, see _choose_replica()
+    _replica_count = 0
+    # Prefix of keys in the result cache, see use_result_cache()
+    cache_prefix = "forgetsql"
+
+    def __init__(self, module, connect_info, min_size=1, max_size=None,
+                 timeout=None, max_idle=None, max_lifetime=None, 
+                 replicas=()):
         """Construct and initialize database connection.
 
         Parameters:
@@ -123,69 +1229,566 @@ class DBConnect(object):
                   arguments as module.connect(*connect_info)
                 * If a dictionary, it will be passed as keyword arguments as
                   module.connect(**connect_info).
+            min_size, max_size, timeout, max_idle, max_lifetime
+                parameters for the ConnectionPool, by default unbounded
+                and keeping at least one connection.
+            replicas
+                connect info for read replicas, each added by
+                add_replica() with the same pool parameters.
         """           
         # The actual DB module
         self.module = module
         # parameters for connecting
         self.connect_info = connect_info
-        # connection object - made by connect()
-        self.connection = None
         # db type, "mysql", "postgresql" or "sqlite" - determined by guess_db_info()
         self.type = None
         # parameter style, "?" or "%s" - determined by guess_db_info()
         self.param = None
+        self.paramstyle = None
+        # Translated SQL statements, see translate() and statement()
+        self._statements = {}
+        self._translations = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # IdentityMap, see use_identity_map()
+        self._identities = None
+        self._identity_size = 0
+        self._identity_per_thread = False
+        # table class or None -> generation of forget_identities()
+        self._identity_forgotten = {}
+        self._identity_generation = 0
+        self._identity_lock = threading.Lock()
+        # ResultCache or shared backend, see use_result_cache()
+        self.results = None
+        # Listener instances, see add_listener()
+        self.listeners = []
+        # Executor, see executor()
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        # ConnectionPools of read replicas, see add_replica()
+        self.replicas = []
+        self.guess_db_info()
+        self.pool = ConnectionPool(self._connect, min_size, max_size, 
+                                   timeout, max_idle, max_lifetime,
+                                   self._thread_bound(connect_info))
         # Connect to the database
         self.connect()
+        for replica_info in replicas:
+            self.add_replica(replica_info, 0, max_size, timeout, max_idle,
+                             max_lifetime)
+
+    def _thread_bound(self, connect_info):
+        """Check if connections made with connect_info can only be used
+        by the thread that made them"""
+        if self.type != "sqlite":
+            return False
+        # pysqlite checks this unless told not to 
+        return not (isinstance(connect_info, dict) and 
+                    connect_info.get("check_same_thread") is False)
+
+    def add_replica(self, connect_info, min_size=0, max_size=None,
+                    timeout=None, max_idle=None, max_lifetime=None):
+        """Add a read replica of the database.
+
+        The replica gets its own ConnectionPool, connecting with
+        connect_info as described for the constructor. Return the pool.
+
+        With replicas, the queries of where(), get(), select() and the
+        generated get_ methods of Table, and Database._query() and
+        friends given replica=True, are sent to a replica, chosen by the
+        attribute routing:
+
+          round-robin    each replica in turn
+          least-loaded   the replica with fewest connections in use
+
+        As with the primary, the replica connection is given back when
+        the rows have been read. Everything else goes to the primary,
+        and so do queries within transaction(). After writing, the
+        thread reads from the primary until the write is committed or
+        rolled back, and for sticky seconds after a commit, so that it
+        reads its own writes even if the replicas lag behind.
+        """
+        pool = ConnectionPool(lambda: self._connect(connect_info), 
+                              min_size, max_size, timeout, max_idle,
+                              max_lifetime, self._thread_bound(connect_info))
+        self.replicas = self.replicas + [pool]
+        return pool
+
+    def _choose_replica(self):
+        """Pick replica pool for a new checkout, see routing"""
+        replicas = self.replicas
+        if self.routing == "least-loaded":
+            loads = [(pool.statistics()["in_use"], n, pool) 
+                     for (n, pool) in enumerate(replicas)]
+            return min(loads)[2]
+        elif self.routing == "round-robin":
+            self._replica_count += 1
+            return replicas[self._replica_count % len(replicas)]
+        else:
+            raise ProgrammingError, "routing=%s" % self.routing
+
+    def _writes(self):
+        """Get [pending, committed, tables] for writes by the current
+        thread. pending is True if there are uncommitted writes,
+        committed is the time of the last commit after writing, and
+        tables the Set of tables with cached results changed since the
+        last commit, see invalidate()."""
+        name = "forgetsql_writes_%s" % id(self)
+        thread = threading.currentThread()
+        writes = getattr(thread, name, None)
+        if writes is None:
+            writes = [False, 0.0, Set()]
+            setattr(thread, name, writes)
+        return writes
+
+    def _wrote(self):
+        """Note a write by the current thread"""
+        self._writes()[0] = True
+
+    def _settled(self, commit):
+        """Note commit or rollback by the current thread"""
+        writes = self._writes()
+        if writes[0] and commit:
+            writes[1] = time.time()
+        writes[0] = False
+        if writes[2]:
+            tables = writes[2]
+            writes[2] = Set()
+            for table in tables:
+                self._new_version(table)
+        for listener in self.listeners:
+            listener.settled(commit)
+
+    def read_replica(self):
+        """Check if a query by the current thread can go to a replica.
+        See add_replica()."""
+        if not self.replicas or self._transactions():
+            return False
+        (pending, committed, tables) = self._writes()
+        return not pending and time.time() - committed >= self.sticky
+
+    def _get_replica(self):
+        """Get (pool, entry) of replica held by the current thread"""
+        name = "forgetsql_replica_%s" % id(self)
+        return getattr(threading.currentThread(), name, None)
+
+    def _set_replica(self, held):
+        name = "forgetsql_replica_%s" % id(self)
+        setattr(threading.currentThread(), name, held)
+
+    def _release_replica(self, discard=False):
+        held = self._get_replica()
+        if held is None:
+            return
+        (pool, entry) = held
+        self._set_replica(None)
+        if not discard:
+            try:
+                # End the read transaction
+                entry.connection.rollback()
+            except self.module.Error:
+                discard = True
+        pool.release(entry, discard)
     
-    def _set_connection(self, connection):
-        """Set the database connection.
-        The connection is as returned by self.module.connect().
+    def _get_entry(self):
+        """Get pool entry held by the current thread, or None"""
+        name = "forgetsql_conn_%s" % id(self)
+        return getattr(threading.currentThread(), name, None)
+
+    def _set_entry(self, entry):
+        name = "forgetsql_conn_%s" % id(self)
+        setattr(threading.currentThread(), name, entry)
+
+    def _hold(self, auto=False):
+        """Get pool entry held by the current thread, checking out one
+        from the pool if needed.
         
-        If the current database module is not threadsafe on connection
-        level, each thread will require a separate connection. This
-        property ensures this feature.
+        Unless auto is True, the thread keeps the connection until
+        release(). Otherwise it is given back by _release_auto().
         """
-        
-        if self.module.threadsafety < 2 and threading: 
-            # Not thread safe on connection level, store the connection
-            # in the current thread
-            name = "forgetsql_conn_%s" % id(self)
-            setattr(threading.currentThread(), name, connection)
+        entry = self._get_entry()
+        if entry is None:
+            entry = self.pool.acquire()
+            entry.auto = auto
+            self._set_entry(entry)
+        elif not auto:
+            entry.auto = False
+        return entry
+
+    def _releasable(self, replica=False):
+        """Check if the connection of the current thread, or its replica 
+        connection, would be given back by _release_auto()"""
+        if replica:
+            held = self._get_replica()
+            return held is not None and not held[1].streams
+        entry = self._get_entry()
+        return (entry is not None and entry.auto and not entry.streams and
+                not self._transactions() and not self._writes()[0])
+
+    def _release_auto(self, replica=False):
+        """Give back a connection checked out by a statement, when
+        no longer needed. 
+
+        The connection is kept while in a transaction(), after writing
+        until commit() or rollback(), and while streaming. If replica is
+        True, the replica connection is given back instead.
+        """
+        if not self._releasable(replica):
+            return
+        if replica:
+            self._release_replica()
+            return
+        for listener in self.listeners:
+            listener.released()
+        entry = self._get_entry()
+        self._set_entry(None)
+        discard = False
+        try:
+            # End the read transaction
+            entry.connection.rollback()
+        except self.module.Error:
+            discard = True
+        self.pool.release(entry, discard)
+
+    def _stream_rows(self, rows, replica=False):
+        """Iterate rows of a query, giving back the connection 
+        afterwards, see _release_auto()"""
+        if replica:
+            entry = self._get_replica()[1]
         else:
-            # store normally
-            self._connection = connection            
+            entry = self._get_entry()
+        return _StreamRows(self, rows, entry, replica)
+
     def _get_connection(self):
-        if self.module.threadsafety < 2 and threading: 
-            name = "forgetsql_conn_%s" % id(self)
-            return getattr(threading.currentThread(), name, None)
-        else:
-            return self._connection
-    connection = property(_get_connection, _set_connection)
+        entry = self._get_entry()
+        if entry is None:
+            return None
+        return entry.connection
+    connection = property(_get_connection, doc=
+        """Connection held by the current thread, or None""")
+
+    def checkout(self):
+        """Check out a connection for the current thread.
+
+        Without checkout(), a connection is checked out by each
+        statement, and given back when the rows have been read, or 
+        after writing, on commit() or rollback(). Within transaction(),
+        it is given back when the transaction ends.
+
+        Return a checkout object with the attribute connection. Calling
+        close() on the checkout object releases the connection, unless
+        the thread already held a connection before checkout(). The
+        checkout object is also a context manager::
             
+            with db.checkout() as connection:
+                Thing.get(thing_id=15)
+        """
+        return _Checkout(self)
     
-    def connect(self):
-        """Connect to the database.
-        
-        The connection object as returned by self.module.connect()
-        is stored in self.connection. In addition, guess_db_info() is
-        called after connecting.
+    def release(self, discard=False):
+        """Give the connection of the current thread back to the pool.
+
+        Any uncommitted changes are rolled back. If discard is True, the
+        connection is closed instead of being reused. A per thread
+        identity map is cleared, see use_identity_map().
         """
-        if isinstance(self.connect_info, dict):
+        if self._identity_per_thread:
+            name = "forgetsql_identities_%s" % id(self)
+            setattr(threading.currentThread(), name, None)
+        for listener in self.listeners:
+            listener.released()
+        self._release_replica(discard)
+        entry = self._get_entry()
+        if entry is None:
+            return
+        self._settled(False)
+        stack = self._transactions()
+        if stack:
+            discard = self._abort_transactions(stack) or discard
+        self._set_entry(None)
+        if not discard:
+            try:
+                entry.connection.rollback()
+            except self.module.Error:
+                discard = True
+        self.pool.release(entry, discard)
+    
+    def _transactions(self):
+        """Get list of open Transactions of the current thread"""
+        name = "forgetsql_transactions_%s" % id(self)
+        thread = threading.currentThread()
+        stack = getattr(thread, name, None)
+        if stack is None:
+            stack = []
+            setattr(thread, name, stack)
+        return stack
+
+    def _abort_transactions(self, stack):
+        """Roll back open transactions. Return True if that failed."""
+        failed = False
+        try:
+            stack[0]._end(False)
+        except self.module.Error:
+            failed = True
+        while stack:
+            stack.pop()._close()
+        return failed
+
+    def _batched(self):
+        """Count a statement for transactions with commit_every"""
+        stack = self._transactions()
+        if stack and stack[0].commit_every:
+            stack[0]._batch(len(stack))
+
+    def transaction(self, commit_every=None):
+        """Start a transaction for the current thread.
+
+        Return a Transaction, to be committed by commit() or rolled back
+        by rollback(). As a context manager, it is committed unless an
+        exception is raised::
+
+            with db.transaction():
+                thing.save()
+                with db.transaction():
+                    # a savepoint
+                    other.save()
+
+        A transaction started within another transaction is a savepoint,
+        so that only its changes are rolled back by rollback(). 
+
+        For long running jobs, give commit_every to commit after every
+        commit_every INSERT/UPDATE/DELETE statements, keeping locks
+        and transaction logs small. These commits wait until no
+        savepoint is open.
+        """
+        return Transaction(self, commit_every)
+
+    def commit(self):
+        """Commit changes of the current thread.
+
+        Use commit() of the Transaction instead within transaction().
+        """
+        if self._transactions():
+            raise ProgrammingError, "Commit the Transaction instead"
+        connection = self.connection
+        if connection is not None:
+            connection.commit()
+            self._settled(True)
+            self._release_auto()
+
+    def rollback(self):
+        """Roll back changes of the current thread.
+
+        Use rollback() of the Transaction instead within transaction().
+        """
+        if self._transactions():
+            raise ProgrammingError, "Roll back the Transaction instead"
+        connection = self.connection
+        if connection is not None:
+            connection.rollback()
+            self._settled(False)
+            self._release_auto()
+
+    def use_identity_map(self, size=1000, per_thread=False):
+        """Cache Table instances in an IdentityMap.
+
+        With an identity map, loading a row that is already cached, for
+        instance by Thing(thing_id=15) or get_thing(), returns the
+        cached instance without querying the database. An instance is
+        cached when loaded or saved, holding at most size instances. A
+        size of 0 disables the identity map.
+
+        If per_thread is True, each thread has its own identity map,
+        which is cleared when the thread calls release(). Otherwise all
+        threads share one identity map. Either way, forget_identities()
+        clears the instances of all threads.
+        """
+        self._identity_size = size
+        self._identity_per_thread = per_thread
+        self._identities = None
+        if size and not per_thread:
+            self._identities = IdentityMap(size)
+
+    def identity_map(self):
+        """Get IdentityMap for the current thread, or None if disabled"""
+        if not self._identity_per_thread:
+            return self._identities
+        name = "forgetsql_identities_%s" % id(self)
+        thread = threading.currentThread()
+        identities = getattr(thread, name, None)
+        if identities is None:
+            if not self._identity_size:
+                return None
+            identities = IdentityMap(self._identity_size)
+            identities.generation = self._identity_generation
+            setattr(thread, name, identities)
+        elif identities.generation != self._identity_generation:
+            self._identity_lock.acquire()
+            try:
+                forgotten = self._identity_forgotten.items()
+                generation = self._identity_generation
+            finally:
+                self._identity_lock.release()
+            for (table, cleared) in forgotten:
+                if cleared > identities.generation:
+                    identities.clear(table)
+            identities.generation = generation
+        return identities
+
+    def forget_identities(self, table=None):
+        """Remove instances of the Table class table, or of all tables,
+        from the identity map.
+
+        With per thread identity maps, the maps of other threads are
+        cleared the next time they are used. Called by Table methods
+        like update_where() that change rows without loading them.
+        """
+        if not self._identity_per_thread:
+            if self._identities is not None:
+                self._identities.clear(table)
+            return
+        self._identity_lock.acquire()
+        try:
+            self._identity_generation += 1
+            if table is None:
+                self._identity_forgotten.clear()
+            self._identity_forgotten[table] = self._identity_generation
+        finally:
+            self._identity_lock.release()
+
+    def use_result_cache(self, cache=None, size=1000):
+        """Cache query results of tables with Table.cache_results().
+
+        By default results are cached in this process by a ResultCache
+        holding at most size results. A size of 0 disables the cache.
+        Give a memcached client as cache to share results between
+        processes, in which case the attribute cache_prefix should be
+        unique for the database.
+
+        Each table has a version in the cache, which is part of the keys
+        of its results. Writes by Table methods like save() and
+        update_where() change the version, so that cached results are
+        not used. The version is changed again on commit, and until then
+        the writing thread does not use the cache for the table.
+        """
+        if cache is None and size:
+            cache = ResultCache(size)
+        self.results = cache
+
+    def _version_key(self, table):
+        return "%s:version:%s" % (self.cache_prefix, table)
+
+    def _new_version(self, table):
+        """Set a new version for cached results of table"""
+        if self.results is None:
+            return None
+        version = "%r.%s" % (time.time(), random.randint(0, 1<<30))
+        self.results.set(self._version_key(table), version)
+        return version
+
+    def invalidate(self, table):
+        """Forget cached results of table by the table name.
+
+        Called by Table methods writing to the table. Call it after
+        changing the table by other SQL, or those changes are only seen
+        when the cached results expire.
+        """
+        if self.results is None:
+            return
+        self._new_version(table)
+        self._writes()[2].add(table)
+
+    def result_key(self, table, sql, parameters):
+        """Get cache key for the results of a query on table.
+        Return None if the current thread should not use the cache."""
+        if table in self._writes()[2]:
+            return None
+        version = self.results.get(self._version_key(table))
+        if version is None:
+            version = self._new_version(table)
+        parameters = parameters.items()
+        parameters.sort()
+        digest = md5(repr((version, sql, parameters))).hexdigest()
+        return "%s:%s:%s" % (self.cache_prefix, table, digest)
+
+    def add_listener(self, listener):
+        """Add a Listener to be told about each statement executed.
+
+        For instance, to log statements slower than half a second::
+
+            db.add_listener(SlowQueryLog(0.5))
+        """
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        """Remove listener added by add_listener()"""
+        listeners = self.listeners[:]
+        listeners.remove(listener)
+        self.listeners = listeners
+
+    def executor(self):
+        """Get the Executor for running functions in the background.
+
+        The executor has a worker for each connection the pool can
+        make, or the attribute workers if the pool is unbounded. Note
+        that other threads might then have to wait for connections.
+        """
+        self._executor_lock.acquire()
+        try:
+            if self._executor is None:
+                workers = self.pool.max_size or self.workers
+                self._executor = Executor(self, workers)
+            return self._executor
+        finally:
+            self._executor_lock.release()
+
+    def submit(self, function, *args, **kwargs):
+        """Call function(*args, **kwargs) by a worker thread.
+
+        Return a Future for the result. The function is run and
+        committed as one transaction, see Executor. This can be used
+        for running queries concurrently from one thread::
+
+            count = db.submit(Postal.select(is_pobox=True).count)
+            postals = db.submit(list, Postal.select().limit(20))
+            print count.result(), postals.result()
+        """
+        return self.executor().submit(function, *args, **kwargs)
+
+    def _connect(self, connect_info=None):
+        """Make a new connection as described by connect_info, by
+        default self.connect_info"""
+        if connect_info is None:
+            connect_info = self.connect_info
+        if isinstance(connect_info, dict):
             # dict etc, kwargs style, connect(a=x1, b=x2)
-            connection = self.module.connect(**self.connect_info)
-        elif isinstance(self.connect_info, (tuple, list)):
+            connection = self.module.connect(**connect_info)
+        elif isinstance(connect_info, (tuple, list)):
             # tuple etc, args style  connect(a, b)
-            connection = self.module.connect(*self.connect_info)
+            connection = self.module.connect(*connect_info)
         else:
             # probably strings (URIs etc.)   connect(a)
-            connection = self.module.connect(self.connect_info)    
-        self.connection = connection    
+            connection = self.module.connect(connect_info)    
+        return connection
+
+    def connect(self):
+        """Connect the current thread to the database.
+        
+        Any connection held by the current thread is discarded, and a
+        connection is checked out from the pool, available as
+        self.connection. In addition, guess_db_info() is called after
+        connecting.
+        """
+        # Keep the old entry alive until reconnected, so that the new
+        # connection can't be mistaken for the old one
+        old = self._get_entry()
+        self.release(discard=True)
+        # A reconnect keeps the way the connection was checked out
+        self._hold(auto=old is not None and old.auto)
+        del old
         # DB info should not change between connects, but you never know
         self.guess_db_info()
-        if self.type == "postgresql":
-            # FIXME: AVOID AUTOCOMMIT!! 
-            #connection.autocommit(1)
-            pass
+        # No autocommit, see commit() and transaction()
         self.prepare_db_types() 
      
     def prepare_db_types(self):
@@ -217,9 +1820,13 @@ class DBConnect(object):
         
         self.type is determined to "mysql", "postgresql" or "sqlite"
         
-        self.param is "?" or "%s" and denotes how query parameters to be
-        expanded by cursor.execute(sql, params) is to be expressed in
-        the sql.
+        self.paramstyle is the DB API paramstyle of the module, which
+        $field parameters are compiled to.
+
+        self.param is "?" or "%s" and denotes how positional query 
+        parameters to be expanded by cursor.execute(sql, params) is to be
+        expressed in the sql, or None if the paramstyle has no such
+        placeholder.
         """
         try:     
             db_name = self.module.__name__.lower()    
@@ -233,44 +1840,222 @@ class DBConnect(object):
             self.type = "postgresql"    
         else:
             raise UnsupportedDBError, self.module
-        if self.module.paramstyle == "qmark":
+        self.paramstyle = self.module.paramstyle
+        if self.paramstyle == "qmark":
             self.param = "?"
-            # FIXME: Should support named parameters $fish
-        elif self.module.paramstyle == "format":
-            self.param = "%s"
-        elif self.module.paramstyle == "pyformat":
-            # FIXME: Should support named parameters %(fish)s 
+        elif self.paramstyle in ("format", "pyformat"):
             self.param = "%s"
-        else:    
-            raise UnsupportedDBError, "paramstyle=%s" % self.module.paramstyle
+        elif self.paramstyle in ("named", "numeric"):
+            self.param = None
+        else:
+            raise UnsupportedDBError, "paramstyle=%s" % self.paramstyle
 
-    def cursor(self):
-        """Fetch a cursor. Reconnect if needed."""
-        if not self.connection:
-            self.connect()
+    def _translate(self, sql):
+        """Compile $field parameters in sql to the parameter style of
+        the database module, see compile_sql(). Not cached, see
+        translate()."""
+        return compile_sql(sql, self.paramstyle, self.type)
+
+    def translate(self, sql):
+        """Translate $field parameters in sql, using cached translations.
+
+        The translation is a tuple (sql, names, positional) as returned
+        by compile_sql().
+
+        Ad-hoc SQL might not repeat itself, so the cache is cleared
+        when it grows beyond translation_cache_size statements.
+        """
         try:
-            c = self.connection.cursor()    
-            # Connection errors won't show until we query something
-            c.execute("SELECT 1+1")
-            assert c.fetchone() == (2,)
-            return c
+            translated = self._translations[sql]
+        except KeyError:
+            self.cache_misses += 1
+            if len(self._translations) >= self.translation_cache_size:
+                self._translations.clear()
+            translated = self._translate(sql)
+            self._translations[sql] = translated
+            return translated
+        self.cache_hits += 1
+        return translated
+
+    def statement(self, shape, build):
+        """Return translated statement of a given shape.
+
+        The shape is a hashable key, normally (table, operation,
+        fields), that fully determines the SQL returned by calling
+        build(). The statement is built and translated only the first
+        time a shape is seen. As the cache belongs to this connection,
+        the parameter style is implied by the shape.
+        """
+        try:
+            translated = self._statements[shape]
+        except KeyError:
+            self.cache_misses += 1
+            translated = self._translate(build())
+            self._statements[shape] = translated
+            return translated
+        self.cache_hits += 1
+        return translated
+
+    def _ping(self, connection):
+        """Check connection by a round-trip to the database.
+        Raises self.module.Error if the connection is broken."""
+        c = connection.cursor()
+        c.execute("SELECT 1+1")
+        assert c.fetchone() == (2,)
+
+    def _stream_cursor(self, connection):
+        """Make a cursor that leaves the result set on the server.
+
+        psycopg2 does this with named cursors and MySQLdb with SSCursor.
+        Cursors of other modules, like pysqlite, already fetch rows
+        when asked for.
+        """
+        if self.type == "postgresql":
+            self._cursor_count += 1
+            try:
+                return connection.cursor("forgetsql_%s" % self._cursor_count)
+            except TypeError:
+                # Old psycopg without named cursors
+                pass
+        elif self.type == "mysql":
+            cursors = getattr(self.module, "cursors", None)
+            if hasattr(cursors, "SSCursor"):
+                return connection.cursor(cursors.SSCursor)
+        return connection.cursor()
+
+    def cursor(self, stream=False, replica=False):
+        """Fetch a cursor. Reconnect if needed.
+
+        If stream is True, the cursor will if possible leave the result
+        set on the database server, to be fetched arraysize rows at a
+        time. With MySQL no other queries can be done on the connection
+        until all rows of a streaming cursor have been fetched.
+
+        If replica is True, the cursor is made from the connection to a
+        read replica held by the current thread, see add_replica().
+
+        Connection errors won't show until we query something, so a
+        connection that has not been used for validate_after seconds is
+        checked by a round-trip to the database first. Errors from
+        connections that broke more recently are caught by
+        Database._execute() instead, see reconnect_on(). If the thread
+        had uncommitted changes, the error is raised after reconnecting,
+        as the changes were lost.
+        """
+        if replica:
+            return self._replica_cursor(stream)
+        entry = self._hold(auto=True)
+        now = time.time()
+        try:
+            if now - entry.last_used > self.validate_after:
+                self._ping(entry.connection)
+            if stream:
+                c = self._stream_cursor(entry.connection)
+            else:
+                c = entry.connection.cursor()    
         except self.module.Error, e:
+            exc_info = sys.exc_info()
+            lost = self._pending()
             # Usually because of timeouts
             logging.warning("Reconnecting database due to %s",
                             e.__class__)
-            # Reconnect and try again
             self.connect()
-            c = self.connection.cursor()    
-            c.execute("SELECT 1+1")
-            assert c.fetchone() == (2,)
-            return c
+            if lost:
+                # Uncommitted changes were lost with the connection
+                raise exc_info[0], exc_info[1], exc_info[2]
+            # Try again
+            entry = self._get_entry()
+            if stream:
+                c = self._stream_cursor(entry.connection)
+            else:
+                c = entry.connection.cursor()    
+        if stream:
+            c.arraysize = self.arraysize
+        entry.last_used = now
+        return c
+
+    def _replica_cursor(self, stream=False, retry=True):
+        """As cursor(), but from a replica connection. A broken
+        connection is replaced once, possibly by another replica."""
+        held = self._get_replica()
+        if held is None:
+            pool = self._choose_replica()
+            held = (pool, pool.acquire())
+            self._set_replica(held)
+        entry = held[1]
+        now = time.time()
+        try:
+            if now - entry.last_used > self.validate_after:
+                self._ping(entry.connection)
+            if stream:
+                c = self._stream_cursor(entry.connection)
+            else:
+                c = entry.connection.cursor()    
+        except self.module.Error, e:
+            if not retry:
+                raise
+            logging.warning("Reconnecting replica due to %s",
+                            e.__class__)
+            self._release_replica(discard=True)
+            return self._replica_cursor(stream, retry=False)
+        if stream:
+            c.arraysize = self.arraysize
+        entry.last_used = now
+        return c
+
+    def reconnect_on(self, error, replica=False):
+        """Reconnect if error was caused by a broken connection.
+
+        Called by Database._execute() when a query fails. Return True if
+        the connection of the current thread was found broken and has
+        been replaced, in which case the query can be retried.
+        If replica is True, the replica connection is checked instead.
+
+        If the thread had uncommitted changes, they were lost with the
+        broken connection. The connection is still replaced, but False
+        is returned, so that the error is raised instead of the query
+        being retried without the changes.
+        """
+        if not isinstance(error, (self.module.OperationalError,
+                                  self.module.InterfaceError)):
+            return False
+        if replica:
+            try:
+                self._ping(self._get_replica()[1].connection)
+            except self.module.Error:
+                logging.warning("Reconnecting replica due to %s",
+                                error.__class__)
+                self._release_replica(discard=True)
+                return True
+            return False
+        try:
+            self._ping(self.connection)
+        except self.module.Error:
+            lost = self._pending()
+            logging.warning("Reconnecting database due to %s",
+                            error.__class__)
+            self.connect()
+            return not lost
+        # The connection is fine, so it was a real error
+        return False
+
+    def _pending(self):
+        """Check if the current thread has uncommitted writes or open
+        transactions"""
+        return bool(self._writes()[0] or self._transactions())
     
     def close(self):
-        """Close the connection. 
-        Any pending transactions will be rolled back.""" 
-        if self.connection:
-            self.connection.close()           
-            self.connection = None    
+        """Close the connection of the current thread, and all idle
+        connections in the pool.
+        Any pending transactions will be rolled back. The executor is
+        shut down, after finishing the submitted functions.""" 
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.release(discard=True)
+        self.pool.close()
+        for pool in self.replicas:
+            pool.close()
 
 class Database(object):
     """Base class for objects that uses the database. 
@@ -288,70 +2073,205 @@ class Database(object):
     # a DBConnect instance, which holds the actual connection, and more
     # important to us, the cursor() method.
     _db = None
+
+    # No __dict__, so that Table subclasses can use __slots__
+    __slots__ = ()
     
-    def _execute(cls, sql, parameters={}):
-        """Execute SQL and return cursor"""
-        cursor = cls._db.cursor()
-        if cls._db.type == "mysql" or cls._db.type == "postgresql":
-            # FIXME: Avoid regex-hack-fixing this param crap
-            sql = _col_pat.sub(r"%(\1)s", sql)
-        elif cls._db.type == "sqlite":
-            pass
-        else:
-            raise UnsupportedDBError, cls._db.type
-        logging.debug("%s %r", sql, parameters)
-        cursor.execute(sql, parameters)
-        return cursor
+    def _execute(cls, sql, parameters={}, translated=False, stream=False,
+                 write=None):
+        """Execute SQL and return cursor.
+
+        Unless translated is True, $field parameters in sql are 
+        translated to the parameter style of the database module.
+        If stream is True, a streaming cursor is used, see
+        DBConnect.cursor().
+
+        Statements returning no rows are counted as writes for
+        DBConnect.transaction() with commit_every. Give write=True for
+        writes returning rows, as INSERT ... RETURNING, or write=False
+        for statements that are not writes.
+
+        The cursor is made from the connection held by the current
+        thread, see DBConnect.checkout(). If the connection turns out to
+        be broken, the statement is retried once on a new connection.
+        """
+        return cls._run("execute", sql, parameters, translated, stream,
+                        write)
     _execute = classmethod(_execute)      
+
+    def _execute_many(cls, sql, parameter_list, translated=False):
+        """Execute SQL once for each of the dictionaries in
+        parameter_list, as with PEP 249 .executemany(), and return
+        cursor."""
+        return cls._run("executemany", sql, parameter_list, translated)
+    _execute_many = classmethod(_execute_many)
+
+    def _run(cls, method, sql, parameters, translated, stream=False,
+             write=None):
+        """Call method "execute" or "executemany" on a new cursor. 
+        See _execute()."""
+        return cls._run_event(method, sql, parameters, translated,
+                              stream, write=write)[0]
+    _run = classmethod(_run)
+
+    def _run_event(cls, method, sql, parameters, translated, stream=False,
+                   read=False, replica=False, write=None):
+        """As _run(), but return (cursor, event), where event is the
+        StatementEvent given to listeners, or None if there are no
+        listeners. See DBConnect.add_listener(). 
+        
+        If read is True, the statement is a query that doesn't change
+        anything. If replica is True, it is sent to a read replica, 
+        see DBConnect.add_replica(). For write, see _execute()."""
+        listeners = cls._db.listeners
+        if listeners:
+            held = cls._db._get_entry()
+        cursor = cls._db.cursor(stream, replica)
+        if listeners:
+            # Not counting the wait for a connection, see event.wait
+            start = time.time()
+        if not translated:
+            sql = cls._db.translate(sql)
+        (sql, names, positional) = sql
+        logging.debug("%s %r", sql, parameters)
+        args = (sql,)
+        if names and positional:
+            try:
+                if method == "execute":
+                    args += ([parameters[name] for name in names],)
+                else:
+                    args += ([[p[name] for name in names] 
+                              for p in parameters],)
+            except KeyError, e:
+                raise ProgrammingError, "Missing parameter $%s" % e.args[0]
+        elif parameters or method == "executemany":
+            # Without $field parameters, any parameters are given
+            # to the module as they are
+            args += (parameters,)
+        try:
+            getattr(cursor, method)(*args)
+        except cls._db.module.Error, e:
+            exc_info = sys.exc_info()
+            if not cls._db.reconnect_on(e, replica):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            # Retry once on the new connection
+            cursor = cls._db.cursor(stream, replica)
+            getattr(cursor, method)(*args)
+        if not read:
+            # Might have changed something, even with a description.
+            # Keeps the connection until commit() or rollback().
+            cls._db._wrote()
+        if write is None:
+            write = not read and not cursor.description
+        if write and cls._db._batching:
+            cls._db._batched()
+        if not listeners:
+            return cursor, None
+        event = StatementEvent(method, sql, parameters)
+        event.seconds = time.time() - start
+        entry = cls._db._get_entry()
+        if held is None and entry is not None:
+            event.wait = entry.wait
+        if not cursor.description:
+            event.rows = cursor.rowcount
+        for listener in listeners:
+            listener.executed(event)
+        return cursor, event
+    _run_event = classmethod(_run_event)
+
+    def _iter_events(cls, rows, event):
+        """Yield rows, telling listeners when all are fetched"""
+        start = time.time()
+        count = 0
+        for row in rows:
+            count += 1
+            yield row
+        event.rows = count
+        event.fetch_seconds = time.time() - start
+        for listener in cls._db.listeners:
+            listener.fetched(event)
+    _iter_events = classmethod(_iter_events)
     
-    def _iter_cursor(cls, cursor):
+    def _iter_cursor(cls, cursor, stream=False):
         """Provide iterator of cursor results.
 
-        If the cursor does provide an iterator, provide that.
-        Otherwise, return a generator that yield rows by using repeted
-        calls to fetchmany().
+        If the cursor does provide an iterator, provide that, unless
+        stream is True. Otherwise, return a generator that yield rows by
+        using repeted calls to fetchmany(), fetching cursor.arraysize
+        rows at a time.
         """
-        try:
-            return iter(cursor)
-        except TypeError:
-            def iterator():
+        if not stream:
+            try:
+                return iter(cursor)
+            except TypeError:
+                pass
+        def iterator():
+            rows = cursor.fetchmany()
+            while rows:
+                for row in rows:
+                    yield row
                 rows = cursor.fetchmany()
-                while rows:
-                    for row in rows:
-                        yield row
-                    rows = cursor.fetchmany()
-            return iterator() 
-                
+        return iterator() 
+
     _iter_cursor = classmethod(_iter_cursor)
     
-    def _query(cls, sql, parameters={}):
+    def _query(cls, sql, parameters={}, translated=False, stream=False,
+               replica=False):
         """Execute SQL and yield dictionaries.
 
         The optional parameters argument can be used for variable
         expansions as explained in PEP 249 .execute().
+
+        If stream is True, rows are fetched from the database in
+        batches of DBConnect.arraysize while iterating, instead of the
+        database module reading the whole result into memory first.
+
+        If replica is True, the query may be sent to a read replica, see
+        DBConnect.add_replica(). Only do so for plain reads, not for
+        instance SELECT ... FOR UPDATE.
         """
-        cursor = cls._execute(sql, parameters)
+        fields, rows = cls._query_rows(sql, parameters, translated, stream,
+                                       replica)
+        for row in rows:
+            yield dict(izip(fields, row))
+    _query = classmethod(_query)         
+
+    def _query_rows(cls, sql, parameters={}, translated=False, stream=False,
+                    replica=False):
+        """Execute SQL as with _query(), but return field names and an
+        iterator of row tuples, without building a dictionary per row.
+        """
+        replica = replica and cls._db.read_replica()
+        cursor, event = cls._run_event("execute", sql, parameters, 
+                                       translated, stream, read=True,
+                                       replica=replica)
         if not cursor.description:
             # Should only happen when there is no data to yield
             for row in cls._iter_cursor(cursor):
                 # so if there *is* something anyway, raise an exception
                 raise ProgrammingError, \
                     "Could not find description for sql", sql
-            return
+            cls._db._release_auto(replica)
+            return [], iter(())
         fields = [d[0] for d in cursor.description]
-        for row in cls._iter_cursor(cursor):
-            yield dict(izip(fields, row))
-    _query = classmethod(_query)         
+        rows = cls._iter_cursor(cursor, stream)
+        if stream or cls._db._releasable(replica):
+            # Give back the connection when the rows are read
+            rows = cls._db._stream_rows(rows, replica)
+        if event is not None:
+            rows = cls._iter_events(rows, event)
+        return fields, rows
+    _query_rows = classmethod(_query_rows)
          
 
-    def _query_one(cls, sql, parameters={}):
+    def _query_one(cls, sql, parameters={}, translated=False, replica=False):
         """Execute SQL as with _query(), but return first row.
 
         Return None if no rows were returned.  If more than one row is
         returned, a warning is logged, and only the first row is
         returned.
         """
-        res = cls._query(sql, parameters)
+        res = cls._query(sql, parameters, translated, replica=replica)
         try:
             result = res.next()
         except StopIteration:
@@ -375,11 +2295,31 @@ class metaclass_table(type):
         # Assume generated class County
         for county in County:
             print county.county_name
+
+    If the identity map is enabled, instanciating the class returns
+    cached instances, see DBConnect.use_identity_map().
     """
     def __iter__(cls):
         for elem in cls.where():
             yield elem
 
+    def __call__(cls, _db_row=None, **primary):
+        identities = cls._db and cls._db.identity_map()
+        if identities is None:
+            return type.__call__(cls, _db_row, **primary)
+        if _db_row:
+            key = cls._identity(_db_row)
+        elif primary and Set(primary) == Set(cls._primary):
+            key = cls._identity(primary)
+        else:
+            # New, or wrong primary keys
+            return type.__call__(cls, _db_row, **primary)
+        instance = identities.get(key)
+        if instance is None:
+            instance = type.__call__(cls, _db_row, **primary)
+            identities.add(key, instance)
+        return instance
+
 class Table(Database):
     """Representation of a table.
     
@@ -414,9 +2354,29 @@ class Table(Database):
         # all things which have thing.box_id = box.box_id
         for thing in box.get_things():
             pass
+
+    - By a Query, for sorting, paging and selecting fields::
+
+        # The ten things with highest thing.value in box 3
+        for thing in Thing.select(box_id=3).order_by("-value").limit(10):
+            pass
     """
     # To get __iter__ behavour 
     __metaclass__ = metaclass_table
+
+    # Generated subclasses add a slot for each field, see
+    # TableBuilder.build_class()
+    __slots__ = ("_primary_values", "_prefetched", "_dirty")
+
+    # field name -> type, set by TableBuilder
+    _fields = {}
+
+    # Foreign key field -> referenced field of the foreign table, if
+    # not the same name, see TableBuilder.add_foreign()
+    _references = {}
+
+    # Seconds results are cached, see cache_results()
+    _cache_ttl = None
     
     def __init__(self, _db_row=None, **primary):
         """Instanciate a new or existing database row.
@@ -441,7 +2401,51 @@ class Table(Database):
             return
         self._load(_db_row=_db_row, **primary)
 
-    def where(cls, where=None, **parameters):
+    def __setattr__(self, name, value):
+        """Set attribute, marking fields as changed, see changed()"""
+        object.__setattr__(self, name, value)
+        if name in self._fields:
+            try:
+                self._dirty.add(name)
+            except AttributeError:
+                object.__setattr__(self, "_dirty", Set([name]))
+
+    def __getstate__(self):
+        """Return attributes in __slots__ and __dict__, for pickle"""
+        state = dict(getattr(self, "__dict__", {}))
+        for cls in self.__class__.__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if name in ("__dict__", "__weakref__"):
+                    continue
+                try:
+                    state[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+        return state
+
+    def __setstate__(self, state):
+        for (name, value) in state.items():
+            object.__setattr__(self, name, value)
+
+    def changed(self):
+        """Return the fields changed since the row was loaded or saved.
+
+        A field is changed when it is assigned to, even if the value is
+        the same. Changes inside mutable values are not noticed, assign
+        the field again to have them saved.
+        """
+        dirty = getattr(self, "_dirty", ())
+        return [field for field in self._fields 
+                if field in dirty and hasattr(self, field)]
+
+    def _clean(self):
+        """Mark all fields as unchanged"""
+        try:
+            del self._dirty
+        except AttributeError:
+            pass
+
+    def where(cls, where=None, prefetch=(), stream=False, **parameters):
         """Yield all instances limited by ``where`` clause.
 
         Use $field in where clause and supply values in the optional
@@ -462,17 +2466,316 @@ class Table(Database):
             for county in County.where(county_name="Oslo"):
                 print county                            
 
+        The optional parameter prefetch is a sequence of relation names
+        to load for all the instances up front, see prefetch().
+
+        For huge tables, set stream to True to keep memory usage
+        constant while iterating, see Database._query()::
+
+            for song in Song.where(stream=True):
+                print song.path
         """
-        sql = "SELECT * FROM %s" % cls._table_name
-        if where:
-            sql += " WHERE %s" % where
-        if where is None and parameters:
-            sql += " WHERE "    
-            sql += " AND ".join(["%s=$%s" % (key, key) for key in parameters])
-        for row in cls._query(sql, parameters):
-            yield cls(_db_row=row)
+        instances = cls._where(where, parameters, stream)
+        if not prefetch:
+            return instances
+        instances = list(instances)
+        cls.prefetch(instances, *prefetch)
+        return iter(instances)
     where = classmethod(where)         
+
+    def _where(cls, where, parameters, stream=False):
+        """Yield instances for where(), without prefetching"""
+        if where:
+            sql = "SELECT * FROM %s WHERE %s" % (cls._table_name, where)
+            rows = cls._cached_rows(sql, parameters, stream=stream)
+        else:
+            fields = ()
+            if where is None and parameters:
+                fields = tuple(sorted(parameters))
+            sql = cls._sql("where", fields)
+            rows = cls._cached_rows(sql, parameters, translated=True, 
+                                    stream=stream)
+        for instance in cls._instances(*rows):
+            yield instance
+    _where = classmethod(_where)
+
+    def cache_results(cls, ttl=60):
+        """Cache query results of where(), get() and select() for ttl
+        seconds, or forever if 0. A ttl of None stops caching.
+
+        The connection must have a result cache, see
+        DBConnect.use_result_cache(). Cached results are forgotten when
+        the table is changed by save(), save_many(), update_where() or
+        delete_where(). Changes done otherwise are seen when the results
+        expire, unless DBConnect.invalidate() is called.
+
+        This is meant for small tables that rarely change::
+
+            db.db.use_result_cache()
+            db.County.cache_results(3600)
+        """
+        cls._cache_ttl = ttl
+    cache_results = classmethod(cache_results)
+
+    def _cached_rows(cls, sql, parameters, translated=False, stream=False):
+        """As _query_rows(), but using the result cache if enabled for
+        the table, see cache_results(). Streamed queries are not cached.
+        The query may be sent to a read replica.
+        """
+        results = cls._db.results
+        if cls._cache_ttl is None or results is None or stream:
+            return cls._query_rows(sql, parameters, translated, stream,
+                                   replica=True)
+        key = cls._db.result_key(cls._table_name, sql, parameters)
+        if key is None:
+            return cls._query_rows(sql, parameters, translated, 
+                                   replica=True)
+        cached = results.get(key)
+        if cached is None:
+            (fields, rows) = cls._query_rows(sql, parameters, translated,
+                                             replica=True)
+            cached = (fields, list(rows))
+            results.set(key, cached, cls._cache_ttl)
+        return cached[0], iter(cached[1])
+    _cached_rows = classmethod(_cached_rows)
+
+    def _instances(cls, fields, rows):
+        """Yield instances from row tuples with the columns fields.
+
+        This is the same as cls(_db_row=row) with row as a dictionary,
+        but without building a dictionary for each row. Subclasses that
+        override __init__() or _load() get the dictionaries.
+
+        The fields can be a subset of _fields, as long as the primary
+        keys are included. Such partial instances are not added to the
+        identity map, but complete instances already there are used.
+        """
+        columns = Set(fields)
+        if (not columns <= Set(cls._fields) or
+            not Set(cls._primary) <= columns or
+            cls.__init__.im_func is not Table.__init__.im_func or
+            cls._load.im_func is not Table._load.im_func):
+            for row in rows:
+                yield cls(_db_row=dict(izip(fields, row)))
+            return
+        identities = cls._db.identity_map()
+        complete = len(columns) == len(cls._fields)
+        primary = [fields.index(field) for field in cls._primary]
+        primary_names = ["p__"+field for field in cls._primary]
+        new = cls.__new__
+        # Loading should not mark fields as changed
+        setter = object.__setattr__
+        for row in rows:
+            values = tuple([row[n] for n in primary])
+            if identities is not None:
+                key = (cls, values)
+                instance = identities.get(key)
+                if instance is not None:
+                    yield instance
+                    continue
+            instance = new(cls)
+            for field, value in izip(fields, row):
+                setter(instance, field, value)
+            setter(instance, "_primary_values", 
+                   dict(izip(primary_names, values)))
+            if identities is not None and complete:
+                identities.add(key, instance)
+            yield instance
+    _instances = classmethod(_instances)
+
+    def prefetch(cls, instances, *relations):
+        """Load related rows for many instances in one go.
+
+        The relations are named as the generated methods without
+        "get_", for instance "county" for get_county() and "postals" for
+        get_postals(). The related rows of all the instances are fetched
+        by one query per relation, and the generated methods will
+        return these instead of querying the database::
+
+            postals = list(Postal.where(is_pobox=True))
+            Postal.prefetch(postals, "municipal")
+            for postal in postals:
+                # No database query
+                print postal.get_municipal()
+
+        A prefetched foreign instance is only used as long as the
+        foreign key field is unchanged. Missing foreign rows are not
+        prefetched, so that get_county() still raises NotFoundError.
+        Prefetched children are not updated when children are saved
+        later.
+        """
+        for name in relations:
+            try:
+                relation = cls._relations[name]
+            except KeyError:
+                raise ProgrammingError, "Unknown relation %s for %s" % (
+                      name, cls.__name__)
+            if relation[0] == "foreign":
+                cls._prefetch_foreign(instances, *relation[1:])
+            else:
+                cls._prefetch_children(instances, *relation[1:])
+    prefetch = classmethod(prefetch)
+
+    def _prefetch_foreign(cls, instances, field, Foreign):
+        column = cls._references.get(field, field)
+        values = Set([getattr(instance, field) for instance in instances])
+        values.discard(None)
+        foreigns = {}
+        for foreign in Foreign._where_in(column, list(values)):
+            foreigns[getattr(foreign, column)] = foreign
+        for instance in instances:
+            value = getattr(instance, field)
+            if value in foreigns:
+                instance._set_prefetched(field, (value, foreigns[value]))
+    _prefetch_foreign = classmethod(_prefetch_foreign)
+
+    def _prefetch_children(cls, instances, Child, child_field, my_field):
+        children = {}
+        for instance in instances:
+            children[getattr(instance, my_field)] = []
+        for child in Child._where_in(child_field, children.keys()):
+            children[getattr(child, child_field)].append(child)
+        for instance in instances:
+            instance._set_prefetched((Child, child_field),
+                                     children[getattr(instance, my_field)])
+    _prefetch_children = classmethod(_prefetch_children)
+
+    def _set_prefetched(self, key, value):
+        try:
+            self._prefetched[key] = value
+        except AttributeError:
+            self._prefetched = {key: value}
+
+    def _get_prefetched(self, key):
+        """Get prefetched value, or None"""
+        try:
+            return self._prefetched.get(key)
+        except AttributeError:
+            return None
+
+    # Maximum number of values in one IN list
+    _in_size = 512
+
+    def _where_in(cls, field, values):
+        """Yield all instances with field in the list values.
+
+        The values are queried in chunks of _in_size. The IN lists are
+        padded to a power of two, so that few statement shapes are
+        needed.
+        """
+        for start in range(0, len(values), cls._in_size):
+            chunk = values[start:start+cls._in_size]
+            size = 1
+            while size < len(chunk):
+                size *= 2
+            params = {}
+            for n in range(size):
+                params["in__%s" % n] = chunk[min(n, len(chunk)-1)]
+            sql = cls._sql("in", (field, size))
+            rows = cls._query_rows(sql, params, translated=True, 
+                                   replica=True)
+            for instance in cls._instances(*rows):
+                yield instance
+    _where_in = classmethod(_where_in)
     
+    def async_where(cls, where=None, **parameters):
+        """Run where() in the background, see DBConnect.submit().
+
+        Return a Future for the list of instances::
+
+            future = Postal.async_where(municipal_id=1103)
+            # .. do something else
+            for postal in future.result():
+                print postal.postal_name
+        """
+        return cls._db.submit(lambda: list(cls.where(where, **parameters)))
+    async_where = classmethod(async_where)
+
+    def select(cls, where=None, **parameters):
+        """Start a Query of instances limited by ``where`` clause.
+
+        The parameters are as for where(). The query can be refined
+        further before it is run by iterating over it::
+
+            for postal in Postal.select(municipal_id=1103).order_by(
+                                        "postal_name").limit(20):
+                print postal.postal_name
+        """
+        return Query(cls).where(where, **parameters)
+    select = classmethod(select)
+
+    def delete_where(cls, where=None, **parameters):
+        """Delete rows limited by ``where`` clause, without loading them.
+
+        The where clause and parameters are as for where(), but one of
+        them must be given. A blank where clause is refused, use the
+        where clause "1=1" to delete all rows::
+
+            Postal.delete_where("postal_no > $no", no=9000)
+            Postal.delete_where(municipal_id=1103)
+
+        Instances of the table are removed from the identity map, see
+        DBConnect.use_identity_map(). Prefetched children of other
+        tables are not updated.
+
+        Return number of rows deleted. 
+        (This is database dependant, as with save())
+        """
+        return cls._bulk("delete", {}, where, parameters)
+    delete_where = classmethod(delete_where)
+
+    def update_where(cls, values, where=None, **parameters):
+        """Update rows limited by ``where`` clause, without loading
+        them.
+
+        The dictionary values maps field names to their new values. The
+        where clause and parameters are as for delete_where()::
+
+            Postal.update_where({"is_pobox": False}, municipal_id=1103)
+        
+        Return number of rows updated. 
+        (This is database dependant, as with save())
+        """
+        if not values:
+            raise ProgrammingError, "No values to update"
+        return cls._bulk("update_where", values, where, parameters)
+    update_where = classmethod(update_where)
+
+    def _bulk(cls, operation, values, where, parameters):
+        """Execute statement for delete_where() or update_where()"""
+        if where is not None and not where.strip():
+            raise ProgrammingError, \
+                  'Empty where clause for %s, use "1=1" for all rows' % \
+                  operation
+        if where is None and not parameters:
+            raise ProgrammingError, "Missing where clause for %s" % operation
+        fields = tuple(sorted(values))
+        cls._check_fields(fields)
+        params = parameters.copy()
+        for field in fields:
+            params["v__" + field] = values[field]
+        if where:
+            sql = cls._build_sql(operation, (fields, ())) 
+            sql += " WHERE " + where
+            curs = cls._execute(sql, params)
+        else:
+            where = tuple(sorted(parameters))
+            cls._check_fields(where)
+            sql = cls._sql(operation, (fields, where))
+            curs = cls._execute(sql, params, translated=True)
+        cls._db.invalidate(cls._table_name)
+        cls._db.forget_identities(cls)
+        return curs.rowcount
+    _bulk = classmethod(_bulk)
+
+    def _check_fields(cls, fields):
+        """Raise ProgrammingError unless all fields are in _fields"""
+        for field in fields:
+            if not field in cls._fields:
+                raise ProgrammingError, "Unknown field %s for %s" % (
+                      field, cls.__name__)
+    _check_fields = classmethod(_check_fields)
+
     def get(cls, where=None, **parameters):
         """Like where(), but returns first instance or None."""
         for elem in cls.where(where, **parameters):
@@ -490,6 +2793,94 @@ class Table(Database):
         where = " AND ".join(where)
         return where
     _where_primary = classmethod(_where_primary)     
+
+    def _identity(cls, values, prefix=""):
+        """Get identity map key from dictionary of primary key values.
+
+        The prefix is prepended to the field names, for instance "p__"
+        for _primary_values.
+        """
+        return (cls, tuple([values[prefix+field] for field in cls._primary]))
+    _identity = classmethod(_identity)
+
+    def _forget(self):
+        """Remove from identity map. Return the identity map or None."""
+        identities = self._db.identity_map()
+        if identities is not None and hasattr(self, "_primary_values"):
+            identities.discard(self._identity(self._primary_values, "p__"))
+        return identities
+
+    def _remember(self, identities):
+        """Add to identity map by current primary key values"""
+        if identities is not None:
+            identities.add(self._identity(self._primary_values, "p__"), 
+                           self)
+
+    def _sql(cls, operation, fields=()):
+        """Get translated SQL statement for operation on fields.
+
+        The statement is built by _build_sql() the first time, and
+        afterwards fetched from the statement cache of the connection.
+        """
+        shape = (cls._table_name, operation, fields)
+        return cls._db.statement(shape, 
+                                 lambda: cls._build_sql(operation, fields))
+    _sql = classmethod(_sql)
+
+    def _build_sql(cls, operation, fields=()):
+        """Build SQL statement for operation on fields.
+
+        Operations:
+            where       SELECT with fields matched by $field 
+            load        SELECT by primary keys (as $p__field)
+            insert      INSERT of fields
+            update      UPDATE of fields, by primary keys 
+            in          SELECT with fields[0] IN ($in__0, $in__1, ..)
+                        having fields[1] values
+            delete      DELETE with fields[1] matched by $field 
+            update_where
+                        UPDATE of fields[0] (as $v__field), with 
+                        fields[1] matched by $field
+        """
+        if operation == "where":
+            sql = "SELECT * FROM %s" % cls._table_name
+            if fields:
+                sql += " WHERE "
+                sql += " AND ".join(["%s=$%s" % (field, field) 
+                                     for field in fields])
+        elif operation == "in":
+            field, size = fields
+            sql = "SELECT * FROM %s WHERE %s IN (%s)" % (
+                  cls._table_name, field,
+                  ",".join(["$in__%s" % n for n in range(size)]))
+        elif operation == "load":
+            sql = "SELECT * FROM %s WHERE %s" % (
+                  cls._table_name, cls._where_primary())
+        elif operation == "insert":
+            sql = "INSERT INTO %s(%s) VALUES (%s)" % (
+                  cls._table_name, ",".join(fields),
+                  ",".join(["$%s" % field for field in fields]))
+        elif operation == "update":
+            sql = "UPDATE %s SET %s WHERE %s" % (
+                  cls._table_name, 
+                  ",".join(["%s=$%s" % (field, field) for field in fields]),
+                  cls._where_primary())
+        elif operation in ("delete", "update_where"):
+            values, where = fields
+            if operation == "delete":
+                sql = "DELETE FROM %s" % cls._table_name
+            else:    
+                sql = "UPDATE %s SET %s" % (cls._table_name, 
+                      ",".join(["%s=$v__%s" % (field, field) 
+                                for field in values]))
+            if where:
+                sql += " WHERE "
+                sql += " AND ".join(["%s=$%s" % (field, field) 
+                                     for field in where])
+        else:
+            raise ProgrammingError, "Unknown operation %s" % operation
+        return sql
+    _build_sql = classmethod(_build_sql)
         
     def _load(self, _db_row=None, reload=False, **primary):
         """Load from database.
@@ -519,16 +2910,17 @@ class Table(Database):
             raise ProgrammingError, "Missing parameter for _load()"     
         if not _db_row:
             # Fetch from database
-            where = self._where_primary()
-            sql = "SELECT * FROM %s WHERE %s" % (
-                  self._table_name, where)   
-            _db_row = self._query_one(sql, params)
+            sql = self._sql("load")
+            _db_row = self._query_one(sql, params, translated=True,
+                                      replica=True)
             if not _db_row:
                 raise NotFoundError, primary
             
         for field in self._fields:
-            setattr(self, field, _db_row[field])    
+            if field in _db_row:
+                object.__setattr__(self, field, _db_row[field])    
         self._save_primary()
+        self._clean()
                 
 
     def __repr__(self):
@@ -547,83 +2939,231 @@ class Table(Database):
         all database related attributes are removed.
         """
         if hasattr(self, "_primary_values"):
+            identities = self._forget()
             self._load(reload=True)
+            self._remember(identities)
         else:    
             for field in self._fields:
                 try:
                     delattr(self, field)
                 except AttributeError:
                     continue    
+            self._clean()
     
-    def save(self):
+    def _save_params(self):
+        """Get fields to save and a dictionary of their values.
+
+        For a new row all fields that are set are to be saved, for an
+        existing row only those that have been changed.
+        The fields are returned as a tuple, suitable for _sql().
+        """
+        params = {}
+        fields = []
+        if hasattr(self, "_primary_values"):
+            candidates = self.changed()
+        else:
+            candidates = self._fields
+        for field in candidates:
+            try:
+                params[field] = getattr(self, field)
+            except AttributeError:
+                # Blank values we assume will get default values
+                # from the database.. for instance "current date"
+                # etc.
+                continue
+            else:
+                fields.append(field)
+        return tuple(fields), params
+
+    def _needs_id(self):
+        """Check if the primary key is to be generated by the database"""
+        # NOTE: We cannot assume this for multi-valued primary
+        # keys, as it is often legal to have a primary key with one
+        # of the values NULL. 
+        return len(self._primary) == 1 and \
+               getattr(self, self._primary[0], None) is None
+
+    def _last_insert_id(cls):
+        """Fetch primary key generated by the last INSERT"""
+        if cls._db.type == "mysql":
+            return cls._query_one("SELECT LAST_INSERT_ID() AS id")["id"]
+        elif cls._db.type == "sqlite":     
+            return cls._query_one("SELECT last_insert_rowid() AS id")["id"]
+        elif cls._db.type == "postgresql":     
+            # Assume SERIAL and auto generated sequence name 
+            # table_field_seq
+            seq_name = "%s_%s_seq" % (cls._table_name, cls._primary[0])
+            return cls._query_one("SELECT currval('%s') AS id" % seq_name)["id"]
+        else:
+            # Other databases would probably use sequences BEFORE
+            # inserting.
+            raise UnsupportedDBError, cls._db.type
+    _last_insert_id = classmethod(_last_insert_id)
+
+    def save(self, reload=True):
         """Save changes to database.
 
+        For an existing row, only the changed fields are UPDATE-d, see
+        changed(). If no fields have been changed, nothing is done and 0
+        is returned.
+
+        Afterwards the instance is reloaded, to get the values set by the
+        database, like defaults and triggers. Set reload to False to
+        avoid this extra query. Fields that were not set on a new
+        instance will then stay unset.
+
         Return number of rows updated/inserted, normally 1. 
         (This is database dependant, sqlite will often return 0)"""
-        params = {}
-        if hasattr(self, "_primary_values"):
+        fields, params = self._save_params()
+        update = hasattr(self, "_primary_values")
+        if update and not fields:
+            return 0
+        # Might be saved with new primary keys
+        identities = self._forget()
+        if update:
             # it's an UPDATE.
-            fields = []
-            for field in self._fields:
-                try:
-                    params[field] = getattr(self, field)
-                except AttributeError:
-                    # Blank values we assume will get default values
-                    # from the database.. for instance "current date"
-                    # etc.
-                    continue
-                else:
-                    fields.append("%s=$%s" % (field, field))
-            fields = ",".join(fields)
-        
             params.update(self._primary_values)
-            sql = "UPDATE %s SET %s WHERE %s" % (
-                  self._table_name, fields, self._where_primary())
+            sql = self._sql("update", fields)
         else:
             # it's an INSERT
-            fields = []
-            values = []
-            for field in self._fields:
-                try:
-                    params[field] = getattr(self, field)
-                except AttributeError:
-                    continue
-                else:
-                    fields.append(field)
-                    values.append("$%s" % field)
-            fields = ",".join(fields)        
-            values = ",".join(values)        
-            sql = "INSERT INTO %s(%s) VALUES (%s)" % (
-                   self._table_name, fields, values)
-        curs = self._execute(sql, params)
+            sql = self._sql("insert", fields)
+        curs = self._execute(sql, params, translated=True)
+        self._db.invalidate(self._table_name)
         
-        if len(self._primary) == 1 and \
-            getattr(self, self._primary[0], None) is None:
+        if self._needs_id():
             # It's one of those fetch-id-after-inserting-databases 
-            # NOTE: We cannot assume this for multi-valued primary
-            # keys, as it is often legal to have a primary key with one
-            # of the values NULL. 
-
-            if self._db.type == "mysql":
-                id = self._query_one("SELECT LAST_INSERT_ID() AS id")["id"]
-            elif self._db.type == "sqlite":     
-                id = self._query_one("SELECT last_insert_rowid() AS id")["id"]
-            elif self._db.type == "postgresql":     
-                # Assume SERIAL and auto generated sequence name 
-                # table_field_seq
-                seq_name = "%s_%s_seq" % (self._table_name, self._primary[0])
-                id = self._query_one("SELECT currval('%s') AS id" % seq_name)["id"]
-            else:
-                # Other databases would probably use sequences BEFORE
-                # inserting.
-                raise UnsupportedDBError, self._db.type
-            setattr(self, self._primary[0], id) 
+            setattr(self, self._primary[0], self._last_insert_id()) 
 
         # Set/Update _primary_values so we can do a reload
         self._save_primary()
-        self._load(reload=True)
+        if reload:
+            self._load(reload=True)
+        else:    
+            self._clean()
+        self._remember(identities)
         return curs.rowcount 
 
+    def async_save(self, reload=True):
+        """Run save() in the background, see DBConnect.submit().
+
+        Return a Future for the return value of save(). The instance
+        should not be modified until the future is done.
+        """
+        return self._db.submit(self.save, reload)
+
+    def save_many(cls, instances, reload=False):
+        """Save many instances using few database round-trips.
+
+        The instances are grouped by being new (INSERT) or existing
+        (UPDATE) and by which fields they have set or changed, and
+        existing instances without changes are skipped. Each group is
+        saved by a single executemany(). Primary keys generated by the
+        database are fetched in bulk, by RETURNING on PostgreSQL and
+        from the range of rowids on sqlite. On MySQL each new row needs
+        a separate INSERT to fetch its id, as MySQLdb might split
+        executemany() into several statements.
+
+        Unlike save(), the instances are not reloaded from the database
+        unless reload is True.
+
+        Return number of rows updated/inserted. 
+        (This is database dependant, as with save())
+        """
+        groups = {}
+        order = []
+        for instance in instances:
+            if not isinstance(instance, cls):
+                raise ProgrammingError, "Can't save %r as %s" % (
+                      instance, cls.__name__)
+            fields, params = instance._save_params()
+            update = hasattr(instance, "_primary_values")
+            if update and not fields:
+                continue
+            if update:
+                params.update(instance._primary_values)
+            instance._forget()
+            key = (update, fields, not update and instance._needs_id())
+            if not key in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append((instance, params))
+        rowcount = 0
+        for key in order:
+            (update, fields, needs_id) = key
+            group = groups[key]
+            if update:
+                sql = cls._sql("update", fields)
+            elif needs_id:
+                rowcount += cls._insert_ids(fields, group)
+                continue
+            else:
+                sql = cls._sql("insert", fields)
+            curs = cls._execute_many(sql, [params for (i, params) in group],
+                                     translated=True)
+            rowcount += max(curs.rowcount, 0)
+        if order:
+            cls._db.invalidate(cls._table_name)
+        identities = cls._db.identity_map()
+        for key in order:
+            for (instance, params) in groups[key]:
+                instance._save_primary()
+                if reload:
+                    instance._load(reload=True)
+                else:
+                    instance._clean()
+                instance._remember(identities)
+        return rowcount
+    save_many = classmethod(save_many)
+
+    # Maximum number of rows in one INSERT when using RETURNING
+    _returning_rows = 500
+
+    def _insert_ids(cls, fields, group):
+        """INSERT group of (instance, params) and set generated ids.
+        
+        Return number of rows inserted. Used by save_many()
+        """
+        primary = cls._primary[0]
+        if cls._db.type == "postgresql":
+            rowcount = 0
+            for start in range(0, len(group), cls._returning_rows):
+                chunk = group[start:start+cls._returning_rows]
+                params = {}
+                rows = []
+                for (n, (instance, row_params)) in enumerate(chunk):
+                    values = []
+                    for field in fields:
+                        name = "%s__%s" % (field, n)
+                        params[name] = row_params[field]
+                        values.append("$" + name)
+                    rows.append("(%s)" % ",".join(values or ["DEFAULT"]))
+                sql = "INSERT INTO %s(%s) VALUES %s RETURNING %s" % (
+                      cls._table_name, ",".join(fields or (primary,)), 
+                      ",".join(rows), primary)
+                curs = cls._execute(sql, params, write=True)
+                # Rows are returned in VALUES order
+                for ((instance, row_params), (id,)) in izip(chunk, 
+                                                            curs.fetchall()):
+                    setattr(instance, primary, id)
+                rowcount += len(chunk)
+            return rowcount
+        sql = cls._sql("insert", fields)
+        if cls._db.type == "sqlite":
+            cls._execute_many(sql, [params for (i, params) in group],
+                              translated=True)
+            # sqlite locks the database for writing during the
+            # transaction, so the rows get a contiguous range of rowids
+            last = cls._last_insert_id()
+            first = last - len(group) + 1
+            for (n, (instance, params)) in enumerate(group):
+                setattr(instance, primary, first + n)
+            return len(group)
+        for (instance, params) in group:
+            cls._execute(sql, params, translated=True)
+            setattr(instance, primary, cls._last_insert_id())
+        return len(group)
+    _insert_ids = classmethod(_insert_ids)
+
     def _save_primary(self):      
         """Store a copy of current primary keys.
         
@@ -644,11 +3184,21 @@ class Table(Database):
         table = self._foreigns[_foreign]
         if getattr(self, _foreign) is None:
             return None
-        if isinstance(_foreign, unicode):
+        prefetched = self._get_prefetched(_foreign)
+        if prefetched and prefetched[0] == getattr(self, _foreign):
+            return prefetched[1]
+        column = self._references.get(_foreign, _foreign)
+        if isinstance(column, unicode):
             # We can't (shouldn't) have unicode kw args!
-            _foreign = _foreign.encode("ascii", "ignore")
-        primary = {_foreign: getattr(self, _foreign)}
-        return table(**primary)
+            column = column.encode("ascii", "ignore")
+        primary = {column: getattr(self, _foreign)}
+        if column in table._primary:
+            return table(**primary)
+        # Referencing another unique field
+        foreign = table.get(**primary)
+        if foreign is None:
+            raise NotFoundError, primary
+        return foreign
 
     # Will be used by all generated _set_something() methods
     def _set_foreign(self, value, _foreign):
@@ -659,8 +3209,8 @@ class Table(Database):
         if value is None:
             setattr(self, _foreign, None)
         else:   
-            # Fetch the foreign primary key 
-            primary = getattr(value, _foreign)
+            # Fetch the referenced key 
+            primary = getattr(value, self._references.get(_foreign, _foreign))
             setattr(self, _foreign, primary)
 
     # Will be used by all generated _get_somethings() methods
@@ -669,12 +3219,240 @@ class Table(Database):
         
         A child is someone whose foreign keys point to us.
         """
-        sql = "SELECT * FROM %s WHERE %s=%s" % (
-              _Child._table_name, _child_field, self._db.param)
-        params = (getattr(self, _my_field), )
-        for row in self._query(sql, params):
-            yield _Child(_db_row=row)
+        prefetched = self._get_prefetched((_Child, _child_field))
+        if prefetched is not None:
+            return iter(prefetched)
+        return self._iter_children(_Child, _child_field, _my_field)
+
+    def _iter_children(self, _Child, _child_field, _my_field):
+        sql = _Child._sql("where", (_child_field,))
+        params = {_child_field: getattr(self, _my_field)}
+        rows = self._query_rows(sql, params, translated=True, replica=True)
+        for child in _Child._instances(*rows):
+            yield child
+
 
+class Query(object):
+    """Composable query for instances of a Table class.
+
+    Queries are made by Table.select(), and refined by the methods
+    where(), only(), order_by(), limit(), offset() and after(). Each of
+    these returns a new Query, leaving the original unchanged::
+
+        postals = Postal.select(is_pobox=False)
+        first = postals.order_by("-postal_no").limit(10)
+        for postal in first:
+            print postal.postal_no
+
+    Iterating runs the query and yields instances. To only ask the
+    database, use count() or exists().
+    """
+    def __init__(self, table):
+        self.table = table
+        self._where = ()
+        self._parameters = {}
+        self._only = None
+        self._order = ()
+        self._limit = None
+        self._offset = None
+        self._after = None
+
+    def _copy(self):
+        query = Query(self.table)
+        query.__dict__.update(self.__dict__)
+        return query
+
+    def where(self, where=None, **parameters):
+        """Limit by ``where`` clause, as for Table.where().
+
+        Several where clauses are combined by AND.
+        """
+        query = self._copy()
+        if where is None and parameters:
+            self.table._check_fields(parameters)
+            where = " AND ".join(["%s=$%s" % (field, field) 
+                                  for field in sorted(parameters)])
+        if where:
+            query._where = self._where + (where,)
+        query._parameters = self._parameters.copy()
+        query._parameters.update(parameters)
+        return query
+
+    def only(self, *fields):
+        """Only fetch the given fields.
+
+        The primary keys are always fetched. Fields not fetched are
+        left unset on the instances, which can still be saved.
+        """
+        self.table._check_fields(fields)
+        query = self._copy()
+        query._only = list(self.table._primary)
+        for field in fields:
+            if not field in query._only:
+                query._only.append(field)
+        return query
+
+    def order_by(self, *fields):
+        """Sort by the given fields, or descending for "-field".
+
+        With limit(), offset() or after(), the primary keys are added
+        to the sort order, so that pages are stable even when the fields
+        have equal values.
+        """
+        order = []
+        for field in fields:
+            descending = field.startswith("-")
+            if descending:
+                field = field[1:]
+            order.append((field, descending))
+        self.table._check_fields([field for (field, descending) in order])
+        query = self._copy()
+        query._order = tuple(order)
+        return query
+
+    def limit(self, limit):
+        """Return at most limit instances"""
+        query = self._copy()
+        query._limit = int(limit)
+        return query
+
+    def offset(self, offset):
+        """Skip the first offset instances.
+
+        For paging through big tables, after() is more efficient, as
+        the database must still find all the skipped rows.
+        """
+        query = self._copy()
+        query._offset = int(offset)
+        return query
+
+    def after(self, key):
+        """Only return instances after key in the order of order_by().
+
+        The key is the last instance of the previous page, or a
+        tuple of its values for the order_by() fields followed by the
+        primary keys. The primary keys are added to the sort order to
+        make it unique::
+
+            page = Postal.select().order_by("postal_name").limit(100)
+            postals = list(page)
+            while postals:
+                # ...
+                postals = list(page.after(postals[-1]))
+
+        Unlike offset(), the database can use an index to find the
+        start of the page. NULL values in the order fields are not
+        supported.
+        """
+        query = self._copy()
+        query._after = key
+        return query
+
+    def _order_fields(self):
+        """Fields to sort by as (field, descending) pairs"""
+        order = list(self._order)
+        if (self._after is not None or 
+            order and (self._limit is not None or self._offset)):
+            fields = [field for (field, descending) in order]
+            for field in self.table._primary:
+                if not field in fields:
+                    order.append((field, False))
+        return order
+
+    def _after_where(self, order, parameters):
+        """WHERE clause for after(), adding values to parameters"""
+        key = self._after
+        if isinstance(key, Table):
+            values = [getattr(key, field) for (field, descending) in order]
+        else:
+            if not isinstance(key, (tuple, list)):
+                key = (key,)
+            if len(key) != len(order):
+                raise ProgrammingError, "Key %r does not match order %s" % (
+                      key, [field for (field, descending) in order])
+            values = key
+        # a > x OR (a = x AND b > y) OR ..
+        alternatives = []
+        for (n, (field, descending)) in enumerate(order):
+            parameters["q__after%s" % n] = values[n]
+            equal = ["%s=$q__after%s" % (order[m][0], m) for m in range(n)]
+            if descending:
+                compare = "%s<$q__after%s" % (field, n)
+            else:
+                compare = "%s>$q__after%s" % (field, n)
+            alternatives.append(" AND ".join(equal + [compare]))
+        return " OR ".join(["(%s)" % a for a in alternatives])
+
+    def _limit_sql(self, limit, offset, parameters):
+        """LIMIT/OFFSET clause for the database, adding to parameters"""
+        if limit is None and not offset:
+            return ""
+        if limit is None:
+            # sqlite and MySQL needs a LIMIT before OFFSET
+            if self.table._db.type == "sqlite":
+                limit = -1
+            elif self.table._db.type == "mysql":
+                limit = 18446744073709551615L
+        sql = ""
+        if limit is not None:
+            parameters["q__limit"] = limit
+            sql += " LIMIT $q__limit"
+        if offset:
+            parameters["q__offset"] = offset
+            sql += " OFFSET $q__offset"
+        return sql
+
+    def _sql(self, columns=None, order=True, limit=None, offset=None):
+        """Get SQL and parameters for the query.
+
+        The columns, limit and offset of the query are used unless
+        given. Ordering is left out if order is False.
+        """
+        parameters = self._parameters.copy()
+        if columns is None:
+            columns = ",".join(self._only or ["*"])
+        sql = "SELECT %s FROM %s" % (columns, self.table._table_name)
+        where = list(self._where)
+        order_fields = self._order_fields()
+        if self._after is not None:
+            where.append(self._after_where(order_fields, parameters))
+        if where:
+            sql += " WHERE " + " AND ".join(["(%s)" % w for w in where])
+        if order and order_fields:
+            sql += " ORDER BY " + ",".join(
+                [field + (descending and " DESC" or "")
+                 for (field, descending) in order_fields])
+        if limit is None:
+            limit = self._limit
+        if offset is None:
+            offset = self._offset
+        sql += self._limit_sql(limit, offset, parameters)
+        return sql, parameters
+
+    def __iter__(self):
+        sql, parameters = self._sql()
+        rows = self.table._cached_rows(sql, parameters)
+        return self.table._instances(*rows)
+
+    def count(self):
+        """Count the instances the query would return"""
+        if self._limit is None and not self._offset:
+            sql, parameters = self._sql("COUNT(*)", order=False)
+        else:
+            sql, parameters = self._sql(",".join(self.table._primary),
+                                        order=False)
+            sql = "SELECT COUNT(*) FROM (%s) AS counted" % sql
+        fields, rows = self.table._cached_rows(sql, parameters)
+        for row in rows:
+            return row[0]
+
+    def exists(self):
+        """Check if the query would return any instances"""
+        sql, parameters = self._sql("1", order=False, limit=1)
+        fields, rows = self.table._cached_rows(sql, parameters)
+        for row in rows:
+            return True
+        return False
 
 class TableBuilder(Database):
     """Build Table subclasses by investigating database.
@@ -686,9 +3464,19 @@ class TableBuilder(Database):
     generate Table instances, one for each table. 
 
     In addition to figuring out column names and primary keys, the table
-    builder will also guess foreign keys and add methods like
+    builder will also find foreign keys and add methods like
     get_something(), set_something() and get_somethings().
+
+    Set the attribute slots to True to generate classes that store
+    the fields in __slots__ instead of a __dict__ per instance, saving
+    memory for large results. Instances of such classes only allow the
+    fields and Table's own attributes to be set, not arbitrary ones.
     """
+    # Generate classes with __slots__ for the fields
+    slots = False
+    # Guess foreign keys by field names, see find_foreign()
+    guess_foreign = True
+
     def __init__(self, TableBase=Table):
         """Build tables using provided TableBase as a base class.
 
@@ -703,6 +3491,7 @@ class TableBuilder(Database):
         if not TableBase._db:
             class TableBase(TableBase):
                 _db = self._db
+                __slots__ = ()
         self.TableBase = TableBase
 
     def all_tables(self):
@@ -729,24 +3518,55 @@ class TableBuilder(Database):
         self.table_names = [t for t in tables if not t.endswith("_seq")]
         self.sequences = [t for t in tables if t.endswith("_seq")]
 
-    def build_class(self, table_name):
+    def build_class(self, table_name, fields=()):
         """Build the (empty) subclass for table_name.
 
         The generated class will have a Pythonish version of table_name
         as the official class name. For instance, the class for my_table
         will be MyTable.
+
+        If the attribute slots is True, the class will have __slots__
+        for the given fields.
         """
         class table(self.TableBase):
+            __slots__ = self._slots(fields)
             _table_name = table_name
             _children = []
+            # name -> relation, see Table.prefetch()
+            _relations = {}
         if isinstance(table_name, unicode):
             table_name = table_name.encode("ascii", "ignore")
         table.__name__ = table_name.capitalize()    
         return table
 
+    def _slots(self, fields):
+        """Get __slots__ for a class with fields.
+
+        Fields that are not valid identifiers, or that would hide
+        attributes of TableBase, are stored in __dict__ instead.
+        """
+        if not self.slots:
+            return ("__dict__",)
+        slots = []
+        for field in fields:
+            if isinstance(field, unicode):
+                field = field.encode("ascii", "replace")
+            if _identifier.match(field) and not hasattr(self.TableBase,
+                                                        field):
+                slots.append(field)
+            elif not "__dict__" in slots:
+                slots.append("__dict__")
+        return tuple(slots)
+
     def add_fields(self, table):
         """Find the fields and primary keys"""
-        table_name = table._table_name
+        table._fields, table._primary = self.find_fields(table._table_name)
+
+    def find_fields(self, table_name):
+        """Find the fields and primary keys of table_name.
+
+        Return a dictionary of field types and a list of primary keys.
+        """
         fields = {}
         primary = []
         c = self._db.cursor()
@@ -791,21 +3611,94 @@ class TableBuilder(Database):
         # match on ALL fields for UPDATE/DELETE.
         if not primary:
             primary = fields.keys()
-        table._fields = fields    
-        table._primary = primary
+        return fields, primary
     
+    def find_foreign_keys(self, table_name):
+        """Find foreign key constraints of table_name.
+
+        Return a list of (field, foreign table name, foreign field). The
+        foreign field is None if the constraint refers to the primary
+        key without naming it. Constraints of several fields are left
+        out. If the database catalog can't be read, the list is empty.
+        """
+        c = self._db.cursor()
+        try:
+            if self._db.type == "mysql":
+                c.execute("""SELECT constraint_name, column_name,
+                                    referenced_table_name, 
+                                    referenced_column_name
+                             FROM information_schema.key_column_usage
+                             WHERE table_schema=DATABASE() 
+                               AND table_name=%s
+                               AND referenced_table_name IS NOT NULL""",
+                          (table_name,))
+                rows = c.fetchall()
+            elif self._db.type == "sqlite":
+                c.execute("PRAGMA foreign_key_list(%s)" % table_name)
+                # id, seq, table, from, to, ..
+                rows = [(row[0], row[3], row[2], row[4]) 
+                        for row in c.fetchall()]
+            elif self._db.type == "postgresql":
+                c.execute("""SELECT con.conname, a.attname, f.relname,
+                                    fa.attname
+                        FROM pg_catalog.pg_constraint con
+                        JOIN pg_catalog.pg_class t ON (con.conrelid = t.oid)
+                        JOIN pg_catalog.pg_class f ON (con.confrelid = f.oid)
+                        JOIN pg_catalog.pg_attribute a 
+                             ON (a.attrelid = t.oid 
+                                 AND a.attnum = ANY (con.conkey))
+                        JOIN pg_catalog.pg_attribute fa 
+                             ON (fa.attrelid = f.oid 
+                                 AND fa.attnum = ANY (con.confkey))
+                        WHERE con.contype = 'f' AND t.relname = %s
+                          AND pg_catalog.pg_table_is_visible(t.oid)""",
+                          (table_name,))
+                rows = c.fetchall()
+            else:    
+                raise UnsupportedDBError, self._db.type
+        except self._db.module.Error, e:
+            logging.warning("Could not find foreign keys of %s: %s", 
+                            table_name, e)
+            # PostgreSQL won't continue the transaction after errors
+            self._db.connection.rollback()
+            return []
+        constraints = {}
+        order = []
+        for (name, field, foreign, foreign_field) in rows:
+            if not name in constraints:
+                constraints[name] = []
+                order.append(name)
+            constraints[name].append((field, foreign, foreign_field))
+        return [constraints[name][0] for name in order 
+                if len(constraints[name]) == 1]
+
     def find_foreign(self, table): 
-        """Guess foreign keys. 
+        """Find foreign keys. 
 
-        Basically a field fish_id is assumed a foreign key for the table
-        fish - if it exists.
+        Foreign key constraints listed by find_foreign_keys() are added
+        first. Then, unless the attribute guess_foreign is False, the
+        other foreign keys are guessed. Basically a field fish_id is
+        assumed a foreign key for the table fish - if it exists.
 
         Note that build_table() must have been called on all tables
         first in order to compare foreign keys with primary keys.
         """
         table._foreigns = {}
+        table._references = {}
+        for (field, table_name, foreign_field) in self.find_foreign_keys(
+                                                  table._table_name):
+            foreign = self.tables.get(table_name)
+            if foreign is None or field in table._foreigns:
+                continue
+            if foreign_field is None:
+                if len(foreign._primary) != 1:
+                    continue
+                foreign_field = foreign._primary[0]
+            self.add_foreign(table, field, foreign, foreign_field)
+        if not self.guess_foreign:
+            return
         for field in table._fields.keys():
-            if not field.endswith("_id"):
+            if not field.endswith("_id") or field in table._foreigns:
                 continue
             # Chop of _id
             table_name = field[:-3]
@@ -816,16 +3709,48 @@ class TableBuilder(Database):
             foreign = self.tables[table_name]      
             if not field in foreign._primary:
                 continue
-            table._foreigns[field] = foreign
-            # And add a reverse mapping 
-            # his_table, his_field, my_field
-            foreign._children.append((table, field, field))
+            self.add_foreign(table, field, foreign)
+
+    def add_foreign(self, table, field, foreign, foreign_field=None):
+        """Add field of table as a foreign key to the table foreign.
+
+        The field refers to foreign_field of the foreign table, by
+        default the field of the same name.
+        """
+        table._foreigns[field] = foreign
+        if foreign_field is None:
+            foreign_field = field
+        elif foreign_field != field:
+            table._references[field] = foreign_field
+        # And add a reverse mapping 
+        # his_table, his_field, my_field
+        foreign._children.append((table, field, foreign_field))
+
+    def relation_name(self, table, field):
+        """Name the relation of foreign key field of table.
+
+        This is the name of the foreign table, as in get_county(),
+        unless the field is named differently from the field it refers
+        to. For instance, the field owner_id referring to person_id is
+        named owner, as in get_owner().
+        """
+        if table._references.get(field, field) == field:
+            name = table._foreigns[field].__name__
+        elif field.endswith("_id"):
+            name = field[:-3]
+        else:
+            name = field
+        if isinstance(name, unicode):
+            name = name.encode("ascii", "ignore")
+        return name.lower()
     
     def build_table(self, table_name):
         """Build a table class and find all fields.
         """
-        table = self.build_class(table_name)
-        self.add_fields(table)    
+        fields, primary = self.find_fields(table_name)
+        table = self.build_class(table_name, fields)
+        table._fields = fields    
+        table._primary = primary
         return table
     
     def generate_foreign_methods(self, table):
@@ -835,14 +3760,16 @@ class TableBuilder(Database):
         table class Other.
         """
         for foreign,Foreign in table._foreigns.items():
-            get_name = "get_" + Foreign.__name__.lower()
+            name = self.relation_name(table, foreign)
+            table._relations[name] = ("foreign", foreign, Foreign)
+            get_name = "get_" + name
             def _get_foreign(self, _foreign=foreign):
                 return super(table, self)._get_foreign(_foreign)
             if sys.version_info > (2,4,None,None,None):
                 _get_foreign.__name__ = get_name 
             setattr(table, get_name, _get_foreign)    
 
-            set_name = "set_" + Foreign.__name__.lower()
+            set_name = "set_" + name
             def _set_foreign(self, value, _foreign=foreign):
                 super(table, self)._set_foreign(value, _foreign)
             if sys.version_info > (2,4,None,None,None):
@@ -853,11 +3780,16 @@ class TableBuilder(Database):
         """Generate get-methods for retrieving foreign key children.
 
         The method names will be named like get_others() for the table
-        class Other.
+        class Other. If the foreign key of Other is named differently,
+        see relation_name(), it is added, as in get_others_by_owner().
         """
         for (Child, child_field, my_field) in table._children:
             # transform name, ie. "car" -> "get_cars"
             child_name = "get_" + Child.__name__.lower() + "s"
+            if child_field != my_field:
+                child_name += "_by_" + self.relation_name(Child, child_field)
+            table._relations[child_name[4:]] = ("children", Child, 
+                                                child_field, my_field)
             def _get_children(self, _Child=Child,
                              _child_field=child_field,
                              _my_field=my_field):
@@ -867,7 +3799,166 @@ class TableBuilder(Database):
                 _get_children.__name__ = child_name 
             setattr(table, child_name, _get_children)
 
-    def build_tables(self):
+    # Increase when the format of schema() changes
+    schema_format = 2
+
+    def fingerprint(self):
+        """Get a checksum of the database schema.
+
+        The checksum is of the table definitions and foreign key
+        constraints as listed by one or two queries, so that a cached
+        schema can be validated cheaply.
+        """
+        c = self._db.cursor()
+        if self._db.type == "mysql":
+            c.execute("""SELECT table_name, column_name, column_type,
+                                column_key
+                         FROM information_schema.columns 
+                         WHERE table_schema=DATABASE()
+                         ORDER BY table_name, ordinal_position""")
+        elif self._db.type == "sqlite":
+            c.execute("""SELECT type, name, tbl_name, sql 
+                         FROM sqlite_master ORDER BY type, name""")
+        elif self._db.type == "postgresql":
+            c.execute("""SELECT c.relname, a.attname, a.atttypid, 
+                    (SELECT index.indkey FROM pg_catalog.pg_index index
+                     WHERE index.indrelid = c.oid AND index.indisprimary)
+                    FROM pg_catalog.pg_class c
+                    JOIN pg_catalog.pg_attribute a ON (a.attrelid = c.oid)
+                    JOIN pg_catalog.pg_namespace n 
+                         ON (c.relnamespace = n.oid)
+                    WHERE n.nspname = pg_catalog.current_schema() 
+                      AND c.relkind = 'r'
+                      AND a.attnum > 0 AND NOT a.attisdropped
+                    ORDER BY c.relname, a.attnum""")
+        else: 
+            raise UnsupportedDBError, self._db.type
+        checksum = md5(self._db.type)
+        for row in c.fetchall():
+            checksum.update(repr(tuple(row)))
+        if self._db.type == "mysql":
+            c.execute("""SELECT table_name, column_name, 
+                                referenced_table_name, referenced_column_name
+                         FROM information_schema.key_column_usage
+                         WHERE table_schema=DATABASE() 
+                           AND referenced_table_name IS NOT NULL
+                         ORDER BY table_name, constraint_name, 
+                                  ordinal_position""")
+        elif self._db.type == "postgresql":
+            c.execute("""SELECT t.relname, con.conname, con.conkey, 
+                                con.confrelid, con.confkey
+                    FROM pg_catalog.pg_constraint con
+                    JOIN pg_catalog.pg_class t ON (con.conrelid = t.oid)
+                    WHERE con.contype = 'f' 
+                      AND pg_catalog.pg_table_is_visible(t.oid)
+                    ORDER BY t.relname, con.conname""")
+        else:
+            # sqlite_master has the constraints in the sql
+            return checksum.hexdigest()
+        for row in c.fetchall():
+            checksum.update(repr(tuple(row)))
+        return checksum.hexdigest()
+
+    def schema(self):
+        """Get the schema found by build_tables() as a dictionary.
+
+        The dictionary can be given to build_schema() to build the same
+        tables without investigating the database.
+        """
+        tables = {}
+        for (table_name, table) in self.tables.items():
+            foreigns = dict([(field, (Foreign._table_name, 
+                                      table._references.get(field, field)))
+                             for (field, Foreign) in table._foreigns.items()])
+            tables[table_name] = (table._fields, table._primary, foreigns)
+        return {"format": self.schema_format,
+                "table_names": self.table_names, 
+                "sequences": self.sequences,
+                "tables": tables}
+
+    def build_schema(self, schema):
+        """Build the table classes from schema as returned by schema()
+        """
+        self.table_names = schema["table_names"]
+        self.sequences = schema["sequences"]
+        self.tables = {}
+        for table_name in self.table_names:
+            (fields, primary, foreigns) = schema["tables"][table_name]
+            table = self.build_class(table_name, fields)
+            table._fields = fields    
+            table._primary = primary
+            table._foreigns = {}
+            table._references = {}
+            self.tables[table_name] = table
+        for table_name in self.table_names:
+            table = self.tables[table_name]
+            (fields, primary, foreigns) = schema["tables"][table_name]
+            for (field, (foreign, foreign_field)) in foreigns.items():
+                self.add_foreign(table, field, self.tables[foreign], 
+                                 foreign_field)
+
+    def load_schema(self, filename, fingerprint):
+        """Load schema from cache file written by save_schema().
+
+        Return None if the file does not exist or does not match
+        fingerprint. 
+        """
+        try:
+            file = open(filename, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                cached = pickle.load(file)
+            except Exception, e:
+                logging.warning("Ignoring broken schema cache %s: %s", 
+                                filename, e)
+                return None
+        finally:
+            file.close()
+        if not isinstance(cached, dict):
+            return None
+        if cached.get("fingerprint") != fingerprint:
+            return None
+        schema = cached.get("schema")
+        if not schema or schema.get("format") != self.schema_format:
+            return None
+        return schema
+
+    def save_schema(self, filename, fingerprint):
+        """Save schema() to cache file for use by load_schema().
+
+        The file is replaced atomically, so that other processes never
+        read a half written cache. Failing to write the cache is logged
+        as a warning only.
+        """
+        cached = {"fingerprint": fingerprint, "schema": self.schema()}
+        dir, prefix = os.path.split(os.path.abspath(filename))
+        try:
+            fd, temp = tempfile.mkstemp(prefix=prefix, dir=dir)
+        except (IOError, OSError), e:
+            logging.warning("Could not write schema cache %s: %s", 
+                            filename, e)
+            return
+        try:
+            file = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(cached, file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                file.close()
+            if os.name != "posix" and os.path.exists(filename):
+                # rename() can't replace files on Windows
+                os.remove(filename)
+            os.rename(temp, filename)
+        except (IOError, OSError), e:
+            logging.warning("Could not write schema cache %s: %s", 
+                            filename, e)
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    def build_tables(self, cache=None):
         """Fully generate the list of table classes.
         
         This is the main method which will retrieve all tables, generate
@@ -875,20 +3966,35 @@ class TableBuilder(Database):
 
         The generated table classes will be available in self.tables
         using the SQL table name as a key.
+
+        If cache is given as a filename, the schema found is stored in
+        that file. Later calls will build the tables from the cache
+        instead of investigating each table, as long as fingerprint()
+        of the database is unchanged.
         """
-        self.all_tables()
-        self.tables = {}
-        for table_name in self.table_names:     
-            table = self.build_table(table_name)
-            self.tables[table_name] = table
-        for table in self.tables.values():
-            self.find_foreign(table)
+        schema = None
+        if cache:
+            fingerprint = self.fingerprint()
+            schema = self.load_schema(cache, fingerprint)
+        if schema is not None:
+            self.build_schema(schema)
+        else:
+            self.all_tables()
+            self.tables = {}
+            for table_name in self.table_names:     
+                table = self.build_table(table_name)
+                self.tables[table_name] = table
+            for table in self.tables.values():
+                self.find_foreign(table)
+            if cache:
+                self.save_schema(cache, fingerprint)
         for table in self.tables.values():
             self.generate_foreign_methods(table)    
             self.generate_children_methods(table)    
 
 
-def generate(db_module, connect_info, globals=None):
+def generate(db_module, connect_info, globals=None, slots=False, cache=None,
+             replicas=()):
     """Generate forgetSQL classes and return as a module object.
 
     The db_module can be MySQLdb or sqlite2. This parameter must be
@@ -923,12 +4029,26 @@ def generate(db_module, connect_info, globals=None):
         import database
         for postal in database.Postal:
             print postal.postal_no
+
+    If slots is True, the generated classes use __slots__ for the
+    fields, see TableBuilder.
+
+    To avoid investigating all tables on every start, give a filename
+    as cache for storing the database schema, see
+    TableBuilder.build_tables()::
+
+        db = forgetsql2.generate(MySQLdb, {db='fish'},
+                                 cache="/var/cache/fish/schema")
+
+    Queries can be sent to read replicas, given as a list of connect
+    info, see DBConnect.add_replica().
     """
     # subclass in the _db connection
     class TB(TableBuilder):
-        _db = DBConnect(db_module, connect_info)
+        _db = DBConnect(db_module, connect_info, replicas=replicas)
+    TB.slots = slots
     builder = TB()
-    builder.build_tables()    
+    builder.build_tables(cache)    
     module = None
     if globals is None:
         # Generate a module object. Note that it is not adviced to add
@@ -42,11 +42,20 @@ import StringIO
 import logging
 import re
 import gc
+import time
+import threading
+import shutil
+import pickle
 from sets import Set
 from doc_exception import ProgrammingError
 
 from forgetsql2 import Database, TableBuilder, DBConnect
 from forgetsql2 import NotFoundError, generate
+from forgetsql2 import ConnectionPool, PoolTimeoutError, IdentityMap
+from forgetsql2 import ResultCache
+from forgetsql2 import FutureTimeoutError
+from forgetsql2 import Listener, Statistics, SlowQueryLog, NPlusOneDetector
+from forgetsql2 import fingerprint, compile_sql
 
 gc.disable()
             
@@ -285,6 +294,55 @@ class TestDBConnect(TestFramework):
         self.assert_(self.lastLog().startswith(
                 "WARNING: Reconnecting database due to "))
     
+    def testCursorValidate(self):
+        d = self.Database()
+        d._db.validate_after = 0
+        d._db._get_entry().last_used -= 1
+        d._db.connection.close()
+        cursor = d._db.cursor()    
+        cursor.execute("SELECT 1+1")    
+        self.assertEqual(cursor.fetchone(), (2,))
+        self.assert_(self.lastLog().startswith(
+                "WARNING: Reconnecting database due to "))
+
+    def testReconnectOn(self):
+        d = self.Database()
+        # A real error on a working connection
+        self.assertRaises(self.db.OperationalError, 
+                          d._query_one, "SELECT * FROM not_a_table")
+        self.assertEqual(self.lastLog(), "")
+        self.failIf(d._db.reconnect_on(self.db.OperationalError()))
+        d._db.connection.close()
+        self.failIf(d._db.reconnect_on(self.db.IntegrityError()))
+        self.assert_(d._db.reconnect_on(self.db.OperationalError()))
+        self.assert_(self.lastLog().startswith(
+                "WARNING: Reconnecting database due to "))
+        self.assertEqual(d._query_one("SELECT 1+1 AS two"), {"two": 2})
+    
+    def testReconnectLost(self):
+        d = self.Database()
+        update = "UPDATE county SET county_name='X' WHERE county_id=11"
+        d._execute(update)
+        d._db.connection.close()
+        # Not retried without the update
+        self.assertRaises(self.db.Error, d._execute, update)
+        self.assert_(self.lastLog().startswith(
+                "WARNING: Reconnecting database due to "))
+        self.failIf(d._db._pending())
+        self.assertNotEqual(d._query_one("SELECT county_name FROM county "
+                                         "WHERE county_id=11"),
+                            {"county_name": "X"})
+        d._execute(update)
+        d._db.connection.close()
+        self.failIf(d._db.reconnect_on(self.db.OperationalError()))
+        self.assert_(self.lastLog().startswith(
+                "WARNING: Reconnecting database due to "))
+        self.assertEqual(d._query_one("SELECT 1+1 AS two"), {"two": 2})
+        transaction = d._db.transaction()
+        d._db.connection.close()
+        self.failIf(d._db.reconnect_on(self.db.OperationalError()))
+        self.lastLog()
+    
     def testSameConnection(self):
         d1 = self.Database()     
         d2 = self.Database()
@@ -314,6 +372,163 @@ class TestDBConnect(TestFramework):
                         self.Database._db.connection)
 
 
+class TestConnectionPool(TestFramework):
+    def makePool(self, **kwargs):
+        return ConnectionPool(self.db_c._connect, **kwargs)
+
+    def testAcquireRelease(self):
+        pool = self.makePool()
+        entry = pool.acquire()
+        self.assert_(entry.connection.cursor())
+        pool.release(entry)
+        # Should be reused
+        self.assertEqual(pool.acquire(), entry)
+        stats = pool.statistics()
+        self.assertEqual(stats["created"], 1)
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["in_use"], 1)
+        self.assertEqual(stats["idle"], 0)
+
+    def testTimeout(self):
+        pool = self.makePool(max_size=1, timeout=0.1)
+        entry = pool.acquire()
+        self.assertRaises(PoolTimeoutError, pool.acquire)
+        self.assertEqual(pool.statistics()["size"], 1)
+        pool.release(entry)
+        pool.acquire()
+
+    def testMaxIdle(self):
+        pool = self.makePool(max_idle=0)
+        entry = pool.acquire()
+        pool.release(entry)
+        time.sleep(0.01)
+        self.assertNotEqual(pool.acquire(), entry)
+        self.assertEqual(pool.statistics()["closed"], 1)
+
+    def testMaxLifetime(self):
+        pool = self.makePool(max_lifetime=0)
+        entry = pool.acquire()
+        time.sleep(0.01)
+        pool.release(entry)
+        self.assertEqual(pool.statistics()["size"], 0)
+
+    def testReclaimDeadThread(self):
+        pool = self.makePool(max_size=1, timeout=5)
+        thread = threading.Thread(target=pool.acquire)
+        thread.start()
+        thread.join()
+        entry = pool.acquire()
+        self.assert_(entry.connection.cursor())
+        self.assertEqual(pool.statistics()["created"], 2)
+        self.assert_(self.lastLog().startswith(
+                "WARNING: Reclaiming connection from dead thread"))
+    
+    def testThreadConnections(self):
+        connections = []
+        db = self.db_c
+        def work():
+            connections.append(db.connection)
+            self.Database._query_one("SELECT 1+1 AS two")
+            # Given back after reading
+            connections.append(db.connection)
+            self.Database._execute("UPDATE county SET county_name='X'")
+            # Kept until committed
+            connections.append(db.connection)
+            db.rollback()
+            connections.append(db.connection)
+        for n in range(6):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertEqual(connections[:4],
+                         [None, None, connections[2], None])
+        self.assertNotEqual(connections[2], None)
+        stats = db.pool.statistics()
+        # Only the connection held by this thread since connect()
+        self.assertEqual(stats["in_use"], 1)
+        self.assertEqual(stats["size"], stats["idle"] + 1)
+        if db.pool.thread_bound:
+            # Can't be used by other threads, closed when owner died
+            self.assertEqual(stats["idle"], 0)
+        else:
+            self.failUnless(stats["created"] <= 2)
+
+    def testReclaimUnbounded(self):
+        db = self.db_c
+        thread = threading.Thread(target=db.checkout)
+        thread.start()
+        thread.join()
+        self.assertEqual(db.pool.statistics()["in_use"], 1)
+        self.assert_(self.lastLog().startswith(
+                "WARNING: Reclaiming connection from dead thread"))
+
+    def testTransactionGivesBack(self):
+        db = self.db_c
+        def work():
+            transaction = db.transaction()
+            self.Database._execute("UPDATE county SET county_name='X'")
+            transaction.rollback()
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertEqual(db.pool.statistics()["in_use"], 1)
+        self.assertEqual(self.lastLog(), "")
+
+    def testNotBuffered(self):
+        db = self.db_c
+        connections = []
+        def work():
+            rows = self.Database._query("SELECT * FROM county")
+            rows.next()
+            # Still reading from the cursor
+            connections.append(db.connection)
+            list(rows)
+            connections.append(db.connection)
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertNotEqual(connections[0], None)
+        self.assertEqual(connections[1], None)
+        self.assertEqual(db.pool.statistics()["in_use"], 1)
+
+    def testStreamAbandoned(self):
+        db = self.db_c
+        connections = []
+        def work():
+            rows = self.Database._query("SELECT * FROM county", 
+                                        stream=True)
+            rows.next()
+            connections.append(db.connection)
+            del rows
+            # Given back although not all rows were read
+            connections.append(db.connection)
+            try:
+                for row in self.Database._query("SELECT * FROM county",
+                                                stream=True):
+                    raise ValueError
+            except ValueError:
+                pass
+            connections.append(db.connection)
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertNotEqual(connections[0], None)
+        self.assertEqual(connections[1:], [None, None])
+        self.assertEqual(db.pool.statistics()["in_use"], 1)
+
+    def testCheckout(self):
+        db = self.db_c
+        db.release()
+        self.assertEqual(db.connection, None)
+        checkout = db.checkout()
+        self.assertEqual(checkout.connection, db.connection)
+        # Nested checkout keeps the connection
+        db.checkout().close()
+        self.assertEqual(checkout.connection, db.connection)
+        checkout.close()
+        self.assertEqual(db.connection, None)
+        self.assertEqual(db.pool.statistics()["idle"], 1)
+
 class TestDatabase(TestFramework):
     
     def testQuery(self):
@@ -328,6 +543,19 @@ class TestDatabase(TestFramework):
         should_be = [{"county_id": x} for x in range(1,24) if x != 13]
         self.assertEqual(list(res), should_be)
 
+    def testQueryStream(self):
+        self.Database._db.arraysize = 3
+        res = self.Database._query("SELECT county_id FROM county "
+                                   "ORDER BY county_id", stream=True)
+        self.assertEqual([row["county_id"] for row in res],
+                         range(1, 13) + range(14, 24))
+        # fetchmany() with arraysize
+        cursor = self.Database._db.cursor(stream=True)
+        self.assertEqual(cursor.arraysize, 3)
+        cursor.execute("SELECT county_id FROM county")
+        rows = list(self.Database._iter_cursor(cursor, stream=True))
+        self.assertEqual(len(rows), 22)
+
     def testQueryOne(self):
         res = self.Database._query_one("SELECT 1+1 AS mysum")
         self.assertEqual(res, {'mysum': 2})
@@ -388,6 +616,94 @@ class TestTableBuilder(TestFramework):
         self.assertEqual(Set(Municipal._foreigns),
                          Set(("county_id",)))
 
+    def testDeclaredForeign(self):
+        self.builder._execute("""CREATE TABLE store (
+            store_id INTEGER NOT NULL PRIMARY KEY,
+            zip INTEGER,
+            owner_id INTEGER,
+            municipal_id INTEGER,
+            FOREIGN KEY (zip) REFERENCES postal(postal_no),
+            FOREIGN KEY (owner_id) REFERENCES county(county_id))""")
+        try:
+            self.builder._execute("INSERT INTO store "
+                                  "VALUES (1, 4001, 11, 1103)")
+            self.builder.build_tables()
+            Store = self.builder.tables["store"]
+            Postal = self.builder.tables["postal"]
+            County = self.builder.tables["county"]
+            Municipal = self.builder.tables["municipal"]
+            self.assertEqual(Store._foreigns, {"zip": Postal, 
+                                               "owner_id": County,
+                                               "municipal_id": Municipal})
+            self.assertEqual(Store._references, {"owner_id": "county_id",
+                                                 "zip": "postal_no"})
+            store = Store(store_id=1)
+            self.assertEqual(store.get_zip().postal_no, 4001)
+            self.assertEqual(store.get_owner().county_id, 11)
+            self.assertEqual(store.get_municipal().municipal_id, 1103)
+            store.set_owner(County(county_id=1))
+            self.assertEqual(store.owner_id, 1)
+            store.save()
+            county = County(county_id=1)
+            self.assertEqual([s.store_id 
+                              for s in county.get_stores_by_owner()], [1])
+            stores = list(Store.where(prefetch=("zip", "owner")))
+            self.assertEqual(stores[0].get_zip().postal_no, 4001)
+            # Without guessing by the name
+            self.builder.guess_foreign = False
+            self.builder.build_tables()
+            Store = self.builder.tables["store"]
+            self.assertEqual(Set(Store._foreigns), Set(["zip", "owner_id"]))
+            # Through the schema cache
+            builder = self.TableBuilder()
+            builder.build_schema(self.builder.schema())
+            Store = builder.tables["store"]
+            self.assertEqual(Store._references, {"owner_id": "county_id",
+                                                 "zip": "postal_no"})
+        finally:
+            self.builder._execute("DROP TABLE store")
+
+    def testSchemaCache(self):
+        import tempfile
+        cache = tempfile.mktemp()
+        try:
+            self.builder.build_tables(cache=cache)
+            self.failUnless(os.path.exists(cache))
+            schema = self.builder.schema()
+            investigated = []
+            class TB(self.TableBuilder):
+                def find_fields(self, table_name):
+                    investigated.append(table_name)
+                    return super(TB, self).find_fields(table_name)
+            builder = TB()
+            builder.build_tables(cache=cache)
+            self.assertEqual(investigated, [])
+            self.assertEqual(builder.schema(), schema)
+            Postal = builder.tables["postal"]
+            Municipal = builder.tables["municipal"]
+            self.assertEqual(Postal._foreigns, {"municipal_id": Municipal})
+            municipal = Postal(postal_no=4001).get_municipal()
+            self.assertEqual(municipal.municipal_id, 1103)
+            self.failUnless(hasattr(Municipal, "get_postals"))
+
+            # A changed schema is investigated again
+            self.builder._execute("CREATE TABLE fish (fish_id INTEGER)")
+            builder = TB()
+            builder.build_tables(cache=cache)
+            self.failUnless("fish" in builder.tables)
+            self.failUnless(investigated)
+
+            # And a broken cache is ignored
+            open(cache, "wb").write("garbage")
+            del investigated[:]
+            builder = TB()
+            builder.build_tables(cache=cache)
+            self.failUnless("fish" in builder.tables)
+            self.failUnless(investigated)
+            self.failUnless("broken schema cache" in self.lastLog())
+        finally:
+            os.unlink(cache)
+
 class TestBuiltClass(TestFramework):
     def setUp(self):
         super(TestBuiltClass, self).setUp()
@@ -494,6 +810,80 @@ class TestBuiltClass(TestFramework):
         # Only one row, and it should be county_id=3    
         self.assertEqual(result, [3])
 
+    def testWhereStream(self):
+        Postal = self.builder.tables["postal"]
+        self.db_c.arraysize = 7
+        streamed = [p.postal_no for p in Postal.where(stream=True)]
+        self.assertEqual(streamed, [p.postal_no for p in Postal])
+        streamed = [p.postal_no for p in Postal.where(municipal_id=1103,
+                                                     stream=True)]
+        self.assertEqual(Set(streamed), 
+                         Set([p.postal_no for p in 
+                              Postal.where(municipal_id=1103)]))
+
+    def picklable(self, table):
+        # pickle finds the class by module and name
+        table.__module__ = __name__
+        table.__name__ = "Pickled%s" % table.__name__
+        globals()[table.__name__] = table
+
+    def testNoSlots(self):
+        Postal = self.builder.tables["postal"]
+        self.picklable(Postal)
+        svg = Postal(postal_no=4001)
+        svg.note = "x"
+        for protocol in (0, 1, 2):
+            copy = pickle.loads(pickle.dumps(svg, protocol))
+            self.assertEqual(copy.postal_name, "STAVANGER")
+            self.assertEqual(copy.note, "x")
+
+    def testSlots(self):
+        self.builder.slots = True
+        Postal = self.builder.build_table("postal")
+        self.assertEqual(Set(Postal.__slots__), Set(Postal._fields))
+        svg = Postal(postal_no=4001)
+        self.failIf(hasattr(svg, "__dict__"))
+        self.assertRaises(AttributeError, setattr, svg, "postal_nr", 4002)
+        new = Postal()
+        self.failIf(hasattr(new, "postal_name"))
+
+    def testSlotsPickle(self):
+        self.builder.slots = True
+        Postal = self.builder.build_table("postal")
+        self.picklable(Postal)
+        svg = Postal(postal_no=4001)
+        svg.postal_name = "SVG"
+        for protocol in (0, 1, 2):
+            copy = pickle.loads(pickle.dumps(svg, protocol))
+            self.assertEqual(copy.postal_name, "SVG")
+            self.assertEqual(copy.changed(), ["postal_name"])
+            self.assertEqual(copy._primary_values, svg._primary_values)
+
+    def testSlotsFallback(self):
+        self.builder.slots = True
+        self.assertEqual(self.builder._slots(["postal_no", u"postal_name"]),
+                         ("postal_no", "postal_name"))
+        # Not identifiers, or hiding methods, go in __dict__
+        self.assertEqual(self.builder._slots(["postal no", "save", "x"]),
+                         ("__dict__", "x"))
+        self.builder.slots = False
+        self.assertEqual(self.builder._slots(["postal_no"]), ("__dict__",))
+        Postal = self.builder.build_table("postal")
+        svg = Postal(postal_no=4001)
+        svg.something = "else"
+        self.assertEqual(svg.postal_name, "STAVANGER")
+
+    def testInstancesOverridden(self):
+        Postal = self.builder.tables["postal"]
+        loaded = []
+        class MyPostal(Postal):
+            def _load(self, _db_row=None, reload=False, **primary):
+                loaded.append(_db_row)
+                Postal._load(self, _db_row, reload, **primary)
+        postals = list(MyPostal.where(municipal_id=1103))
+        self.assertEqual(len(loaded), len(postals))
+        self.assertEqual(loaded[0]["postal_no"], postals[0].postal_no)
+
     def testGet(self):
         County = self.builder.tables["county"]      
         county = County.get("county_name=$name",
@@ -562,6 +952,53 @@ class TestSave(TestFramework):
         ins.save()
         self.assert_(ins.insertion_id > 0)
 
+    def testSaveMany(self):
+        p1 = self.Postal()
+        p1.postal_no = 9998
+        p1.postal_name = "Ingenmannsland"
+        p1.municipal_id = 1103
+        p2 = self.Postal()
+        p2.postal_no = 9999
+        p2.municipal_id = 1103
+        svg = self.Postal(postal_no=4001)
+        svg.postal_name = "Nesten Stavanger"
+        self.assertEqual(self.Postal.save_many([p1, p2, svg]), 3)
+        self.assertEqual(self.Postal(postal_no=9998).postal_name,
+                         "Ingenmannsland")
+        self.assertEqual(self.Postal(postal_no=9999).postal_name, None)
+        self.assertEqual(self.Postal(postal_no=4001).postal_name,
+                         "Nesten Stavanger")
+        # Not reloaded, so no default value
+        self.failIf(hasattr(p2, "is_pobox"))
+        # but can be updated
+        p2.postal_name = "Fjosk"
+        self.Postal.save_many([p2], reload=True)
+        self.assertEqual(p2.is_pobox, 0)
+        self.assertEqual(self.Postal(postal_no=9999).postal_name, "Fjosk")
+        # Nothing changed
+        self.assertEqual(self.Postal.save_many([p1, p2, svg]), 0)
+        
+    def testSaveManyAutoincrement(self):
+        old = self.Insertion()
+        old.value = "old"
+        old.save()
+        insertions = []
+        for value in ("fish", "cod", "salmon"):
+            ins = self.Insertion()
+            ins.value = value
+            insertions.append(ins)
+        self.Insertion.save_many(insertions)
+        ids = [ins.insertion_id for ins in insertions]
+        self.assertEqual(ids, range(old.insertion_id+1, 
+                                    old.insertion_id+4))
+        for ins in insertions:
+            self.assertEqual(self.Insertion(insertion_id=ins.insertion_id)
+                                .value, ins.value)
+
+    def testSaveManyWrongClass(self):
+        self.assertRaises(ProgrammingError, self.Postal.save_many, 
+                          [self.Insertion()])
+
     def testUpdatePrimary(self):     
         p = self.Postal()
         p.postal_no = 9999
@@ -581,9 +1018,983 @@ class TestSave(TestFramework):
         p.municipal_id = 1103
         p.save()
         self.builder._execute("DELETE FROM postal WHERE postal_no=9999")
+        p.postal_name = "Ingenting"
         # Should fail
         self.assertRaises(NotFoundError, p.save)
 
+    def testChanged(self):
+        Postal = self.builder.tables["postal"]
+        p = Postal(postal_no=4001)
+        self.assertEqual(p.changed(), [])
+        p.postal_name = "STAVANGER"
+        self.assertEqual(p.changed(), ["postal_name"])
+        p.undo()
+        self.assertEqual(p.changed(), [])
+        new = Postal()
+        new.postal_no = 9999
+        self.assertEqual(new.changed(), ["postal_no"])
+        new.undo()
+        self.assertEqual(new.changed(), [])
+
+    def testSaveOnlyChanged(self):
+        Postal = self.builder.tables["postal"]
+        p = Postal(postal_no=4001)
+        # Nothing changed, nothing done
+        self.assertEqual(p.save(), 0)
+        # Changed behind our back, should not be overwritten
+        self.builder._execute("UPDATE postal SET municipal_id=1 "
+                              "WHERE postal_no=4001")
+        p.postal_name = "SVG"
+        p.save()
+        self.assertEqual(p.changed(), [])
+        self.assertEqual(p.municipal_id, 1)
+        self.assertEqual(p.postal_name, "SVG")
+
+    def testSaveNoReload(self):
+        Postal = self.builder.tables["postal"]
+        p = Postal(postal_no=4001)
+        self.builder._execute("UPDATE postal SET municipal_id=1 "
+                              "WHERE postal_no=4001")
+        p.postal_name = "SVG"
+        p.save(reload=False)
+        self.assertEqual(p.changed(), [])
+        self.assertEqual(p.municipal_id, 1103)
+        self.assertEqual(Postal(postal_no=4001).postal_name, "SVG")
+        p = Postal()
+        p.postal_no = 9999
+        p.postal_name = "Ingenmannsland"
+        p.municipal_id = 1103
+        p.save(reload=False)
+        self.failIf(hasattr(p, "is_pobox"))
+        self.assertEqual(Postal(postal_no=9999).postal_name, 
+                         "Ingenmannsland")
+
+class TestTransaction(TestFramework):
+    def setUp(self):
+        super(TestTransaction, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+        if isinstance(self.db_connect, dict):
+            self.other = self.db.connect(**self.db_connect) 
+        else:    
+            self.other = self.db.connect(*self.db_connect) 
+
+    def tearDown(self):
+        self.other.close()
+        super(TestTransaction, self).tearDown()
+
+    def committed(self, postal_no):
+        """postal_name as seen by another connection"""
+        c = self.other.cursor()
+        c.execute("SELECT postal_name FROM postal WHERE postal_no=%s" % 
+                  postal_no)
+        name = c.fetchone()[0]
+        self.other.rollback()
+        return name
+
+    def rename(self, postal_no, name):
+        self.Postal.update_where({"postal_name": name}, postal_no=postal_no)
+
+    def testCommit(self):
+        transaction = self.db_c.transaction()
+        self.assertEqual(transaction.savepoint, None)
+        self.rename(4001, "SVG")
+        self.assertEqual(self.committed(4001), "STAVANGER")
+        transaction.commit()
+        self.assertEqual(self.committed(4001), "SVG")
+        self.assertRaises(ProgrammingError, transaction.commit)
+
+    def testContextManager(self):
+        transaction = self.db_c.transaction()
+        self.assertEqual(transaction.__enter__(), transaction)
+        self.rename(4001, "SVG")
+        transaction.__exit__(NotFoundError, NotFoundError(), None)
+        self.assertEqual(self.Postal(postal_no=4001).postal_name, 
+                         "STAVANGER")
+        transaction = self.db_c.transaction()
+        self.rename(4001, "SVG")
+        transaction.__exit__(None, None, None)
+        self.assertEqual(self.committed(4001), "SVG")
+
+    def testSavepoint(self):
+        outer = self.db_c.transaction()
+        self.rename(4001, "SVG")
+        inner = self.db_c.transaction()
+        self.assertEqual(inner.savepoint, "forgetsql_1")
+        self.rename(4002, "SVG2")
+        self.assertRaises(ProgrammingError, outer.commit)
+        inner.rollback()
+        self.assertEqual(self.Postal(postal_no=4002).postal_name, 
+                         "STAVANGER")
+        inner = self.db_c.transaction()
+        self.rename(4003, "SVG3")
+        inner.commit()
+        outer.commit()
+        self.assertEqual(self.committed(4001), "SVG")
+        self.assertEqual(self.committed(4002), "STAVANGER")
+        self.assertEqual(self.committed(4003), "SVG3")
+
+    def testCommitEvery(self):
+        transaction = self.db_c.transaction(commit_every=3)
+        for n in range(7):
+            self.rename(4001, "SVG%s" % n)
+            # Queries are not counted
+            self.Postal(postal_no=4001)
+        self.assertEqual(transaction.commits, 2)
+        self.assertEqual(self.committed(4001), "SVG5")
+        transaction.rollback()
+        self.assertEqual(self.committed(4001), "SVG5")
+        self.assertEqual(self.db_c._batching, 0)
+
+    def testCommitEveryReturning(self):
+        transaction = self.db_c.transaction(commit_every=2)
+        # As INSERT ... RETURNING, counted although it returns rows
+        self.Postal._execute("SELECT 1", write=True)
+        self.Postal._execute("SELECT 1")
+        self.assertEqual(transaction.commits, 0)
+        self.Postal._execute("SELECT 1", write=True)
+        self.assertEqual(transaction.commits, 1)
+        transaction.rollback()
+
+    def testCommitEverySavepoint(self):
+        transaction = self.db_c.transaction(commit_every=2)
+        inner = self.db_c.transaction()
+        for n in range(3):
+            self.rename(4001, "SVG%s" % n)
+        self.assertEqual(transaction.commits, 0)
+        inner.commit()
+        self.rename(4002, "SVG")
+        self.assertEqual(transaction.commits, 1)
+        self.assertEqual(self.committed(4002), "SVG")
+        transaction.commit()
+
+    def testRelease(self):
+        connection = self.db_c.connection
+        level = getattr(connection, "isolation_level", None)
+        self.db_c.transaction()
+        self.db_c.transaction()
+        self.rename(4001, "SVG")
+        self.assertRaises(ProgrammingError, self.db_c.commit)
+        self.db_c.release()
+        self.assertEqual(self.db_c._transactions(), [])
+        self.assertEqual(getattr(connection, "isolation_level", None), 
+                         level)
+        self.assertEqual(self.Postal(postal_no=4001).postal_name, 
+                         "STAVANGER")
+
+    def testCommitRollback(self):
+        self.rename(4001, "SVG")
+        self.db_c.rollback()
+        self.assertEqual(self.committed(4001), "STAVANGER")
+        self.rename(4001, "SVG")
+        self.db_c.commit()
+        self.assertEqual(self.committed(4001), "SVG")
+
+class TestBulk(TestFramework):
+    def setUp(self):
+        super(TestBulk, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+
+    def testDeleteWhere(self):
+        count = self.Postal.select(municipal_id=1103).count()
+        self.assertEqual(self.Postal.delete_where(municipal_id=1103), count)
+        self.failIf(self.Postal.select(municipal_id=1103).exists())
+        self.assertEqual(self.Postal.delete_where("postal_no < $no", 
+                                                  no=4000),
+                         len([p for p in self.Postal if p.postal_no < 4000]))
+        self.failIf(self.Postal.select("postal_no < 4000").exists())
+        self.assertRaises(ProgrammingError, self.Postal.delete_where)
+        self.assertRaises(ProgrammingError, self.Postal.delete_where,
+                          postal_nr=4001)
+        # A blank where clause is not "1=1"
+        self.assertRaises(ProgrammingError, self.Postal.delete_where, "")
+        self.assertRaises(ProgrammingError, self.Postal.delete_where, " ",
+                          postal_no=4001)
+        self.assert_(self.Postal.select().exists())
+        self.Postal.delete_where("1=1")
+        self.assertEqual(self.Postal.select().count(), 0)
+
+    def testUpdateWhere(self):
+        count = self.Postal.select(municipal_id=1103).count()
+        self.assertEqual(self.Postal.update_where({"postal_name": "X",
+                                                   "is_pobox": False},
+                                                  municipal_id=1103),
+                         count)
+        for postal in self.Postal.where(municipal_id=1103):
+            self.assertEqual(postal.postal_name, "X")
+        # A value parameter may have the same name as a where parameter
+        self.Postal.update_where({"municipal_id": 1}, 
+                                 "municipal_id=$municipal_id",
+                                 municipal_id=1103)
+        self.assertEqual(self.Postal.select(municipal_id=1).count(), count)
+        self.assertRaises(ProgrammingError, self.Postal.update_where, 
+                          {"postal_nr": 1}, municipal_id=1)
+        self.assertRaises(ProgrammingError, self.Postal.update_where, 
+                          {}, municipal_id=1)
+        self.assertRaises(ProgrammingError, self.Postal.update_where, 
+                          {"postal_name": "Y"}, "")
+        self.failIf(self.Postal.select(postal_name="Y").exists())
+
+    def testIdentityMap(self):
+        self.db_c.use_identity_map()
+        svg = self.Postal(postal_no=4001)
+        self.Postal.update_where({"postal_name": "SVG"}, postal_no=4001)
+        fresh = self.Postal(postal_no=4001)
+        self.failIf(fresh is svg)
+        self.assertEqual(fresh.postal_name, "SVG")
+        self.Postal.delete_where(postal_no=4001)
+        self.assertRaises(NotFoundError, self.Postal, postal_no=4001)
+
+class TestQuery(TestFramework):
+    def setUp(self):
+        super(TestQuery, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+        self.postals = [(p.postal_name, p.postal_no) for p in self.Postal]
+        self.postals.sort()
+
+    def testOrderLimit(self):
+        query = self.Postal.select().order_by("-postal_no").limit(3)
+        numbers = [p.postal_no for p in self.Postal]
+        numbers.sort()
+        numbers.reverse()
+        self.assertEqual([p.postal_no for p in query], numbers[:3])
+        self.assertEqual([p.postal_no for p in query.offset(2)], 
+                         numbers[2:5])
+        # Offset without limit
+        query = self.Postal.select().order_by("-postal_no").offset(4)
+        self.assertEqual([p.postal_no for p in query], numbers[4:])
+
+    def testOrderLimitStable(self):
+        # Many postals have the same municipal_id
+        query = self.Postal.select().order_by("municipal_id").limit(7)
+        sql, parameters = query.offset(7)._sql()
+        self.failUnless("ORDER BY municipal_id,postal_no LIMIT" in sql)
+        paged = []
+        page = list(query)
+        while page:
+            paged.extend([p.postal_no for p in page])
+            page = list(query.offset(len(paged)))
+        numbers = [p.postal_no for p in self.Postal]
+        numbers.sort()
+        paged.sort()
+        self.assertEqual(paged, numbers)
+
+    def testWhere(self):
+        query = self.Postal.select(municipal_id=1103)
+        self.assertEqual(Set([p.postal_no for p in query]),
+                         Set([p.postal_no for p in 
+                              self.Postal.where(municipal_id=1103)]))
+        query = query.where("postal_no > $no", no=4010)
+        for postal in query:
+            self.assertEqual(postal.municipal_id, 1103)
+            self.failUnless(postal.postal_no > 4010)
+        self.assertRaises(ProgrammingError, self.Postal.select, 
+                          postal_nr=4001)
+
+    def testOnly(self):
+        query = self.Postal.select(postal_no=4001).only("postal_name")
+        svg, = list(query)
+        self.assertEqual(svg.postal_name, "STAVANGER")
+        self.failIf(hasattr(svg, "municipal_id"))
+        svg.postal_name = "SVG"
+        svg.save()
+        self.assertEqual(svg.municipal_id, 1103)
+        self.assertEqual(self.Postal(postal_no=4001).postal_name, "SVG")
+        self.assertRaises(ProgrammingError, query.only, "postal_nr")
+
+    def testOnlyIdentityMap(self):
+        self.db_c.use_identity_map()
+        svg, = list(self.Postal.select(postal_no=4001).only("postal_name"))
+        self.failIf(self.Postal(postal_no=4001) is svg)
+        full = self.Postal(postal_no=4001)
+        svg, = list(self.Postal.select(postal_no=4001).only("postal_name"))
+        self.failUnless(svg is full)
+
+    def testAfter(self):
+        page = self.Postal.select().order_by("postal_name").limit(50)
+        postals = list(page)
+        seen = []
+        while postals:
+            self.failIf(len(postals) > 50)
+            seen.extend([(p.postal_name, p.postal_no) for p in postals])
+            postals = list(page.after(postals[-1]))
+        self.assertEqual(seen, self.postals)
+        # By tuple of (postal_name, postal_no)
+        after = list(page.after(self.postals[10]))
+        self.assertEqual([(p.postal_name, p.postal_no) for p in after],
+                         self.postals[11:61])
+        self.assertRaises(ProgrammingError, list, page.after(("x",)))
+
+    def testAfterDescending(self):
+        page = self.Postal.select().order_by("-postal_name").limit(7)
+        seen = []
+        postals = list(page)
+        while postals:
+            seen.extend([(p.postal_name, p.postal_no) for p in postals])
+            postals = list(page.after(postals[-1]))
+        # postal_no is still ascending
+        expected = self.postals[:]
+        expected.sort(lambda a, b: cmp(b[0], a[0]) or cmp(a[1], b[1]))
+        self.assertEqual(seen, expected)
+
+    def testCount(self):
+        self.assertEqual(self.Postal.select().count(), len(self.postals))
+        query = self.Postal.select(municipal_id=1103)
+        self.assertEqual(query.count(), len(list(query)))
+        self.assertEqual(query.limit(2).count(), 2)
+        self.assertEqual(query.offset(1).count(), len(list(query)) - 1)
+        self.failUnless(query.exists())
+        self.failIf(self.Postal.select(postal_no=9999).exists())
+
+class TestExecutor(TestFramework):
+    def setUp(self):
+        super(TestExecutor, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+
+    def testSubmit(self):
+        future = self.db_c.submit(self.Postal.select().count)
+        self.assertEqual(future.result(), 
+                         len(list(self.Postal.where())))
+        self.failUnless(future.done())
+        self.assertEqual(future.exception(), None)
+        self.assertEqual(self.db_c.executor().workers, 
+                         self.db_c.workers)
+
+    def testException(self):
+        future = self.db_c.submit(self.Postal, postal_no=9999)
+        self.assertRaises(NotFoundError, future.result)
+        self.failUnless(isinstance(future.exception(), NotFoundError))
+
+    def testTimeout(self):
+        event = threading.Event()
+        future = self.db_c.submit(event.wait)
+        self.assertRaises(FutureTimeoutError, future.result, 0.01)
+        event.set()
+        future.result()
+
+    def testCallback(self):
+        done = []
+        event = threading.Event()
+        future = self.db_c.submit(event.wait)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [])
+        event.set()
+        future.result()
+        # Called before result() returns, or by add_done_callback()
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def testBounded(self):
+        self.db_c.workers = 2
+        running = []
+        most = []
+        lock = threading.Lock()
+        def work():
+            lock.acquire()
+            running.append(1)
+            most.append(len(running))
+            lock.release()
+            time.sleep(0.01)
+            self.Postal(postal_no=4001)
+            lock.acquire()
+            running.pop()
+            lock.release()
+        futures = [self.db_c.submit(work) for n in range(8)]
+        for future in futures:
+            future.result()
+        self.assertEqual(max(most), 2)
+
+    def testAsync(self):
+        future = self.Postal.async_where(municipal_id=1103)
+        self.assertEqual(Set([p.postal_no for p in future.result()]),
+                         Set([p.postal_no for p in 
+                              self.Postal.where(municipal_id=1103)]))
+        svg = self.Postal(postal_no=4001)
+        svg.postal_name = "SVG"
+        svg.async_save().result()
+        self.assertEqual(svg.changed(), [])
+        # Committed by the worker
+        self.assertEqual(self.Postal(postal_no=4001).postal_name, "SVG")
+
+    def testRollback(self):
+        def fail():
+            self.builder._execute("DELETE FROM postal")
+            raise NotFoundError
+        self.assertRaises(NotFoundError, self.db_c.submit(fail).result)
+        self.failUnless(self.Postal.select().exists())
+
+class TestListeners(TestFramework):
+    def setUp(self):
+        super(TestListeners, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+
+    def testFingerprint(self):
+        self.assertEqual(fingerprint("SELECT * FROM postal\n WHERE "
+                                     "postal_no IN (?, ?, ?) AND x='y'"),
+                         "SELECT * FROM postal WHERE postal_no IN (?...) "
+                         "AND x=?")
+        self.assertEqual(fingerprint("SELECT 1+1 FROM t2 WHERE a=%s"),
+                         "SELECT ?+? FROM t2 WHERE a=?")
+
+    def testEvents(self):
+        events = []
+        class Recorder(Listener):
+            def executed(self, event):
+                events.append(("executed", event.rows, event))
+            def fetched(self, event):
+                events.append(("fetched", event.rows, event))
+        recorder = Recorder()
+        self.db_c.add_listener(recorder)
+        postals = list(self.Postal.where(municipal_id=1103))
+        self.builder._execute("UPDATE postal SET postal_name='X' "
+                              "WHERE postal_no=4001")
+        self.db_c.remove_listener(recorder)
+        self.Postal(postal_no=4001)
+        self.assertEqual([(name, rows) for (name, rows, e) in events],
+                         [("executed", None), ("fetched", len(postals)),
+                          ("executed", 1)])
+        event = events[0][2]
+        self.assertEqual(event.parameters, {"municipal_id": 1103})
+        self.assertEqual(event.fingerprint, 
+                         "SELECT * FROM postal WHERE municipal_id=?")
+        self.failUnless(event.seconds >= 0)
+        self.assertEqual(event.thread, threading.currentThread())
+
+    def testWait(self):
+        events = []
+        class Recorder(Listener):
+            def executed(self, event):
+                events.append(event)
+        self.db_c.add_listener(Recorder())
+        self.db_c.release()
+        # Checked out by the statement
+        self.Postal(postal_no=4001)
+        checkout = self.db_c.checkout()
+        self.Postal(postal_no=4001)
+        checkout.close()
+        self.failUnless(events[0].wait > 0)
+        self.assertEqual(events[1].wait, 0.0)
+
+    def testWaitNotTimed(self):
+        events = []
+        class Recorder(Listener):
+            def executed(self, event):
+                events.append(event)
+        self.db_c.add_listener(Recorder())
+        self.db_c.release()
+        pool = self.db_c.pool
+        def acquire(acquire=pool.acquire):
+            # As if waiting for another thread
+            time.sleep(0.2)
+            return acquire()
+        pool.acquire = acquire
+        try:
+            self.Postal(postal_no=4001)
+        finally:
+            del pool.acquire
+        self.failUnless(events[0].seconds < 0.2)
+
+    def testReleasedAuto(self):
+        released = []
+        class Recorder(Listener):
+            def released(self):
+                released.append(threading.currentThread())
+        self.db_c.add_listener(Recorder())
+        def work():
+            self.Postal(postal_no=4001)
+            self.Postal(postal_no=4001)
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        # Once for each connection given back
+        self.assertEqual(released, [thread, thread])
+
+    def testStatistics(self):
+        statistics = Statistics()
+        self.db_c.add_listener(statistics)
+        for no in (4001, 4002, 4003):
+            self.Postal(postal_no=no)
+        list(self.Postal.where(municipal_id=1103))
+        report = statistics.report()
+        self.assertEqual(len(report), 2)
+        load = [r for r in report if r["count"] == 3][0]
+        self.assertEqual(load["fingerprint"], 
+                         "SELECT * FROM postal WHERE postal_no=?")
+        self.failUnless(load["p50"] <= load["p99"])
+        where = [r for r in report if r["count"] == 1][0]
+        self.assertEqual(where["rows"], 
+                         len(list(self.Postal.where(municipal_id=1103))))
+        statistics.clear()
+        self.assertEqual(statistics.report(), [])
+
+    def testSlowQueryLog(self):
+        self.db_c.add_listener(SlowQueryLog(0))
+        self.Postal(postal_no=4001)
+        self.failUnless(self.lastLog().startswith("WARNING: Slow query"))
+        self.db_c.listeners[0].threshold = 10
+        self.Postal(postal_no=4001)
+        self.assertEqual(self.lastLog(), "")
+
+    def testNPlusOne(self):
+        self.db_c.add_listener(NPlusOneDetector(threshold=3))
+        for postal in self.Postal.where(municipal_id=1103):
+            postal.get_municipal()
+        log = self.lastLog()
+        self.assertEqual(log.count("\n"), 1)
+        self.failUnless("3 times in one request: SELECT * FROM municipal" 
+                        in log)
+        # A new request
+        self.db_c.release()
+        self.Postal(postal_no=4001).get_municipal()
+        self.assertEqual(self.lastLog(), "")
+
+    def testNPlusOneSettled(self):
+        self.db_c.add_listener(NPlusOneDetector(threshold=3))
+        for n in range(4):
+            self.Postal(postal_no=4001).get_municipal()
+            # Each commit starts a new request
+            self.db_c.commit()
+        self.assertEqual(self.lastLog(), "")
+
+    def testNPlusOneSize(self):
+        self.db_c.add_listener(NPlusOneDetector(threshold=3, size=1))
+        for n in range(4):
+            self.Postal(postal_no=4001)
+            self.Postal(postal_no=4001).get_municipal()
+        self.assertEqual(self.lastLog(), "")
+
+class TestReplicas(TestFramework):
+    def setUp(self):
+        super(TestReplicas, self).setUp()
+        self.replica_info = self.db_connect
+        if self.db_mod == "sqlite":
+            # A copy that can be told apart from the primary
+            self.replica_info = self.db_connect.copy()
+            self.replica_info["database"] += "-replica"
+            shutil.copy(self.db_connect["database"], 
+                        self.replica_info["database"])
+            db = self.db.connect(self.replica_info["database"])
+            db.execute("UPDATE postal SET postal_name='REPLICA'")
+            db.commit()
+            db.close()
+        self.replica = self.db_c.add_replica(self.replica_info)
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+        self.db_c.release()
+
+    def tearDown(self):
+        super(TestReplicas, self).tearDown()
+        if self.db_mod == "sqlite":
+            os.unlink(self.replica_info["database"])
+
+    def testRead(self):
+        svg = self.Postal(postal_no=4001)
+        if self.db_mod == "sqlite":
+            self.assertEqual(svg.postal_name, "REPLICA")
+        # Given back after reading
+        self.assertEqual(self.replica.statistics()["in_use"], 0)
+        # Only reads go to the replica
+        self.Postal._execute("SELECT 1")
+        self.assertEqual(self.replica.statistics()["checkouts"], 1)
+        rows = self.Postal.where(stream=True)
+        rows.next()
+        self.assertEqual(self.db_c.pool.statistics()["in_use"], 1)
+
+    def testQuery(self):
+        # Raw queries only go to the replica when asked to
+        sql = "SELECT * FROM postal WHERE postal_no=4001"
+        self.Postal._query_one(sql)
+        self.assertEqual(self.replica.statistics()["checkouts"], 0)
+        self.Postal._query_one(sql, replica=True)
+        self.assertEqual(self.replica.statistics()["checkouts"], 1)
+
+    def testReadYourWrites(self):
+        self.failUnless(self.db_c.read_replica())
+        svg = self.Postal(postal_no=4001)
+        svg.postal_name = "STAVANGER"
+        svg.save()
+        self.failIf(self.db_c.read_replica())
+        self.assertEqual(self.Postal.get(postal_no=4001).postal_name,
+                         "STAVANGER")
+        self.db_c.commit()
+        # Sticky for a while after committing
+        self.failIf(self.db_c.read_replica())
+        self.db_c.sticky = 0
+        self.failUnless(self.db_c.read_replica())
+        svg.postal_name = "SVG"
+        svg.save()
+        self.failIf(self.db_c.read_replica())
+        # Nothing to read after rolling back
+        self.db_c.rollback()
+        self.failUnless(self.db_c.read_replica())
+
+    def testTransaction(self):
+        transaction = self.db_c.transaction()
+        self.failIf(self.db_c.read_replica())
+        self.Postal(postal_no=4001)
+        self.assertEqual(self.replica.statistics()["checkouts"], 0)
+        transaction.rollback()
+        self.failUnless(self.db_c.read_replica())
+
+    def testRouting(self):
+        other = self.db_c.add_replica(self.replica_info)
+        for n in range(4):
+            self.Postal(postal_no=4001)
+            self.db_c.release()
+        self.assertEqual(self.replica.statistics()["checkouts"], 2)
+        self.assertEqual(other.statistics()["checkouts"], 2)
+        self.db_c.routing = "least-loaded"
+        entry = self.replica.acquire()
+        self.Postal(postal_no=4001)
+        self.assertEqual(other.statistics()["checkouts"], 3)
+        self.replica.release(entry)
+        self.db_c.release()
+
+class TestStatementCache(TestFramework):
+    def setUp(self):
+        super(TestStatementCache, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+
+    def testTranslate(self):
+        db = self.db_c
+        (sql, names, positional) = db.translate(
+                                   "SELECT * FROM postal WHERE postal_no=$no")
+        if db.type == "sqlite":
+            self.assertEqual(sql, "SELECT * FROM postal WHERE postal_no=?")
+        else:
+            self.assertEqual(sql, "SELECT * FROM postal WHERE postal_no=%s")
+        self.assertEqual(names, ("no",))
+        self.assert_(positional)
+        misses = db.cache_misses
+        hits = db.cache_hits
+        db.translate("SELECT * FROM postal WHERE postal_no=$no")
+        self.assertEqual(db.cache_misses, misses)
+        self.assertEqual(db.cache_hits, hits+1)
+
+    def testCompile(self):
+        sql = "SELECT * FROM t WHERE a=$a AND b=$b OR a=$a"
+        self.assertEqual(compile_sql(sql, "qmark"),
+            ("SELECT * FROM t WHERE a=? AND b=? OR a=?", 
+             ("a", "b", "a"), True))
+        self.assertEqual(compile_sql(sql, "format"),
+            ("SELECT * FROM t WHERE a=%s AND b=%s OR a=%s", 
+             ("a", "b", "a"), True))
+        self.assertEqual(compile_sql(sql, "numeric"),
+            ("SELECT * FROM t WHERE a=:1 AND b=:2 OR a=:1", 
+             ("a", "b"), True))
+        self.assertEqual(compile_sql(sql, "named"),
+            ("SELECT * FROM t WHERE a=:a AND b=:b OR a=:a", 
+             ("a", "b"), False))
+        self.assertEqual(compile_sql(sql, "pyformat"),
+            ("SELECT * FROM t WHERE a=%(a)s AND b=%(b)s OR a=%(a)s", 
+             ("a", "b"), False))
+
+    def testCompileLiterals(self):
+        sql = ("SELECT '$no', 'it''s $no', \"$no\" -- $no\n"
+               "FROM t /* $no */ WHERE x LIKE '10%' AND y=$yes")
+        self.assertEqual(compile_sql(sql, "qmark")[0], 
+                         sql.replace("$yes", "?"))
+        self.assertEqual(compile_sql(sql, "format")[0], 
+                         sql.replace("%", "%%").replace("$yes", "%s"))
+        # Without parameters, % is left for the module
+        self.assertEqual(compile_sql("SELECT '10%'", "format"), 
+                         ("SELECT '10%'", (), True))
+        self.assertEqual(compile_sql(r"SELECT 'a\'$no', $yes", "qmark", 
+                                     "mysql")[0], r"SELECT 'a\'$no', ?")
+        self.assertEqual(compile_sql("SELECT $$ $no $$, $t$$no$t$, $yes", 
+                                     "qmark", "postgresql")[0],
+                         "SELECT $$ $no $$, $t$$no$t$, ?")
+
+    def testLiteralsExecuted(self):
+        res = self.Postal._query_one("SELECT '$no %' AS text, $no AS no", 
+                                     {"no": 5})
+        self.assertEqual(res, {"text": "$no %", "no": 5})
+        if self.db_c.translate("SELECT $no")[2]:
+            # Positional parameters are looked up by us
+            self.assertRaises(ProgrammingError, self.Postal._query_one, 
+                              "SELECT $no AS no", {})
+
+    def testLoadHits(self):
+        db = self.db_c
+        self.Postal(postal_no=4001)
+        misses = db.cache_misses
+        hits = db.cache_hits
+        svg = self.Postal(postal_no=4001)
+        self.assertEqual(svg.postal_name, "STAVANGER")
+        self.assertEqual(db.cache_misses, misses)
+        self.assertEqual(db.cache_hits, hits+1)
+
+    def testWhereShape(self):
+        db = self.db_c
+        list(self.Postal.where(municipal_id=1103, is_pobox=False))
+        misses = db.cache_misses
+        # Same shape, keywords in other order
+        postals = list(self.Postal.where(is_pobox=False, 
+                                         municipal_id=1103))
+        self.assert_(postals)
+        self.assertEqual(db.cache_misses, misses)
+
+class TestResultCache(TestFramework):
+    def setUp(self):
+        super(TestResultCache, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+        self.db_c.use_result_cache()
+        self.Postal.cache_results(60)
+        self.results = self.db_c.results
+
+    def names(self):
+        return [postal.postal_name 
+                for postal in self.Postal.where(municipal_id=1103)]
+
+    def testCached(self):
+        names = self.names()
+        self.failUnless("STAVANGER" in names)
+        hits = self.results.hits
+        self.Postal._execute("UPDATE postal SET postal_name='SVG'")
+        self.db_c.commit()
+        self.assertEqual(self.names(), names)
+        self.assertEqual(self.results.hits, hits+2)
+        self.assertEqual(self.Postal.select(municipal_id=1103).count(),
+                         len(names))
+        self.db_c.invalidate("postal")
+        self.db_c.commit()
+        self.failUnless("SVG" in self.names())
+        self.failIf(self.Postal.get(postal_no=4001, stream=True) is None)
+
+    def testSave(self):
+        self.names()
+        svg = self.Postal(postal_no=4001)
+        svg.postal_name = "SVG"
+        svg.save()
+        # Not cached by the writer until committed
+        hits = self.results.hits
+        self.failUnless("SVG" in self.names())
+        self.failUnless("SVG" in self.names())
+        self.assertEqual(self.results.hits, hits)
+        self.db_c.commit()
+        self.failUnless("SVG" in self.names())
+        self.failUnless("SVG" in self.names())
+        self.assertEqual(self.results.hits, hits+3)
+        self.Postal.update_where({"postal_name": "STAVANGER"}, 
+                                 postal_no=4001)
+        self.db_c.commit()
+        self.failUnless("STAVANGER" in self.names())
+
+    def testNotCached(self):
+        self.Postal.cache_results(None)
+        self.names()
+        self.names()
+        self.assertEqual(self.results.hits, 0)
+
+    def testExpiry(self):
+        cache = ResultCache(10)
+        cache.set("forever", 1)
+        cache.set("brief", 2, 0.01)
+        self.assertEqual(cache.get("brief"), 2)
+        time.sleep(0.02)
+        self.assertEqual(cache.get("brief"), None)
+        self.assertEqual(cache.get("forever"), 1)
+        for n in range(20):
+            cache.set(n, n)
+        self.assert_(len(cache) <= 10)
+        self.assertEqual(cache.get(19), 19)
+
+class TestIdentityMap(TestFramework):
+    def setUp(self):
+        super(TestIdentityMap, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+        self.Municipal = self.builder.tables["municipal"]
+        self.db_c.use_identity_map()
+
+    def tearDown(self):
+        self.builder._execute("DELETE FROM postal WHERE postal_no=9999")
+        super(TestIdentityMap, self).tearDown()
+
+    def testSameInstance(self):
+        svg = self.Postal(postal_no=4001)
+        self.assert_(self.Postal(postal_no=4001) is svg)
+        self.assert_(self.Postal.get(postal_no=4001) is svg)
+        identities = self.db_c.identity_map()
+        self.assertEqual(identities.hits, 2)
+        self.assertEqual(identities.misses, 1)
+        # Wrong primary keys still fails
+        self.assertRaises(ProgrammingError, 
+                          self.Postal, postal_name="STAVANGER")
+
+    def testForeign(self):
+        municipals = [p.get_municipal() 
+                      for p in self.Postal.where(municipal_id=1103)]
+        self.assert_(len(municipals) > 40)
+        for municipal in municipals:
+            self.assert_(municipal is municipals[0])
+        identities = self.db_c.identity_map()
+        self.assertEqual(identities.hits, len(municipals) - 1)
+
+    def testSave(self):
+        p = self.Postal()
+        p.postal_no = 9998
+        p.municipal_id = 1103
+        p.save()
+        self.assert_(self.Postal(postal_no=9998) is p)
+        # Changed primary key
+        p.postal_no = 9999
+        p.save()
+        self.assert_(self.Postal(postal_no=9999) is p)
+        self.assertRaises(NotFoundError, self.Postal, postal_no=9998)
+
+    def testUndo(self):
+        svg = self.Postal(postal_no=4001)
+        svg.postal_name = "Fisk"
+        svg.undo()
+        self.assert_(self.Postal(postal_no=4001) is svg)
+        self.assertEqual(svg.postal_name, "STAVANGER")
+
+    def testEvict(self):
+        identities = IdentityMap(size=10)
+        for n in range(11):
+            identities.add(n, str(n))
+        self.assertEqual(len(identities), 9)
+        self.assertEqual(identities.get(0), None)
+        self.assertEqual(identities.get(10), "10")
+        identities.clear()
+        self.assertEqual(len(identities), 0)
+
+    def testShared(self):
+        identities = IdentityMap(size=10)
+        errors = []
+        def work(table):
+            try:
+                for n in range(2000):
+                    identities.add((table, n), n)
+                    identities.clear(table)
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(table,))
+                   for table in (self.Postal, self.Municipal, None)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def testPerThread(self):
+        self.db_c.use_identity_map(per_thread=True)
+        svg = self.Postal(postal_no=4001)
+        self.assert_(self.Postal(postal_no=4001) is svg)
+        other = []
+        def work():
+            other.append(self.Postal(postal_no=4001))
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.failIf(other[0] is svg)
+        # Cleared by release()
+        self.db_c.release()
+        self.failIf(self.Postal(postal_no=4001) is svg)
+
+    def testPerThreadForget(self):
+        self.db_c.use_identity_map(per_thread=True)
+        loaded = []
+        first = threading.Event()
+        forgot = threading.Event()
+        def work():
+            loaded.append(self.Postal(postal_no=4001))
+            first.set()
+            forgot.wait()
+            loaded.append(self.Postal(postal_no=4001))
+        thread = threading.Thread(target=work)
+        thread.start()
+        svg = self.Postal(postal_no=4001)
+        first.wait()
+        self.Postal.update_where(dict(postal_name="SVG"), postal_no=4001)
+        forgot.set()
+        thread.join()
+        # Cleared in the other thread as well
+        self.failIf(loaded[1] is loaded[0])
+        self.failIf(self.Postal(postal_no=4001) is svg)
+        self.db_c.rollback()
+
+    def testDisable(self):
+        self.db_c.use_identity_map(0)
+        self.assertEqual(self.db_c.identity_map(), None)
+        self.failIf(self.Postal(postal_no=4001) is 
+                    self.Postal(postal_no=4001))
+
+class TestPrefetch(TestFramework):
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        self.builder = self.TableBuilder()
+        self.builder.build_tables()
+        self.Postal = self.builder.tables["postal"]
+        self.Municipal = self.builder.tables["municipal"]
+
+    def statements(self):
+        # Every statement passes through the statement cache
+        return self.db_c.cache_hits + self.db_c.cache_misses
+
+    def testForeign(self):
+        postals = list(self.Postal.where("postal_no < 4400", 
+                                         prefetch=("municipal",)))
+        before = self.statements()
+        names = Set([p.get_municipal().municipal_name for p in postals])
+        self.assertEqual(self.statements(), before)
+        self.assert_("Stavanger" in names)
+        self.assert_("Sandnes" in names)
+        # Changing the foreign key gets the real one
+        svg = [p for p in postals if p.postal_no == 4001][0]
+        svg.municipal_id = 1102
+        self.assertEqual(svg.get_municipal().municipal_name, "Sandnes")
+        self.assertEqual(self.statements(), before+1)
+
+    def testChildren(self):
+        expected = {}
+        for municipal in self.Municipal.where(county_id=11):
+            expected[municipal.municipal_id] = Set(
+                [p.postal_no for p in municipal.get_postals()])
+        municipals = list(self.Municipal.where(county_id=11,
+                                               prefetch=["postals"]))
+        before = self.statements()
+        for municipal in municipals:
+            postals = [p.postal_no for p in municipal.get_postals()]
+            self.assertEqual(Set(postals), 
+                             expected[municipal.municipal_id])
+        self.assertEqual(self.statements(), before)
+
+    def testManyValues(self):
+        self.Postal._in_size = 7
+        postals = list(self.Postal.where("postal_no < 4400"))
+        self.Postal.prefetch(postals, "municipal")
+        for postal in postals:
+            self.assertEqual(postal.get_municipal().municipal_id,
+                             postal.municipal_id)
+
+    def testMissing(self):
+        postals = list(self.Postal.where(prefetch=("municipal",)))
+        missing = [p for p in postals if p._get_prefetched("municipal_id")
+                   is None]
+        self.assert_(missing)
+        self.assertRaises(NotFoundError, missing[0].get_municipal)
+
+    def testUnknown(self):
+        self.assertRaises(ProgrammingError, self.Postal.prefetch, 
+                          [], "fish")
+
 class TestGenerate(TestFramework):
     def testGenerate(self):
         db = generate(self.db, self.db_connect)
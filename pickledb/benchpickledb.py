@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# *-* encoding: utf8
+#
+# Copyright (c) 2005 Stian Soiland
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.
+# IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY
+# CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+# TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# Author: Stian Soiland <stian@soiland.no>
+# URL: http://soiland.no/i/src/pickledb/
+# License: MIT
+#
+"""Benchmarks for pickledb.
+
+Run all benchmarks:
+    ./benchpickledb.py
+
+Run only some benchmarks:
+    ./benchpickledb.py updates thread
+"""
+
+import sys
+import os
+import glob
+import tempfile
+import time
+import random
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import pickledb
+
+# Number of keys in the databases compared
+sizes = (100, 1000, 10000, 100000)
+
+# Number of shards for ShardedDB
+shards = 64
+
+def make_database(filename, keys, write="sync"):
+    """Write database of keys entries of about 100 bytes"""
+    obj = dict([(n, "value %s " % n + "x" * 90) for n in xrange(keys)])
+    if write in ("sharded", "indexed"):
+        if write == "sharded":
+            db = pickledb.ShardedDB(filename, shards=shards)
+        else:
+            db = pickledb.IndexedDB(filename)
+        db.update(obj)
+        db.close()
+        return
+    file = open(filename, "wb")
+    try:
+        pickle.dump(obj, file)
+    finally:
+        file.close()
+
+def open_database(filename, write):
+    if write == "sharded":
+        return pickledb.ShardedDB(filename)
+    if write == "indexed":
+        return pickledb.IndexedDB(filename)
+    return pickledb.open(filename, write=write)
+
+def remove_database(filename):
+    for name in glob.glob(filename + "*"):
+        os.remove(name)
+
+def bench_updates(seconds=1.0):
+    """Updates per second by write mode and database size.
+
+    Each update replaces one value. Updates are done for about seconds
+    per database, including the close() at the end. The write mode
+    "sharded" is a ShardedDB with 64 shards.
+    """
+    for write in ("sync", "log", "sharded"):
+        for keys in sizes:
+            filename = tempfile.mktemp()
+            make_database(filename, keys, write)
+            try:
+                db = open_database(filename, write)
+                updates = 0
+                start = time.time()
+                while time.time() - start < seconds:
+                    db[updates % keys] = "updated %s " % updates + "x" * 90
+                    updates += 1
+                db.close()
+                used = time.time() - start
+                print "updates write=%s keys=%s: %.0f updates/s" % (
+                      write, keys, updates / used)
+            finally:
+                remove_database(filename)
+
+def bench_open(lookups=100):
+    """Time of open() and of looking up random keys, by database size.
+
+    Compares PickleDB, which unpickles everything on open(), with
+    IndexedDB, which unpickles the looked up values only.
+    """
+    for write in ("sync", "indexed"):
+        for keys in sizes:
+            filename = tempfile.mktemp()
+            make_database(filename, keys, write)
+            try:
+                start = time.time()
+                db = open_database(filename, write)
+                opened = time.time() - start
+                start = time.time()
+                for n in xrange(lookups):
+                    db[random.randrange(keys)]
+                looked = time.time() - start
+                db.close()
+                print "open %s keys=%s: open %.2f ms, %s lookups %.2f ms" % (
+                      write, keys, opened * 1000, lookups, looked * 1000)
+            finally:
+                remove_database(filename)
+
+def bench_thread(seconds=2.0):
+    """Longest wait for an update in write mode "thread".
+
+    Updates are done for seconds with write_every 0.1 seconds, so the
+    writer thread writes the file several times meanwhile.
+    """
+    for keys in sizes:
+        filename = tempfile.mktemp()
+        make_database(filename, keys)
+        try:
+            db = pickledb.open(filename, write="thread")
+            db.write_every = 0.1
+            updates = 0
+            longest = 0.0
+            start = time.time()
+            while time.time() - start < seconds:
+                before = time.time()
+                db[updates % keys] = "updated %s " % updates + "x" * 90
+                longest = max(longest, time.time() - before)
+                updates += 1
+            db.close()
+            stats = db.statistics()
+            print ("thread keys=%s: longest update %.2f ms, "
+                   "%s flushes, longest flush %.2f ms" % (
+                   keys, longest * 1000, stats["flushes"], 
+                   stats["max_flush_time"] * 1000))
+        finally:
+            remove_database(filename)
+
+benchmarks = [
+    ("updates", bench_updates),
+    ("open", bench_open),
+    ("thread", bench_thread),
+]
+
+def main():
+    names = sys.argv[1:] or [name for (name, bench) in benchmarks]
+    for name, bench in benchmarks:
+        if name in names:
+            bench()
+
+if __name__ == "__main__":
+    main()
@@ -38,8 +38,15 @@ except ImportError:
 
 import tempfile    
 import os
+import errno
+import struct
+import zlib
+import mmap
 from doc_exception import DocstringException
 import time
+import logging
+from sets import Set
+from UserDict import DictMixin
     
 class Error(DocstringException):
     """General pickledb error"""
@@ -57,7 +64,10 @@ class AlreadyOpenError(Error):
     """Database file is already open, cannot reload"""
 
 class UnknownWriteModeError(Error):
-    """Write mode must be 'sync' or 'thread'"""
+    """Write mode must be 'sync', 'thread' or 'log'"""
+
+class UnknownDurabilityError(Error):
+    """Durability must be 'none', 'flush' or 'fsync'"""
 
 
 class _dict_wrapper(type):
@@ -82,16 +92,23 @@ class _dict_wrapper(type):
             if not hasattr(self, "_obj"):
                 raise ClosedError 
             method = getattr(self._obj, methodname)
+            if methodname == "update":
+                # So that _after_update() can tell the updated keys,
+                # even if given an iterator
+                args = (dict(*args, **kwargs),)
+                kwargs = {}
             if methodname in cls.write:
                 # Tag as updated
                 self._before_update()
+            change = None
             try:
                 res = method(*args, **kwargs)
+                change = (methodname, args, res)
             finally:    
                 if methodname in cls.write:
                     # Make sure locks are released,etc even if an error
                     # occured in method()
-                    self._after_update()
+                    self._after_update(change)
             return res
         return wrapper     
     _gen_method = classmethod(_gen_method)
@@ -112,7 +129,7 @@ class PickleDB(object):
 
     If the given file does not exists, it will be created.
     
-    The argument write can be "sync" or "thread", defining when
+    The argument write can be "sync", "thread" or "log", defining when
     changes are written to disk:
 
       sync    Changes written to file immediately on updating.
@@ -120,23 +137,55 @@ class PickleDB(object):
               changes are commited immediately. This is the default
               setting.
       
-      thread  Changes are written to file in the background every 
-              second by a seperate thread. close() will however 
-              still be syncronized and not return before 
-              all changes are written to disk. In fact, close() 
+      thread  Changes are written to file in the background at most 
+              one second after they are made, by a seperate thread. 
+              close() will however still be syncronized and not return 
+              before all changes are written to disk. In fact, close() 
               *have* to be called to make sure writer thread
               finishes.
               
               This option requires threading support. To change the
-              delay between writes, modify the attribute write_every, or
-              call sync() when a sync is really needed.
+              delay before writing, modify the attribute write_every, or
+              call sync() when a sync is really needed. To write
+              earlier when many keys have changed, set the attribute
+              max_dirty to a number of keys, or max_bytes to the
+              estimated size of the changes as pickled. The file is written from a
+              copy of the dictionary, so updates only wait for the
+              copying, not for the writing.
+
+      log     Changes are appended immediately to the log file 
+              filename.log, as small records with a checksum. The
+              whole dictionary is only written to file by sync() and 
+              close(), and when the log grows bigger than both the 
+              file and the attribute compact_after bytes. The log is
+              then emptied. On open(), the changes in the log are
+              replayed, ignoring a partly written last record.
+
+              This keeps updates fast for big databases, at the cost of
+              a slower open() after many updates.
+
+    The argument durability can be "none", "flush" or "fsync", defining
+    how hard written changes are pushed to disk:
+
+      none    Leave buffering to Python and the operating system.
+      
+      flush   Flush Python's buffers after each write, so that other
+              processes see the changes. This is the default setting.
+
+      fsync   Also wait for the operating system to write the changes
+              to the disk, so that they survive a power failure. This
+              is the slowest option.
+
+    The whole dictionary is always written to the temporary file
+    filename.new, and then renamed to filename. A crash while writing
+    therefore leaves the previous version of the database intact.
 
 
     This object can be used as the shelve module, but does not
     require or use dbm for storage. Instead, this module uses pickle
     for storing and loading the file. Note that all data are
     kept in memory and written to disk, and PickleDB can therefore not
-    be used for larger amounts of data.
+    be used for larger amounts of data. See ShardedDB for that.
 
     Unlike shelve/dbm, since the whole dictionary is pickled, all keys
     valid for a normal dictionary can be used. Note however that using
@@ -159,17 +208,46 @@ class PickleDB(object):
     be called manually. 
     
     If the write mode is set to "thread", dictionary changes are written 
-    in the background every self.write_every seconds, by default 1.0
-    seconds. To make sure changes in mutable values are stored, sync() 
-    must be used here as well. In threaded mode, close() *must* be
-    called to finish the writer thread.
+    in the background self.write_every seconds after the first change, 
+    by default 1.0 seconds. To make sure changes in mutable values are
+    stored, sync() must be used here as well. In threaded mode, close()
+    *must* be called to finish the writer thread.
+
+    Use statistics() to see how long writing takes, and in threaded
+    mode how many changes are waiting to be written.
     """
 
     __metaclass__ = _dict_wrapper
-    def __init__(self, filename, write="sync"):
+
+    # In "log" mode, minimum size of the log before the whole dictionary
+    # is written
+    compact_after = 1 << 20
+
+    # Start of the database file, see _signatures
+    _signature = None
+
+    # In "thread" mode, write before write_every seconds have passed if
+    # this many keys have changed, or the changes are this many bytes
+    # as pickled. None for no limit. The bytes are estimated without
+    # pickling, see _estimate_size().
+    max_dirty = None
+    max_bytes = None
+
+    def __init__(self, filename, write="sync", durability="flush"):
+        if durability not in ("none", "flush", "fsync"):
+            raise UnknownDurabilityError
         self._updated = False
+        self.durability = durability
         self.filename = filename
+        # In "log" mode
+        self.logname = filename + ".log"
         self.writemode = write
+        # Statistics, see statistics()
+        self.flushes = 0
+        self.flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.last_flush_time = 0.0
+        self.peak_dirty = 0
         if self.writemode == "thread":
             # Will write every 1.0 second (can be changed by the user
             # afterwards
@@ -186,27 +264,115 @@ class PickleDB(object):
 
         if hasattr(self, "_obj"):
             raise AlreadyOpenError
+        # Changes not yet written in "thread" mode, see _mark_dirty()
+        self._dirty = Set()
+        self._dirty_bytes = 0
+        self._dirty_since = None
         self._file = self._lock_open(self.filename)
         # Check end of file
         self._file.seek(0, 2)
-        if self._file.tell() == 0:
-            # File is empty, start with empty dict
-            self._obj = {}
-            self._write()
-        else:    
-            self._read()
+        try:
+            if self._file.tell() == 0:
+                # File is empty, start with empty dict
+                self._create()
+            else:    
+                if _signature(self._file) != self._signature:
+                    raise FileError, "%s is not a %s file" % (
+                          self.filename, self.__class__.__name__)
+                self._read()
+            if self.writemode == "log":
+                self._replay()
+                self._log_file = file(self.logname, "ab")
+                _copy_mode(self.filename, self.logname)
+        except:
+            # Don't keep the lock of a database we couldn't open
+            if hasattr(self, "_obj"):
+                del self._obj
+            if hasattr(self, "_log_file"):
+                self._log_file.close()
+                del self._log_file
+            self._lock_close()
+            del self._file
+            raise
         if self.writemode == "thread":
             import threading
-            self._write_lock = threading.Lock()
+            # Held while changing self._obj, notified by _mark_dirty()
+            self._write_lock = threading.Condition()
+            # Held while writing the file
+            self._flush_lock = threading.Lock()
             self._writer = threading.Thread(target=self._write_thread)
             self._writer.loop = True
             self._writer.start()
     
     def _write_thread(self):
-        """Continous write thread"""
-        while self._writer.loop:
-            time.sleep(self.write_every)
-            self.sync(only_updated=True)
+        """Continous write thread, see _flush_due().
+
+        A failed write is logged, and tried again after write_every 
+        seconds.
+        """
+        # Time of next try after a failed write
+        retry = 0
+        while True:
+            self._write_lock.acquire()
+            try:
+                while self._writer.loop and (not self._flush_due() or
+                                             time.time() < retry):
+                    if time.time() < retry:
+                        timeout = retry - time.time()
+                    elif self._dirty_since is None:
+                        # Notified on the first change
+                        timeout = None
+                    else:    
+                        timeout = (self._dirty_since + self.write_every -
+                                   time.time())
+                    self._write_lock.wait(timeout)
+                loop = self._writer.loop
+            finally:
+                self._write_lock.release()
+            if not loop:
+                # close() writes the rest
+                return
+            try:
+                self.sync(only_updated=True)
+            except:
+                # Keep running, the changes are still marked as dirty
+                logging.exception("Could not write %s", self.filename)
+                retry = time.time() + self.write_every
+
+    def _flush_due(self):
+        """Check if changes should be written in "thread" mode.
+
+        That is when the first change not written is write_every seconds 
+        old, or the changes exceed max_dirty or max_bytes. 
+        Must hold _write_lock.
+        """
+        if self._dirty_since is None:
+            return False
+        if time.time() - self._dirty_since >= self.write_every:
+            return True
+        if self.max_dirty is not None and len(self._dirty) >= self.max_dirty:
+            return True
+        if self.max_bytes is not None and self._dirty_bytes >= self.max_bytes:
+            return True
+        return False
+
+    def _mark_dirty(self, change):
+        """Note the changed keys for the writer thread. 
+        
+        Must hold _write_lock.
+        """
+        records = self._records(change)
+        first = self._dirty_since is None
+        if first:
+            self._dirty_since = time.time()
+        for (operation, key, value) in records:
+            self._dirty.add(key)
+        if self.max_bytes is not None:
+            for (operation, key, value) in records:
+                self._dirty_bytes += (_estimate_size(key) + 
+                                      _estimate_size(value))
+        if first or self._flush_due():
+            self._write_lock.notify()
 
     def sync(self, only_updated=False):        
         """Makes sure that all changes have been written to file.
@@ -216,51 +382,193 @@ class PickleDB(object):
         changes in mutable values are not neccessarily written if
         only_updated is set.
         """
+        if self.writemode == "thread":
+            self._sync_copy(only_updated)
+        elif not only_updated or self._updated:
+            self._timed_write()
+            self._updated = False
+
+    def _sync_copy(self, only_updated):
+        """Write a copy of the dictionary, for "thread" mode.
+
+        The dictionary is only locked while copying, so that it can be
+        updated while the file is written.
+        """
+        self._flush_lock.acquire()
         try:
-            if self.writemode == "thread":
-                self._write_lock.acquire()
-            if not only_updated or self._updated:
-                self._write()
+            self._write_lock.acquire()
+            try:
+                if only_updated and not self._updated:
+                    return
+                obj = self._obj.copy()
+                self.peak_dirty = max(self.peak_dirty, len(self._dirty))
+                dirty = (self._dirty, self._dirty_bytes, self._dirty_since)
+                self._dirty = Set()
+                self._dirty_bytes = 0
+                self._dirty_since = None
                 self._updated = False
-        finally:    
-            if self.writemode == "thread":
+            finally:
                 self._write_lock.release()
+            try:
+                self._timed_write(obj)
+            except:
+                # Still not written, together with any newer changes
+                self._write_lock.acquire()
+                try:
+                    self._updated = True
+                    self._dirty.union_update(dirty[0])
+                    self._dirty_bytes += dirty[1]
+                    if dirty[2] is not None:
+                        self._dirty_since = dirty[2]
+                finally:
+                    self._write_lock.release()
+                raise
+        finally:
+            self._flush_lock.release()
+
+    def _timed_write(self, obj=None):
+        """Calls _write(), keeping statistics"""
+        start = time.time()
+        self._write(obj)
+        used = time.time() - start
+        self.flushes += 1
+        self.flush_time += used
+        self.max_flush_time = max(self.max_flush_time, used)
+        self.last_flush_time = used
+
+    def statistics(self):
+        """Return dictionary of write statistics.
+
+        Keys:
+            dirty           keys changed but not yet written in 
+                            "thread" mode
+            dirty_bytes     size of these changes, if max_bytes is set
+            peak_dirty      most keys written at once in "thread" mode
+            flushes         number of times the file has been written
+            flush_time      total seconds spent writing the file
+            max_flush_time  longest time writing the file
+            last_flush_time time of the last writing of the file
+        """
+        return dict(dirty=len(self._dirty), dirty_bytes=self._dirty_bytes,
+                    peak_dirty=self.peak_dirty, flushes=self.flushes,
+                    flush_time=self.flush_time, 
+                    max_flush_time=self.max_flush_time,
+                    last_flush_time=self.last_flush_time)
     
+    def _create(self):
+        """Starts an empty database in the empty open file"""
+        self._obj = {}
+        self._write()
+
     def _read(self):
         """Reads from open file, throws away old self._obj"""
         self._file.seek(0)
         self._obj = pickle.load(self._file)
+        self._file_size = self._file.tell()
+
+    def _replay(self):
+        """Apply the changes in the log file to self._obj.
+
+        A broken last record, as left by a crash while appending, is
+        removed from the log.
+        """
+        self._log_size = 0
+        try:
+            log = file(self.logname, "r+b")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        try:
+            for record in _read_records(log):
+                _apply(self._obj, record)
+            self._log_size = log.tell()
+            log.truncate()
+        finally:
+            log.close()
+
+    def _log(self, change):
+        """Append records of change to the log, see _dict_wrapper"""
+        data = "".join([_pack_record(record) 
+                        for record in self._records(change)])
+        self._log_file.write(data)
+        _flush(self._log_file, self.durability, self.__os)
+        self._log_size += len(data)
+        if self._log_size > max(self._file_size, self.compact_after):
+            self.sync()
+
+    def _records(self, change):
+        """Get log records (operation, key, value) for change"""
+        (methodname, args, res) = change
+        if methodname == "__setitem__":
+            return [("set", args[0], args[1])]
+        elif methodname in ("__delitem__", "pop"):
+            return [("del", args[0], None)]
+        elif methodname == "popitem":
+            return [("del", res[0], None)]
+        elif methodname == "setdefault":
+            return [("set", args[0], res)]
+        elif methodname == "update":
+            return [("set", key, value) for (key, value) in args[0].items()]
+        elif methodname == "clear":
+            return [("clear", None, None)]
+        else:
+            raise Error, "Can't log %s" % methodname
     
     def _write(self, obj=None):
-        """Stores to object file, overwites existing data on file.
+        """Stores to object file, replacing existing data on file.
 
-        If obj is not given, self._obj will be saved. 
+        If obj is not given, self._obj will be saved. The file is
+        replaced atomically, see _replace().
         """
         # We allow this obj-parameter to make close() delete self._obj
         # before calling _write()
         if obj is None:
             obj = self._obj
-        self._file.seek(0)
-        # FIXME: Should use temporary file and link
-        pickle.dump(obj, self._file)
-        # Make sure written out
-        self._file.flush()
-        # Frees any previously used space
-        self._file.truncate()
+        # Closed first, as the file is replaced. (Windows can't remove
+        # open files)
+        self._file.close()
+        try:
+            self._file_size = _replace(self.filename, obj, 
+                                       self.durability, self.__os,
+                                       self._dump)
+        finally:
+            self._file = file(self.filename, "r+")
+        if self.writemode == "log" and getattr(self, "_log_size", 0):
+            # The log is included now
+            log = file(self.logname, "r+b")
+            log.truncate()
+            log.close()
+            self._log_size = 0
     
+    def _dump(self, obj, file):
+        """Pickles obj to the open file, see _write()"""
+        pickle.dump(obj, file)
+
     def _before_update(self):
         """Called by metaclass before the dictionary is updated"""
         if self.writemode == "thread":
             # To avoid changing self._obj while we are pickle-dumping
             self._write_lock.acquire()
 
-    def _after_update(self):
-        """Called by metaclass after the dictionary is updated"""
+    def _after_update(self, change=None):
+        """Called by metaclass after the dictionary is updated.
+
+        change is (methodname, args, result) of the dictionary method
+        called, or None if it failed.
+        """
         self._updated = True    
         if self.writemode == "sync":
             self.sync(only_updated=True)
         elif self.writemode == "thread":
-            self._write_lock.release()
+            try:
+                if change is not None:
+                    self._mark_dirty(change)
+            finally:        
+                self._write_lock.release()
+        elif self.writemode == "log":
+            if change is not None:
+                self._log(change)
         else:
             raise UnknownWriteModeError
     
@@ -286,13 +594,17 @@ class PickleDB(object):
         reopen the database.
 
         In threaded mode, this method will wait for the writer thread
-        to finish before returning, and might therefore take
-        self.write_every seconds to return.
+        to finish any ongoing write before returning.
         """
         if not hasattr(self, "_obj"):
             raise ClosedError 
         if self.writemode == "thread":
-            self._writer.loop = False
+            self._write_lock.acquire()
+            try:
+                self._writer.loop = False
+                self._write_lock.notify()
+            finally:
+                self._write_lock.release()
             # Let writer thread finish first
             self._writer.join()
         # disable any futher use as we from this point on
@@ -300,7 +612,10 @@ class PickleDB(object):
         # gets saved, or that lookups are from locked file
         obj = self._obj
         del self._obj 
-        self._write(obj)
+        self._timed_write(obj)
+        if self.writemode == "log":
+            self._log_file.close()
+            del self._log_file
         # Free lock
         self._lock_close()
         del self._file
@@ -323,10 +638,10 @@ class PickleDB(object):
 
         To close the returned file, use _lock_close().
         """
-        # Store away the unlink function in case 
-        # the os module is deleted before us and we
-        # still need to remove our lock file
-        self.__unlink = os.unlink
+        # Store away the os module in case it is deleted 
+        # before us and we still need to write the file and
+        # remove our lock file
+        self.__os = os
         
         lockfile = filename + ".lock"
         dir = os.path.dirname(lockfile)
@@ -351,8 +666,618 @@ class PickleDB(object):
         """
         lockfile = self._file.name + ".lock"
         self._file.close()
-        self.__unlink(lockfile)
+        self.__os.unlink(lockfile)
+
+
+class _Mapping(DictMixin):
+    """Base for dictionaries used as _obj by PickleDB subclasses.
+
+    Adds the dict methods missing from DictMixin, comparing and printing
+    a normal dictionary from copy().
+    """
+
+    def copy(self):
+        """Get a normal dictionary with all the keys"""
+        return dict(self.iteritems())
+
+    def fromkeys(self, *args):
+        return dict.fromkeys(*args)
+
+    def __repr__(self):
+        return repr(self.copy())
+    __str__ = __repr__    
+
+    def __cmp__(self, other):
+        return cmp(self.copy(), other)
+
+    def __eq__(self, other):
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return self.copy() != other
+
+    def __lt__(self, other):
+        return self.copy() < other
+
+    def __le__(self, other):
+        return self.copy() <= other
+
+    def __gt__(self, other):
+        return self.copy() > other
+
+    def __ge__(self, other):
+        return self.copy() >= other
+
+
+class _Shards(_Mapping):
+    """Dictionary spread over the shard files filename.0, filename.1, ..
+
+    A key is stored in shard number hash(key) % count. Shards are
+    loaded on first access, and the least recently used shards are
+    dropped from memory when the loaded shards are bigger than memory
+    bytes on file. Changed shards are kept in self.dirty until written
+    by flush(), or before being dropped.
+    """
+
+    def __init__(self, filename, count, memory, durability):
+        self.filename = filename
+        self.count = count
+        self.memory = memory
+        self.durability = durability
+        # Kept for writing when called from __del__ on shutdown
+        self._os = os
+        # Loaded shards and their size on file by shard number
+        self._shards = {}
+        self._sizes = {}
+        # Number of keys for each shard that has been loaded
+        self._lengths = {}
+        # Loaded shard numbers, least recently used first
+        self._used = []
+        self.dirty = Set()
+
+    def shardname(self, n):
+        return "%s.%d" % (self.filename, n)
+
+    def number(self, key):
+        """Shard number for key"""
+        return hash(key) % self.count
+
+    def shard(self, n):
+        """Get shard number n, loading it if needed"""
+        shard = self._shards.get(n)
+        if shard is None:
+            return self._load(n)
+        if self._used[-1] != n:    
+            self._used.remove(n)
+            self._used.append(n)
+        return shard
+
+    def _load(self, n):
+        try:
+            shardfile = file(self.shardname(n), "rb")
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                # Loading it as empty would overwrite it on the next write
+                raise
+            # Not written yet
+            shard = {}
+            size = 0
+        else:    
+            try:
+                shard = pickle.load(shardfile)
+                size = shardfile.tell()
+            finally:
+                shardfile.close()
+        self._shards[n] = shard
+        self._sizes[n] = size
+        self._lengths[n] = len(shard)
+        self._used.append(n)
+        self._evict()
+        return shard
+
+    def _evict(self):
+        """Drop least recently used shards until within self.memory"""
+        while len(self._used) > 1:
+            loaded = sum([self._sizes[n] for n in self._used])
+            if loaded <= self.memory:
+                break
+            n = self._used[0]
+            if n in self.dirty:
+                self.write(n)
+            del self._used[0]
+            del self._shards[n]
+            del self._sizes[n]
+
+    def write(self, n):
+        """Write loaded shard number n to file"""
+        self._sizes[n] = _replace(self.shardname(n), self._shards[n],
+                                  self.durability, self._os, 
+                                  template=self.filename)
+        self.dirty.discard(n)
+
+    def flush(self):
+        """Write all changed shards"""
+        for n in list(self.dirty):
+            self.write(n)
+
+    def touch(self):
+        """Mark all loaded shards as changed, as values might have been
+        modified in place"""
+        self.dirty.union_update(self._used)
+
+    def _changed(self, n):
+        self._lengths[n] = len(self._shards[n])
+        self.dirty.add(n)
+
+    def __getitem__(self, key):
+        return self.shard(self.number(key))[key]
+
+    def __setitem__(self, key, value):
+        n = self.number(key)
+        self.shard(n)[key] = value
+        self._changed(n)
+
+    def __delitem__(self, key):
+        n = self.number(key)
+        del self.shard(n)[key]
+        self._changed(n)
+
+    def __contains__(self, key):
+        return key in self.shard(self.number(key))
+    has_key = __contains__    
+
+    def get(self, key, default=None):
+        return self.shard(self.number(key)).get(key, default)
+
+    def __len__(self):
+        for n in range(self.count):
+            if n not in self._lengths:
+                self.shard(n)
+        return sum(self._lengths.values())
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iterkeys(self):
+        for n in range(self.count):
+            for key in self.shard(n).keys():
+                yield key
+    __iter__ = iterkeys            
+
+    def iteritems(self):
+        for n in range(self.count):
+            for item in self.shard(n).items():
+                yield item
+
+    def clear(self):
+        # No need to load the old shards
+        for n in range(self.count):
+            self._shards[n] = {}
+            self._sizes[n] = 0
+            self._lengths[n] = 0
+            self.dirty.add(n)
+        self._used = range(self.count)    
+
+    def copy(self):
+        """Get a normal dictionary with all the keys"""
+        copy = {}
+        for n in range(self.count):
+            copy.update(self.shard(n))
+        return copy
+
+
+class ShardedDB(PickleDB):
+    """A PickleDB that stores its content in several shard files.
+
+    Keys are spread by hash(key) over the given number of shards,
+    stored in the files filename.0, filename.1, etc. The file filename
+    itself only holds a signature and the number of shards, which can't
+    be changed after creating the database. PickleDB refuses to open it.
+
+    Shards are only loaded when a key in them is accessed, and the least
+    recently used shards are dropped from memory when the loaded shards
+    take more than memory bytes on file. Updating a key only writes its
+    shard, so updates cost in proportion to the shard size rather than
+    the database size.
+
+    Looking up all keys, like keys(), len(), copy() or comparisons, will
+    however load every shard, one at a time.
+
+    Only the write mode "sync" is supported. Values modified in place
+    are written by sync() and close() only if their shard has not been
+    dropped from memory in the meantime.
+
+    Keys must give the same hash() in every process that opens the
+    database. This is true for strings, numbers and tuples of these,
+    unless Python is run with hash randomization, but not for
+    objects that use the default id()-based hash.
+    """
+
+    _signature = "ShardedDB"
+
+    def __init__(self, filename, shards=16, memory=1 << 24, 
+                 write="sync", durability="flush"):
+        if write != "sync":
+            raise UnknownWriteModeError, \
+                  "ShardedDB only supports write mode 'sync'"
+        self.shards = shards
+        self.memory = memory
+        PickleDB.__init__(self, filename, write, durability)
+
+    def _create(self):
+        self._obj = _Shards(self.filename, self.shards, self.memory,
+                            self.durability)
+        # Only the header, _write() writes the shards
+        PickleDB._write(self, {"shards": self.shards, 
+                               "hash": hash("pickledb")})
+
+    def _dump(self, obj, file):
+        file.write(_signatures["ShardedDB"])
+        pickle.dump(obj, file)
+
+    def _read(self):
+        # After the signature, checked by open()
+        self._file.seek(_signature_size)
+        header = pickle.load(self._file)
+        if header["hash"] != hash("pickledb"):
+            raise FileError, "%s was created with another hash()" % \
+                             self.filename
+        self.shards = header["shards"]
+        self._obj = _Shards(self.filename, self.shards, self.memory,
+                            self.durability)
+
+    def _write(self, obj=None):
+        """Writes the changed shards"""
+        if obj is None:
+            obj = self._obj
+        obj.flush()
+
+    def sync(self, only_updated=False):
+        if not only_updated:
+            self._obj.touch()
+        PickleDB.sync(self, only_updated)
+    sync.__doc__ = PickleDB.sync.__doc__
+
+    def close(self):
+        if hasattr(self, "_obj"):
+            self._obj.touch()
+        PickleDB.close(self)
+    close.__doc__ = PickleDB.close.__doc__
+
+
+class _Values(_Mapping):
+    """Dictionary with values unpickled from a memory mapped file on
+    demand.
+
+    The file contains the signature _signatures["IndexedDB"] and the
+    pickled values, followed by the pickled index {key: (offset, 
+    length)} of the values and the trailer _trailer with the offset of
+    the index. Keys set since the file was written are
+    kept in self._changed instead of in the index. The last cache_size
+    unpickled values are kept in self._cache.
+    """
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._map = None
+        self._index = {}
+        self._changed = {}
+        self._cache = {}
+        # Cached keys, least recently used first
+        self._used = []
+        # Index of the file being written by dump()
+        self._written = None
+
+    def open(self, file):
+        """Map the open file, which must have been written by dump()"""
+        self.close()
+        self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._written is not None:
+            # Already know the index
+            self._index = self._written
+            self._written = None
+            self._changed = {}
+            return
+        if (len(self._map) < _trailer_size or 
+            self._map[-len(_magic):] != _magic):
+            self.close()
+            raise FileError, "%s is not an indexed database" % file.name
+        (offset, magic) = struct.unpack(_trailer, 
+                                        self._map[-_trailer_size:])
+        self._index = pickle.loads(self._map[offset:-_trailer_size])
+        
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def dump(self, file):
+        """Write all values and the index to file. 
+
+        The new index is used after open() of the written file.
+        """
+        signature = _signatures["IndexedDB"]
+        file.write(signature)
+        index = {}
+        offset = len(signature)
+        for (key, (old, length)) in self._index.iteritems():
+            if key in self._cache:
+                # Might have been modified in place
+                continue
+            file.write(self._map[old:old+length])
+            index[key] = (offset, length)
+            offset += length
+        changed = self._changed.items() + self._cache.items()
+        for (key, value) in changed:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            file.write(data)
+            index[key] = (offset, len(data))
+            offset += len(data)
+        pickle.dump(index, file, pickle.HIGHEST_PROTOCOL)
+        file.write(struct.pack(_trailer, offset, _magic))
+        self._written = index
+
+    def _uncache(self, key):
+        if key in self._cache:
+            del self._cache[key]
+            self._used.remove(key)
+
+    def __getitem__(self, key):
+        if key in self._changed:
+            return self._changed[key]
+        if key in self._cache:
+            if self._used[-1] != key:
+                self._used.remove(key)
+                self._used.append(key)
+            return self._cache[key]
+        (offset, length) = self._index[key]
+        value = pickle.loads(self._map[offset:offset+length])
+        self._cache[key] = value
+        self._used.append(key)
+        if len(self._used) > self.cache_size:
+            del self._cache[self._used.pop(0)]
+        return value
+
+    def __setitem__(self, key, value):
+        self._changed[key] = value
+        if key in self._index:
+            del self._index[key]
+            self._uncache(key)
+
+    def __delitem__(self, key):
+        if key in self._changed:
+            del self._changed[key]
+        else:
+            del self._index[key]
+            self._uncache(key)
+
+    def __contains__(self, key):
+        return key in self._changed or key in self._index
+    has_key = __contains__    
+
+    def __len__(self):
+        return len(self._changed) + len(self._index)
+
+    def keys(self):
+        return self._index.keys() + self._changed.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+    iterkeys = __iter__
+
+    def clear(self):
+        self._index = {}
+        self._changed = {}
+        self._cache = {}
+        self._used = []
+
+
+class IndexedDB(PickleDB):
+    """A PickleDB that only unpickles the values that are used.
+
+    Values are pickled one by one to the file, followed by an index of
+    the keys and the location of their values. open() only loads the
+    index, and the file is memory mapped, so looking up a key unpickles
+    just its value. The last cache_size values looked up are kept
+    unpickled.
+
+    Writing still writes the whole file, but unchanged values are
+    copied from the old file without unpickling. For fewer writes, use
+    the write mode "log". The write mode "thread" is not supported, as
+    looking up values changes the cache.
+
+    Values modified in place are only written by sync() and close() if
+    they are still in the cache.
+
+    Note that the file format is not the same as for PickleDB, and
+    PickleDB refuses to open IndexedDB files.
+    """
+
+    _signature = "IndexedDB"
+
+    def __init__(self, filename, write="sync", durability="flush",
+                 cache_size=100):
+        if write not in ("sync", "log"):
+            raise UnknownWriteModeError, \
+                  "IndexedDB only supports write modes 'sync' and 'log'"
+        self.cache_size = cache_size
+        PickleDB.__init__(self, filename, write, durability)
+
+    def _create(self):
+        self._obj = _Values(self.cache_size)
+        self._write()
+
+    def _read(self):
+        self._obj = _Values(self.cache_size)
+        self._obj.open(self._file)
+        self._file.seek(0, 2)
+        self._file_size = self._file.tell()
+
+    def _dump(self, obj, file):
+        obj.dump(file)
+
+    def _write(self, obj=None):
+        if obj is None:
+            obj = self._obj
+        PickleDB._write(self, obj)
+        obj.open(self._file)
+
+    def close(self):
+        obj = getattr(self, "_obj", None)
+        PickleDB.close(self)
+        obj.close()
+    close.__doc__ = PickleDB.close.__doc__
+
+
+def _replace(filename, obj, durability, os=os, dump=pickle.dump, 
+             template=None):
+    """Pickle obj to filename, returning the size of the file.
+
+    The object is written by dump(obj, file) to the temporary file
+    filename.new, which is renamed over filename, so that the file
+    always contains either the old or the new version. The new file
+    gets the permissions of filename, or of template if filename
+    doesn't exist yet.
+    """
+    newname = filename + ".new"
+    try:
+        new = file(newname, "wb")
+        try:
+            dump(obj, new)
+            size = new.tell()
+            _flush(new, durability, os)
+        finally:
+            new.close()
+        if not _copy_mode(filename, newname, os) and template:
+            _copy_mode(template, newname, os)
+        if os.name != "posix" and os.path.exists(filename):
+            # rename() can't replace files on Windows
+            os.remove(filename)
+        os.rename(newname, filename)
+    except:
+        # Leave the old file as it was
+        if os.path.exists(newname):
+            os.remove(newname)
+        raise
+    if durability == "fsync" and os.name == "posix":
+        # Make the rename itself durable
+        dir = os.open(os.path.dirname(filename) or os.curdir, os.O_RDONLY)
+        try:
+            os.fsync(dir)
+        finally:
+            os.close(dir)
+    return size
+
+def _copy_mode(filename, other, os=os):
+    """Give the file other the permissions, and if allowed the owner,
+    of filename. Return False if filename doesn't exist."""
+    try:
+        stat = os.stat(filename)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    os.chmod(other, stat.st_mode & 07777)
+    if hasattr(os, "chown"):
+        try:
+            os.chown(other, stat.st_uid, stat.st_gid)
+        except OSError:
+            # Only allowed to give files away as root
+            pass
+    return True
+
+def _estimate_size(value, depth=2):
+    """Estimate the size of value as pickled, without pickling it.
+
+    Strings count their length, and lists, tuples and dictionaries the
+    sizes of their items, down to depth levels. Anything else counts 8
+    bytes.
+    """
+    if isinstance(value, basestring):
+        return len(value) + 5
+    if not depth:
+        return 8
+    if isinstance(value, dict):
+        size = 2
+        for (key, item) in value.iteritems():
+            size += (_estimate_size(key, depth-1) + 
+                     _estimate_size(item, depth-1))
+        return size
+    if isinstance(value, (list, tuple)):
+        size = 2
+        for item in value:
+            size += _estimate_size(item, depth-1)
+        return size
+    return 8
+
+def _flush(file, durability, os=os):
+    """Flush file to disk according to durability"""
+    if durability == "none":
+        return
+    file.flush()
+    if durability == "fsync":
+        os.fsync(file.fileno())
+
+# Start of the files that are not pickled dictionaries, by class name.
+# All have the same length.
+_signatures = {"IndexedDB": "PickleDB indexed\n",
+               "ShardedDB": "PickleDB sharded\n"}
+_signature_size = len(_signatures["IndexedDB"])
+
+def _signature(file):
+    """Get class name for the signature that file starts with, or None"""
+    file.seek(0)
+    start = file.read(_signature_size)
+    for (name, signature) in _signatures.items():
+        if start == signature:
+            return name
+    return None
+
+# IndexedDB file trailer: offset of the index, and _magic
+_magic = "PickleDB"
+_trailer = ">Q%ds" % len(_magic)
+_trailer_size = struct.calcsize(_trailer)
+
+# Log record header: length and CRC-32 of the pickled record
+_header = ">II"
+_header_size = struct.calcsize(_header)
+
+def _pack_record(record):
+    """Pack record (operation, key, value) for the log"""
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    crc = zlib.crc32(data) & 0xffffffff
+    return struct.pack(_header, len(data), crc) + data
+
+def _read_records(log):
+    """Yield the records of log file.
+
+    Stops at the first incomplete or broken record, leaving the file
+    position after the last good record.
+    """
+    while True:
+        start = log.tell()
+        header = log.read(_header_size)
+        if len(header) == _header_size:
+            (length, crc) = struct.unpack(_header, header)
+            data = log.read(length)
+            if (len(data) == length and 
+                zlib.crc32(data) & 0xffffffff == crc):
+                yield pickle.loads(data)
+                continue
+        log.seek(start)
+        return
 
+def _apply(obj, record):
+    """Apply log record to the dictionary obj"""
+    (operation, key, value) = record
+    if operation == "set":
+        obj[key] = value
+    elif operation == "del":
+        obj.pop(key, None)
+    elif operation == "clear":
+        obj.clear()
+    else:
+        raise Error, "Unknown log operation %s" % operation
 
 # open function is the same as PickleDB constructor
 open = PickleDB
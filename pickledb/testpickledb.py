@@ -34,10 +34,13 @@ import unittest
 import pickledb
 import tempfile
 import os
+import errno
 import gc
 import pickle
 import glob
 import time
+import shutil
+import logging
 
 class OpenCloseTests(unittest.TestCase):
     
@@ -181,6 +184,26 @@ class ObjSaveTests(unittest.TestCase):
         # Should shrink the file size
         small = os.stat(self.fname).st_size    
         self.assert_(small < large)
+
+    def testAtomicWrite(self):
+        self.db["fish"] = 31337
+        # Functions can't be pickled
+        self.assertRaises((pickle.PicklingError, TypeError), 
+                          self.db.__setitem__, "cod", lambda: 1)
+        self.assertEqual(pickle.load(open(self.fname)), {"fish": 31337})
+        self.assert_(not os.path.exists(self.fname + ".new"))
+        del self.db["cod"]
+        self.assertEqual(pickle.load(open(self.fname)), {"fish": 31337})
+
+    def testDurability(self):
+        self.db.close()
+        self.assertRaises(pickledb.UnknownDurabilityError, 
+                          pickledb.open, self.fname, durability="disk")
+        for durability in ("none", "flush", "fsync"):
+            self.db = pickledb.open(self.fname, durability=durability)
+            self.db[durability] = 1
+            self.assertEqual(pickle.load(open(self.fname))[durability], 1)
+            self.db.close()
         
 
 class DictTests(unittest.TestCase):
@@ -293,6 +316,31 @@ class WriteTests(unittest.TestCase):
         self.assert_(used > 0.2)
         db.close()
     
+    def mode(self, filename):
+        return os.stat(filename).st_mode & 0777
+
+    def testKeepMode(self):
+        db = pickledb.open(self.fname)
+        db["fish"] = 1
+        os.chmod(self.fname, 0600)
+        db["cod"] = 2
+        self.assertEqual(self.mode(self.fname), 0600)
+        db.close()
+        db = pickledb.open(self.fname, write="log")
+        db["fish"] = 2
+        self.assertEqual(self.mode(db.logname), 0600)
+        db.close()
+        self.assertEqual(self.mode(self.fname), 0600)
+        db = pickledb.ShardedDB(self.fname + "-sharded", shards=2)
+        os.chmod(self.fname + "-sharded", 0640)
+        db[0] = 0
+        # A new shard gets the mode of the header file
+        self.assertEqual(self.mode(self.fname + "-sharded.0"), 0640)
+        os.chmod(self.fname + "-sharded.0", 0600)
+        db[0] = 1
+        self.assertEqual(self.mode(self.fname + "-sharded.0"), 0600)
+        db.close()
+
     def testThreadedWrite(self): 
         try:
             db = pickledb.open(self.fname, write="thread")
@@ -370,6 +418,373 @@ class WriteTests(unittest.TestCase):
             except:
                 pass        
         
+    def testEstimateSize(self):
+        for value in ("x" * 500, [1, 2, "abc"], {"fish": ("cod", 2)}, 15):
+            size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+            estimate = pickledb._estimate_size(value)
+            self.assert_(size / 2 <= estimate <= size * 2, 
+                         (value, size, estimate))
+        # Can't be pickled, but can be estimated
+        self.assertEqual(pickledb._estimate_size(lambda: 1), 8)
+
+    def testThreadedMaxDirty(self): 
+        try:
+            db = pickledb.open(self.fname, write="thread")
+            db.write_every = 60.0
+            db.max_dirty = 10
+            for x in range(9):
+                db[x] = x
+            time.sleep(0.2)
+            self.assertEqual(pickle.load(open(self.fname)), {})
+            self.assertEqual(db.statistics()["dirty"], 9)
+            db[9] = 9
+            # Written without waiting for write_every
+            time.sleep(0.5)
+            self.assertEqual(len(pickle.load(open(self.fname))), 10)
+            stats = db.statistics()
+            self.assertEqual(stats["dirty"], 0)
+            self.assertEqual(stats["peak_dirty"], 10)
+            self.assertEqual(stats["flushes"], 1)
+            db.max_dirty = None
+            db.max_bytes = 1000
+            db["fish"] = "x" * 500
+            time.sleep(0.2)
+            self.assert_(db.statistics()["dirty_bytes"] > 500)
+            db["cod"] = "x" * 500
+            time.sleep(0.5)
+            self.assertEqual(len(pickle.load(open(self.fname))), 12)
+            self.assertEqual(db.statistics()["dirty_bytes"], 0)
+            db.close()
+            self.assertEqual(db.statistics()["flushes"], 3)
+        finally:
+            try:
+                db.close()
+            except:
+                pass        
+
+    def testThreadedWriteError(self):
+        # Don't print the logged error
+        logging.disable(logging.CRITICAL)
+        try:
+            db = pickledb.open(self.fname, write="thread")
+            db.write_every = 0.1
+            def broken(obj=None):
+                raise IOError, "Disk full"
+            db._write = broken
+            db["fish"] = 1
+            time.sleep(0.3)
+            self.assertEqual(db.statistics()["dirty"], 1)
+            self.assertEqual(pickle.load(open(self.fname)), {})
+            # Tried again by the same thread, without further changes
+            del db._write
+            time.sleep(0.3)
+            self.assertEqual(pickle.load(open(self.fname)), {"fish": 1})
+            self.assertEqual(db.statistics()["dirty"], 0)
+            self.assert_(db._writer.isAlive())
+        finally:
+            logging.disable(logging.NOTSET)
+            try:
+                db.close()
+            except:
+                pass        
+
+    def testStatistics(self):
+        db = pickledb.open(self.fname)
+        db["fish"] = 1
+        stats = db.statistics()
+        self.assertEqual(stats["flushes"], 1)
+        self.assert_(stats["flush_time"] >= stats["max_flush_time"] 
+                     >= stats["last_flush_time"] > 0)
+        self.assertEqual(stats["dirty"], 0)
+        db.close()
+        
+class LogTests(unittest.TestCase):
+    def setUp(self):
+        self.fname = tempfile.mktemp()
+        self.db = pickledb.open(self.fname, write="log")
+
+    def tearDown(self):
+        try:
+            self.db.close()
+        except pickledb.ClosedError:
+            pass    
+        for file in glob.glob(self.fname + "*"):
+            try:
+                os.remove(file)     
+            except OSError:
+                pass
+
+    def crash(self):
+        """Copy the files of the open database, as if it crashed.
+        Return the copied filename"""
+        copy = self.fname + "-crashed"
+        shutil.copy(self.fname, copy)
+        shutil.copy(self.db.logname, copy + ".log")
+        return copy
+
+    def testReplay(self):
+        self.db["fish"] = 1
+        self.db["cod"] = 2
+        # Only the log is written
+        self.assertEqual(pickle.load(open(self.fname)), {})
+        self.assert_(os.path.getsize(self.db.logname) > 0)
+        self.db.update([("knott", 3), ("cod", 4)])
+        del self.db["fish"]
+        self.assertEqual(self.db.setdefault("salmon", 5), 5)
+        self.db.pop("salmon")
+        self.db.pop("salmon", None)
+        self.db["x"] = 6
+        self.db.popitem()
+        crashed = pickledb.open(self.crash(), write="log")
+        self.assertEqual(crashed.copy(), self.db.copy())
+        crashed.clear()
+        crashed["y"] = 7
+        crashed.close()
+        crashed = pickledb.open(crashed.filename, write="log")
+        self.assertEqual(crashed, {"y": 7})
+        crashed.close()
+
+    def testBrokenRecord(self):
+        self.db["fish"] = 1
+        self.db["cod"] = 2
+        copy = self.crash()
+        size = os.path.getsize(copy + ".log")
+        # Half written last record
+        log = open(copy + ".log", "r+b")
+        log.truncate(size - 3)
+        log.close()
+        crashed = pickledb.open(copy, write="log")
+        self.assertEqual(crashed, {"fish": 1})
+        # Cut off from the log
+        self.assert_(os.path.getsize(copy + ".log") < size - 3)
+        crashed["cod"] = 3
+        crashed.close()
+        self.assertEqual(pickle.load(open(copy)), {"fish": 1, "cod": 3})
+
+    def testUnknownRecord(self):
+        self.db["fish"] = 1
+        copy = self.crash()
+        log = open(copy + ".log", "ab")
+        log.write(pickledb._pack_record(("shuffle", None, None)))
+        log.close()
+        self.assertRaises(pickledb.Error, pickledb.open, copy, write="log")
+        # Lock released
+        os.remove(copy + ".log")
+        crashed = pickledb.open(copy, write="log")
+        self.assertEqual(crashed, {})
+        crashed.close()
+
+    def testCompact(self):
+        self.db.compact_after = 1000
+        for x in range(100):
+            self.db[x] = x
+        self.assert_(os.path.getsize(self.db.logname) <= 1000)
+        self.assertNotEqual(pickle.load(open(self.fname)), {})
+        self.db.sync()
+        self.assertEqual(os.path.getsize(self.db.logname), 0)
+        self.assertEqual(pickle.load(open(self.fname)), self.db.copy())
+        self.db.close()
+        self.assertEqual(pickle.load(open(self.fname)), 
+                         dict([(x, x) for x in range(100)]))
+
+class ShardedTests(unittest.TestCase):
+    def setUp(self):
+        self.fname = tempfile.mktemp()
+        self.db = pickledb.ShardedDB(self.fname, shards=4)
+
+    def tearDown(self):
+        try:
+            self.db.close()
+        except pickledb.ClosedError:
+            pass    
+        for file in glob.glob(self.fname + "*"):
+            try:
+                os.remove(file)     
+            except OSError:
+                pass
+
+    def shard(self, key):
+        """Load the shard file of key"""
+        return pickle.load(open("%s.%d" % (self.fname, hash(key) % 4)))
+
+    def testWriteShard(self):
+        self.db["fish"] = 1
+        self.assertEqual(self.shard("fish"), {"fish": 1})
+        # Only the touched shard is written
+        self.assertEqual(len(glob.glob(self.fname + ".[0-9]")), 1)
+        self.db.update([(x, x) for x in range(100)])
+        del self.db[50]
+        self.assertEqual(self.db.pop(51), 51)
+        self.assert_(50 not in self.shard(50))
+        self.assertEqual(self.shard(52)[52], 52)
+        self.assertEqual(len(self.db), 99)
+        self.db.close()
+        header = open(self.fname)
+        self.assertEqual(header.read(len("PickleDB sharded\n")), 
+                         "PickleDB sharded\n")
+        self.assertEqual(pickle.load(header),
+                         {"shards": 4, "hash": hash("pickledb")})
+        self.assertRaises(pickledb.FileError, pickledb.open, self.fname)
+        db = pickledb.ShardedDB(self.fname)
+        self.assertEqual(db.shards, 4)
+        self.assertEqual(db["fish"], 1)
+        expected = dict([(x, x) for x in range(100)])
+        expected["fish"] = 1
+        del expected[50]
+        del expected[51]
+        self.assertEqual(db, expected)
+        self.assertEqual(sorted(db.keys()), sorted(expected.keys()))
+        db.clear()
+        self.assertEqual(db, {})
+        db.close()
+        self.assertEqual(self.shard(52), {})
+
+    def testEvict(self):
+        self.db.update([(x, "x" * 100) for x in range(100)])
+        self.db.close()
+        self.db = pickledb.ShardedDB(self.fname, memory=1)
+        self.assertEqual(self.db._obj._shards, {})
+        self.db[0] = "changed"
+        self.assertEqual(self.db[1], "x" * 100)
+        # Only the last one kept in memory, the changed shard written
+        self.assertEqual(len(self.db._obj._shards), 1)
+        self.assertEqual(self.shard(0)[0], "changed")
+        self.assertEqual(len(self.db), 100)
+        self.assertEqual(len(self.db._obj._shards), 1)
+
+    def testLoadError(self):
+        self.db.update([(x, x) for x in range(100)])
+        self.db.close()
+        self.db = pickledb.ShardedDB(self.fname)
+        def failing(*args):
+            raise IOError(errno.EMFILE, "Too many open files")
+        pickledb.file = failing
+        try:
+            self.assertRaises(IOError, self.db.__setitem__, 0, "new")
+        finally:
+            del pickledb.file
+        self.db.close()
+        self.db = pickledb.ShardedDB(self.fname)
+        self.assertEqual(len(self.db), 100)
+        self.assertEqual(self.db[0], 0)
+
+    def testMutable(self):
+        self.db["fish"] = []
+        self.db["fish"].append(1)
+        self.assertEqual(self.shard("fish"), {"fish": []})
+        self.db.sync()
+        self.assertEqual(self.shard("fish"), {"fish": [1]})
+
+    def testNotSharded(self):
+        self.db.close()
+        os.remove(self.fname)
+        db = pickledb.open(self.fname)
+        db.close()
+        self.assertRaises(pickledb.FileError, 
+                          pickledb.ShardedDB, self.fname)
+        # Lock released
+        pickledb.open(self.fname).close()
+        self.assertRaises(pickledb.UnknownWriteModeError,
+                          pickledb.ShardedDB, self.fname, write="thread")
+
+class IndexedTests(unittest.TestCase):
+    def setUp(self):
+        self.fname = tempfile.mktemp()
+        self.db = pickledb.IndexedDB(self.fname, cache_size=2)
+
+    def tearDown(self):
+        try:
+            self.db.close()
+        except pickledb.ClosedError:
+            pass    
+        for file in glob.glob(self.fname + "*"):
+            try:
+                os.remove(file)     
+            except OSError:
+                pass
+
+    def testLazy(self):
+        expected = dict([(x, [x]) for x in range(10)])
+        self.db.update(expected)
+        self.db.close()
+        self.db.open()
+        self.assertEqual(self.db._obj._cache, {})
+        self.assertEqual(len(self.db), 10)
+        self.assert_(5 in self.db)
+        self.assertEqual(self.db._obj._cache, {})
+        self.assertEqual(self.db[5], [5])
+        self.assertEqual(self.db._obj._cache, {5: [5]})
+        self.db[4]
+        self.db[3]
+        # Only 2 kept
+        self.assertEqual(self.db._obj._cache, {4: [4], 3: [3]})
+        self.assertEqual(self.db, expected)
+        self.assertEqual(sorted(self.db.keys()), range(10))
+
+    def testUpdate(self):
+        self.db.update([(x, x) for x in range(10)])
+        self.db[3] = "three"
+        del self.db[4]
+        self.assertEqual(self.db.pop(5), 5)
+        self.assertEqual(self.db.setdefault(11, 11), 11)
+        self.db.close()
+        self.db = pickledb.IndexedDB(self.fname)
+        expected = dict([(x, x) for x in range(10)])
+        expected[3] = "three"
+        del expected[4]
+        del expected[5]
+        expected[11] = 11
+        self.assertEqual(self.db, expected)
+        self.db.clear()
+        self.db.close()
+        self.db.open()
+        self.assertEqual(self.db, {})
+
+    def testMutable(self):
+        self.db["fish"] = []
+        self.db.close()
+        self.db.open()
+        self.db["fish"].append(1)
+        self.db.sync()
+        self.db.close()
+        self.db.open()
+        self.assertEqual(self.db["fish"], [1])
+
+    def testLog(self):
+        self.db.close()
+        self.db = pickledb.IndexedDB(self.fname, write="log")
+        self.db["fish"] = 1
+        self.db["cod"] = 2
+        size = os.path.getsize(self.fname)
+        self.assert_(os.path.getsize(self.db.logname) > 0)
+        copy = self.fname + "-crashed"
+        shutil.copy(self.fname, copy)
+        shutil.copy(self.db.logname, copy + ".log")
+        crashed = pickledb.IndexedDB(copy, write="log")
+        self.assertEqual(crashed, {"fish": 1, "cod": 2})
+        crashed.close()
+        self.db.close()
+        self.assert_(os.path.getsize(self.fname) > size)
+
+    def testOtherFormat(self):
+        self.db["x"] = 1
+        self.db["y"] = 2
+        self.db.close()
+        self.assertRaises(pickledb.FileError, pickledb.open, self.fname)
+        # Still intact, and lock released
+        self.db.open()
+        self.assertEqual(self.db, {"x": 1, "y": 2})
+
+    def testNotIndexed(self):
+        self.db.close()
+        os.remove(self.fname)
+        db = pickledb.open(self.fname)
+        db.close()
+        self.assertRaises(pickledb.FileError, 
+                          pickledb.IndexedDB, self.fname)
+        self.assertRaises(pickledb.UnknownWriteModeError,
+                          pickledb.IndexedDB, self.fname, write="thread")
+
 class AdvancedPicklingTest(unittest.TestCase):
     def setUp(self):
         self.fname = tempfile.mktemp()